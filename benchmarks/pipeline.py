@@ -0,0 +1,562 @@
+"""
+Benchmark of the processing stages on the bundled example stations.
+
+Every stage of the GUI pipeline (parse, NMDB, quality, corrections,
+calibration, soil moisture, ...) is timed on the example data and on
+synthetically longer versions of it: the time series is repeated
+backwards in time, shifted by its span, and the NMDB fixture is shifted
+along, so that 10x means 10 times as many rows. Raw data archives are
+replicated with raw_parse.replicate_zip() and only parsed, other tables
+without a configuration only read. Each case runs in a fresh process,
+so that the peak memory is its own.
+
+The results are written as JSON and can be saved as a baseline, against
+which later runs are compared. The script exits with 1 if a stage got
+slower, or needs more memory, than the baseline by more than the
+tolerance.
+
+Usage:
+    python benchmarks/pipeline.py --scales 1 10 --save-baseline
+    python benchmarks/pipeline.py --scales 1 10 --baseline
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+from neptoon_gui_profile import Profiler, data_rows, rss_bytes  # noqa: E402
+
+CONFIG_DIR = ROOT / "default_configuration"
+EXAMPLE_DIR = ROOT / "example_data"
+NMDB_FIXTURE = EXAMPLE_DIR / "nmdb_JUNG_revori_60_fixture.txt.gz"
+BASELINE_FILE = ROOT / "benchmarks" / "baseline.json"
+
+# name: (kind, file, sensor YAML), raw data is parsed with the settings
+# of raw_parse.SENSOR_YAML
+DATASETS = {
+    "FSC001": ("pipeline", None, CONFIG_DIR / "FSC001_station.yaml"),
+    "FinApp01": ("pipeline", None, CONFIG_DIR / "FinApp01.yaml"),
+    "Hydroinnova-A": (
+        "raw",
+        EXAMPLE_DIR / "CRNS-station_data-Hydroinnova-A.zip",
+        None,
+    ),
+    "Hydroinnova-example": (
+        "raw",
+        ROOT / "data" / "CRNS-station_data-Hydroinnova-example.zip",
+        None,
+    ),
+    "Sheepdrove2": ("table", EXAMPLE_DIR / "Sheepdrove2-CRNS.csv", None),
+    "Sheepdrove2-calibration": (
+        "table",
+        EXAMPLE_DIR / "Sheepdrove2-calibration.csv",
+        None,
+    ),
+    "FSCD001-calibration": (
+        "table",
+        EXAMPLE_DIR / "FSCD001_calibration.csv",
+        None,
+    ),
+}
+PROCESSING_YAML = CONFIG_DIR / "v1_processing_method.yaml"
+
+
+class ShiftedFetcher:
+    """
+    NMDB fetcher for a time series repeated backwards in time: a
+    request is served from the fixture at the original times of every
+    copy.
+    """
+
+    def __init__(self, fetcher, shift, copies):
+        self.fetcher = fetcher
+        self.shift = shift
+        self.copies = copies
+
+    def __call__(self, station, nmdb_table, resolution, start, end):
+        parts = []
+        for copy in range(self.copies):
+            offset = copy * self.shift
+            part = self.fetcher(
+                station, nmdb_table, resolution, start + offset, end + offset
+            ).copy()
+            part.index = part.index - offset
+            parts.append(part)
+        data = pd.concat(parts).sort_index()
+        return data[~data.index.duplicated()]
+
+
+def repeat_backwards(times, copies):
+    """
+    Times of a series repeated copies times backwards in time.
+
+    Returns
+    -------
+    tuple
+        The times, oldest copy first, and the shift between two copies
+    """
+    step = times.iloc[1] - times.iloc[0] if len(times) > 1 else pd.Timedelta(0)
+    shift = times.max() - times.min() + step
+    shifted = [times - copy * shift for copy in reversed(range(copies))]
+    return pd.concat(shifted, ignore_index=True), shift
+
+
+def scale_table(source, target, column, date_time_format, copies):
+    """
+    Write a CSV repeated copies times backwards in time into target.
+
+    Returns
+    -------
+    pd.Timedelta
+        Shift between two copies
+    """
+    data_frame = pd.read_csv(source)
+    times = pd.to_datetime(data_frame[column], format=date_time_format)
+    times, shift = repeat_backwards(times, copies)
+    data_frame = pd.concat([data_frame] * copies, ignore_index=True)
+    data_frame[column] = times.dt.strftime(date_time_format)
+    data_frame.to_csv(target, index=False)
+    return shift
+
+
+def load_process(sensor_yaml):
+    from neptoon.io.read import ConfigurationManager
+    from neptoon.workflow import ProcessWithYaml
+
+    config = ConfigurationManager()
+    config.load_configuration(file_path=sensor_yaml)
+    config.load_configuration(file_path=PROCESSING_YAML)
+    return ProcessWithYaml(configuration_object=config)
+
+
+def pipeline_stages(process, store):
+    """
+    Stages of neptoon_gui_incremental.run_pipeline(), one by one.
+
+    Returns
+    -------
+    list of tuple
+        Name and function of the stages
+    """
+    from neptoon.columns import ColumnInfo
+    from neptoon_gui_calibration import calibrate
+    from neptoon_gui_corrections import correct_neutrons_from_config
+    from neptoon_gui_ingest import create_data_hub
+    from neptoon_gui_nmdb import attach_nmdb_data
+    from neptoon_gui_quality import use_vectorized_quality
+    from neptoon_gui_soil_moisture import produce_soil_moisture
+
+    use_vectorized_quality(process)
+    process_config = process.process_config
+    sensor_config = process.sensor_config
+    smoothing = process_config.data_smoothing
+
+    def quality():
+        process._apply_quality_assessment(
+            partial_config=process_config.neutron_quality_assessment,
+            name_of_target="raw_neutrons",
+        )
+        process._apply_quality_assessment(
+            partial_config=sensor_config.input_data_qa,
+            name_of_target=None,
+        )
+
+    def soil_moisture():
+        produce_soil_moisture(process)
+        if smoothing.smooth_soil_moisture:
+            process._smooth_data(
+                column_to_smooth=str(ColumnInfo.Name.SOIL_MOISTURE_FINAL),
+            )
+        process._apply_quality_assessment(
+            partial_config=sensor_config.soil_moisture_qa,
+            name_of_target=None,
+        )
+
+    stages = [
+        ("parse", lambda: create_data_hub(process, use_sidecar=False)),
+        ("nmdb", lambda: attach_nmdb_data(process, store)),
+        ("static_values", process._prepare_static_values),
+        ("quality", quality),
+        ("corrections", lambda: correct_neutrons_from_config(process)),
+    ]
+    if sensor_config.calibration.calibrate:
+        stages.append(("calibration", lambda: calibrate(process)))
+    stages.append(
+        (
+            "quality_corrected",
+            lambda: process._apply_quality_assessment(
+                partial_config=process_config.neutron_quality_assessment,
+                name_of_target="corrected_neutrons",
+            ),
+        )
+    )
+    if smoothing.smooth_corrected_neutrons:
+        stages.append(
+            (
+                "smoothing",
+                lambda: process._smooth_data(
+                    column_to_smooth=str(
+                        ColumnInfo.Name.CORRECTED_EPI_NEUTRON_COUNT
+                    ),
+                ),
+            )
+        )
+    stages.append(("soil_moisture", soil_moisture))
+    return stages
+
+
+def run_pipeline_case(profiler, run, sensor_yaml, scale, folder):
+    from neptoon_gui_nmdb import FixtureFetcher, NMDBStore
+
+    process = load_process(sensor_yaml)
+    tmp = process.sensor_config.time_series_data
+    # paths in the YAML are resolved by neptoon
+    source = Path(tmp.path_to_data)
+    target = Path(folder) / source.name
+    column = tmp.key_column_info.date_time_columns
+    column = column if isinstance(column, str) else column[0]
+    shift = scale_table(
+        source, target, column, tmp.key_column_info.date_time_format, scale
+    )
+    tmp.path_to_data = str(target)
+
+    fetcher = FixtureFetcher(NMDB_FIXTURE)
+    if scale > 1:
+        fetcher = ShiftedFetcher(fetcher, shift, scale)
+        # the copies start before the sensor was installed
+        process.sensor_config.sensor_info.install_date -= (
+            scale - 1
+        ) * shift.to_pytimedelta()
+    store = NMDBStore(cache_dir=Path(folder) / "nmdb", fetcher=fetcher)
+
+    for stage, function in pipeline_stages(process, store):
+        if stage == "nmdb":
+            # fill the store beforehand, as on a running server
+            index = process.data_hub.crns_data_frame.index
+            tmp = process.process_config.correction_steps.incoming_radiation
+            monitor = tmp.reference_neutron_monitor
+            store.update(
+                monitor.station,
+                monitor.nmdb_table or "revori",
+                str(monitor.resolution or "60"),
+                index[0],
+                index[-1],
+            )
+        with profiler.stage(
+            run, stage, rows=lambda: data_rows(process)
+        ) as record:
+            record["start_rss_mb"] = rss_bytes() / 2**20
+            function()
+
+
+def run_raw_case(profiler, run, location, scale, folder):
+    from raw_parse import make_parser, replicate_zip
+
+    if scale > 1:
+        target = Path(folder) / "replicated.zip"
+        replicate_zip(location, target, scale)
+        location = target
+    parser = make_parser(location)
+    result = {}
+    with profiler.stage(
+        run, "parse_raw", rows=lambda: len(result["data"])
+    ) as record:
+        record["start_rss_mb"] = rss_bytes() / 2**20
+        result["data"] = parser.parse(workers=0)
+
+
+def run_table_case(profiler, run, location, scale, folder):
+    from neptoon_gui_ingest import read_time_series_file
+
+    if scale > 1:
+        target = Path(folder) / Path(location).name
+        data_frame = pd.read_csv(location)
+        pd.concat([data_frame] * scale, ignore_index=True).to_csv(
+            target, index=False
+        )
+        location = target
+    result = {}
+    with profiler.stage(
+        run, "read", rows=lambda: len(result["data"])
+    ) as record:
+        record["start_rss_mb"] = rss_bytes() / 2**20
+        result["data"] = read_time_series_file(location)
+
+
+def run_case(dataset, scale):
+    """
+    Benchmark one dataset at one scale, meant to run in its own process.
+
+    Returns
+    -------
+    list of dict
+        Profiler records of the stages
+    """
+    os.environ.setdefault("DISABLE_PANDERA_IMPORT_WARNING", "True")
+    kind, location, sensor_yaml = DATASETS[dataset]
+    profiler = Profiler()
+    run = "{:} x{:}".format(dataset, scale)
+    folder = tempfile.mkdtemp()
+    try:
+        if kind == "pipeline":
+            run_pipeline_case(profiler, run, sensor_yaml, scale, folder)
+        elif kind == "raw":
+            run_raw_case(profiler, run, location, scale, folder)
+        else:
+            run_table_case(profiler, run, location, scale, folder)
+    finally:
+        shutil.rmtree(folder)
+    records = profiler.records()
+    for record in records:
+        record.update(dataset=dataset, scale=scale)
+        record["rows_per_s"] = (record["rows"] or 0) / max(
+            record["wall_s"], 1e-9
+        )
+    return records
+
+
+def base_rows(dataset):
+    """Rows of a dataset at scale 1, to skip too large scales."""
+    kind, location, sensor_yaml = DATASETS[dataset]
+    if kind == "pipeline":
+        from neptoon.io.read import ConfigurationManager
+
+        config = ConfigurationManager()
+        config.load_configuration(file_path=sensor_yaml)
+        location = config.get_config("sensor").time_series_data.path_to_data
+    elif kind == "raw":
+        import zipfile
+
+        # about one line per 200 bytes in the Hydroinnova files
+        with zipfile.ZipFile(location) as archive:
+            return sum(i.file_size for i in archive.infolist()) // 200
+    with open(location, "rb") as file:
+        return sum(1 for _ in file) - 1
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Compare results with a baseline.
+
+    Parameters
+    ----------
+    results, baseline : list of dict
+        Records as returned by run_case()
+    tolerance : float
+        Allowed relative loss in rows/s and gain in peak memory
+    min_seconds : float
+        Stages faster than this in both runs are not compared, their
+        timing is mostly noise
+
+    Returns
+    -------
+    list of str
+        The regressions
+    """
+    reference = {(r["dataset"], r["scale"], r["stage"]): r for r in baseline}
+    regressions = []
+    for record in results:
+        key = (record["dataset"], record["scale"], record["stage"])
+        old = reference.get(key)
+        if old is None or record["status"] != "ok":
+            continue
+        name = "{:} x{:} {:}".format(*key)
+        if max(record["wall_s"], old["wall_s"]) >= min_seconds and record[
+            "rows_per_s"
+        ] < old["rows_per_s"] * (1 - tolerance):
+            regressions.append(
+                "{:}: {:,.0f} rows/s, baseline {:,.0f} rows/s".format(
+                    name, record["rows_per_s"], old["rows_per_s"]
+                )
+            )
+        added = record["peak_rss_mb"] - record["start_rss_mb"]
+        old_added = old["peak_rss_mb"] - old["start_rss_mb"]
+        if added > max(old_added, 1) * (1 + tolerance) + 10:
+            regressions.append(
+                "{:}: +{:.0f} MB peak memory, baseline +{:.0f} MB".format(
+                    name, added, old_added
+                )
+            )
+    return regressions
+
+
+def print_table(results, baseline=None):
+    reference = {
+        (r["dataset"], r["scale"], r["stage"]): r for r in baseline or []
+    }
+    print(
+        "{:<24} {:>5} {:<18} {:>10} {:>8} {:>12} {:>9} {:>8}".format(
+            "dataset",
+            "scale",
+            "stage",
+            "rows",
+            "wall s",
+            "rows/s",
+            "+MB peak",
+            "vs base",
+        )
+    )
+    for record in results:
+        old = reference.get(
+            (record["dataset"], record["scale"], record["stage"])
+        )
+        change = (
+            "{:+.0%}".format(record["rows_per_s"] / old["rows_per_s"] - 1)
+            if old and old["rows_per_s"]
+            else ""
+        )
+        print(
+            "{:<24} {:>5} {:<18} {:>10,} {:>8.2f} {:>12,.0f} {:>9.0f} "
+            "{:>8}".format(
+                record["dataset"],
+                record["scale"],
+                record["stage"],
+                record["rows"] or 0,
+                record["wall_s"],
+                record["rows_per_s"],
+                record["peak_rss_mb"] - record["start_rss_mb"],
+                change,
+            )
+        )
+
+
+def run(datasets, scales, max_rows, repeat):
+    results = []
+    for dataset in datasets:
+        rows = base_rows(dataset)
+        for scale in scales:
+            if rows * scale > max_rows:
+                print(
+                    "Skipping {:} x{:}, about {:,} rows.".format(
+                        dataset, scale, rows * scale
+                    )
+                )
+                continue
+            best = {}
+            for _ in range(repeat):
+                # a fresh process, so that peak memory is the case's own
+                with ProcessPoolExecutor(
+                    max_workers=1, mp_context=get_context("spawn")
+                ) as pool:
+                    records = pool.submit(run_case, dataset, scale).result()
+                for record in records:
+                    kept = best.get(record["stage"])
+                    if kept is None or record["wall_s"] < kept["wall_s"]:
+                        best[record["stage"]] = record
+            results.extend(best.values())
+            print(
+                "{:} x{:}: {:.1f} s".format(
+                    dataset,
+                    scale,
+                    sum(record["wall_s"] for record in best.values()),
+                )
+            )
+    return results
+
+
+def environment():
+    import numpy as np
+
+    try:
+        from importlib.metadata import version
+
+        neptoon = version("neptoon")
+    except Exception:
+        neptoon = None
+    return dict(
+        date=datetime.now().isoformat(timespec="seconds"),
+        machine=platform.node(),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        pandas=pd.__version__,
+        numpy=np.__version__,
+        neptoon=neptoon,
+        cpus=os.cpu_count(),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--datasets", nargs="+", choices=list(DATASETS), default=DATASETS
+    )
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 10, 100])
+    parser.add_argument(
+        "--max-rows",
+        type=int,
+        default=2_000_000,
+        help="skip cases with more rows, by default 2,000,000",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--output", type=Path, help="write the results as JSON"
+    )
+    parser.add_argument(
+        "--save-baseline",
+        nargs="?",
+        const=BASELINE_FILE,
+        type=Path,
+        help="save the results as baseline, by default " + BASELINE_FILE.name,
+    )
+    parser.add_argument(
+        "--baseline",
+        nargs="?",
+        const=BASELINE_FILE,
+        type=Path,
+        help="compare with a baseline, by default " + BASELINE_FILE.name,
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative slowdown and memory growth, by default 0.25",
+    )
+    parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=0.05,
+        help="faster stages are not compared, by default 0.05",
+    )
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+
+    results = run(list(args.datasets), args.scales, args.max_rows, args.repeat)
+    print()
+    print_table(results, baseline)
+
+    report = dict(environment=environment(), results=results)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as file:
+                json.dump(report, file, indent=1)
+            print("Written to {:}".format(path))
+
+    if baseline is not None:
+        regressions = compare(
+            results, baseline, args.tolerance, args.min_seconds
+        )
+        print()
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("No regressions against the baseline.")
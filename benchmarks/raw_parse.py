@@ -0,0 +1,145 @@
+"""
+Benchmark of serial against parallel raw data parsing.
+
+The Hydroinnova example archive is replicated N times into a temporary
+zip (each copy under its own folder, so the timestamps are duplicated)
+and parsed with the StreamingRawParser serially and with a process
+pool. Both frames must be identical. Beforehand, the formatted frames of
+the example archive, and of the archive unpacked into a folder, must be
+identical to neptoon's.
+
+Usage:
+    python benchmarks/raw_parse.py --copies 20 --workers 4
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from neptoon_gui_ingest import StreamingRawParser  # noqa: E402
+
+EXAMPLE_ZIP = ROOT / "example_data" / "CRNS-station_data-Hydroinnova-A.zip"
+SENSOR_YAML = ROOT / "default_configuration" / "A101_station.yaml"
+PROCESSING_YAML = ROOT / "default_configuration" / "v1_processing_method.yaml"
+
+
+def replicate_zip(source, target, copies):
+    """Writes the members of source copies times into target."""
+    with zipfile.ZipFile(source) as src, zipfile.ZipFile(
+        target, "w", compression=zipfile.ZIP_DEFLATED
+    ) as dst:
+        members = [(i, src.read(i)) for i in src.infolist() if not i.is_dir()]
+        for copy in range(copies):
+            for info, data in members:
+                dst.writestr(
+                    "copy{:03d}/{:}".format(copy, info.filename), data
+                )
+
+
+def make_parser(location):
+    from neptoon.io.read import ConfigurationManager
+
+    config = ConfigurationManager()
+    config.load_configuration(file_path=SENSOR_YAML)
+    sensor_config = config.get_config("sensor")
+    options = sensor_config.raw_data_parse_options.model_copy(
+        update=dict(data_location=Path(location))
+    )
+    tmp = sensor_config.time_series_data.key_column_info
+    return StreamingRawParser(
+        options,
+        date_time_columns=tmp.date_time_columns,
+        date_time_format=tmp.date_time_format,
+    )
+
+
+def check_against_neptoon(folder):
+    """
+    Compare the formatted frames of the example archive and of its
+    unpacked folder with that of neptoon's ProcessWithYaml.
+    """
+    from neptoon.io.read import ConfigurationManager
+    from neptoon.workflow import ProcessWithYaml
+    from neptoon_gui_ingest import import_raw_data
+
+    def process_of(location):
+        config = ConfigurationManager()
+        config.load_configuration(file_path=SENSOR_YAML)
+        config.load_configuration(file_path=PROCESSING_YAML)
+        process = ProcessWithYaml(configuration_object=config)
+        process.sensor_config.raw_data_parse_options.data_location = location
+        # the installed saqc rejects the fractional maxna of the hourly
+        # aggregation in neptoon itself, the parsing is compared at the
+        # input resolution
+        temporal = process.sensor_config.time_series_data.temporal
+        temporal.output_resolution = temporal.input_resolution
+        return process
+
+    unpacked = folder / "unpacked"
+    with zipfile.ZipFile(EXAMPLE_ZIP) as archive:
+        archive.extractall(unpacked)
+    # neptoon itself calls tarfile.is_tarfile() on folders, which fails
+    # on Python 3.11, so both are compared with its frame of the zip
+    expected = process_of(EXAMPLE_ZIP)._import_data()
+    for label, location in (("zip", EXAMPLE_ZIP), ("folder", unpacked)):
+        pd.testing.assert_frame_equal(
+            import_raw_data(process_of(location)), expected
+        )
+        print("{:}: identical to neptoon.".format(label))
+
+
+def run(copies, workers, repeat):
+    folder = Path(tempfile.mkdtemp())
+    try:
+        check_against_neptoon(folder)
+        location = folder / "replicated.zip"
+        replicate_zip(EXAMPLE_ZIP, location, copies)
+        parser = make_parser(location)
+        print(
+            "{:} copies, {:,.0f} files, {:.1f} MB zipped".format(
+                copies,
+                parser.count_files(),
+                location.stat().st_size / 1e6,
+            )
+        )
+
+        results = {}
+        for label, n in (("serial", 0), ("parallel", workers)):
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                data = parser.parse(workers=n)
+                times.append(time.perf_counter() - start)
+            results[label] = data
+            print(
+                "{:>8}: {:6.2f} s (best of {:}), {:,.0f} rows/s{:}".format(
+                    label,
+                    min(times),
+                    repeat,
+                    len(data) / min(times),
+                    ", {:} workers".format(n) if n else "",
+                )
+            )
+
+        pd.testing.assert_frame_equal(results["serial"], results["parallel"])
+        print("Parallel and serial frames are identical.")
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--copies", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.copies, args.workers, args.repeat)
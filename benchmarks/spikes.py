@@ -0,0 +1,202 @@
+"""
+Benchmark and agreement of the spike detectors on the example stations.
+
+The raw neutrons of every pipeline station of pipeline.DATASETS, as the
+quality checks see them, are checked for spikes with saqc's UniLOF
+(spike_uni_lof) and with the Hampel filter (spike_hampel), also in
+chunks with HampelStream. Longer records are made by repeating the
+series backwards in time. The report lists the time of each detector,
+the spikes found and how many of the UniLOF spikes the Hampel filter
+finds too.
+
+Usage:
+    python benchmarks/spikes.py --scales 1 10 100
+    python benchmarks/spikes.py --window 25 --threshold 5 --output spikes.json
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from pipeline import (  # noqa: E402
+    DATASETS,
+    NMDB_FIXTURE,
+    environment,
+    load_process,
+    repeat_backwards,
+)
+from neptoon_gui_spikes import (  # noqa: E402
+    DEFAULT_THRESHOLD,
+    DEFAULT_WINDOW,
+    HampelStream,
+)
+
+COLUMN = "epithermal_neutrons_cph"
+
+
+def raw_neutrons(sensor_yaml):
+    """Raw neutron count rates of a station before the spike check."""
+    from neptoon_gui_ingest import create_data_hub
+    from neptoon_gui_nmdb import FixtureFetcher, NMDBStore, attach_nmdb_data
+
+    process = load_process(sensor_yaml)
+    create_data_hub(process, use_sidecar=False)
+    with tempfile.TemporaryDirectory() as folder:
+        store = NMDBStore(
+            cache_dir=folder, fetcher=FixtureFetcher(NMDB_FIXTURE)
+        )
+        attach_nmdb_data(process, store)
+    process._prepare_static_values()
+    return process.data_hub.crns_data_frame[COLUMN]
+
+
+def repeat_series(series, copies):
+    times, _ = repeat_backwards(series.index.to_series(), copies)
+    values = np.tile(series.to_numpy(), copies)
+    return pd.Series(values, index=pd.DatetimeIndex(times))
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def stream_flags(values, window, threshold, chunk):
+    stream = HampelStream(window=window, threshold=threshold)
+    flags = [
+        stream.push(values[start : start + chunk])
+        for start in range(0, len(values), chunk)
+    ]
+    flags.append(stream.flush())
+    return np.concatenate(flags)
+
+
+def compare(name, series, scale, uni_lof, window, threshold, chunk):
+    from neptoon_gui_quality import _spike_hampel, _spike_uni_lof
+
+    values, index = series.to_numpy(), series.index
+    lof, lof_s = timed(_spike_uni_lof, values, index, uni_lof)
+    hampel, hampel_s = timed(
+        _spike_hampel, values, index, dict(window=window, threshold=threshold)
+    )
+    stream, stream_s = timed(stream_flags, values, window, threshold, chunk)
+    both = int((lof & hampel).sum())
+    either = int((lof | hampel).sum())
+    return dict(
+        dataset=name,
+        scale=scale,
+        rows=len(values),
+        uni_lof_s=lof_s,
+        hampel_s=hampel_s,
+        stream_s=stream_s,
+        speedup=lof_s / hampel_s if hampel_s else None,
+        uni_lof_spikes=int(lof.sum()),
+        hampel_spikes=int(hampel.sum()),
+        both=both,
+        recall=both / lof.sum() if lof.any() else None,
+        precision=both / hampel.sum() if hampel.any() else None,
+        jaccard=both / either if either else None,
+        stream_equal=bool((stream == hampel).all()),
+    )
+
+
+def run(datasets, scales, max_rows, uni_lof, window, threshold, chunk):
+    results = []
+    for name in datasets:
+        series = raw_neutrons(DATASETS[name][2])
+        for scale in scales:
+            if len(series) * scale > max_rows:
+                print("Skipping {:} x{:}.".format(name, scale))
+                continue
+            result = compare(
+                name,
+                repeat_series(series, scale),
+                scale,
+                uni_lof,
+                window,
+                threshold,
+                chunk,
+            )
+            results.append(result)
+            print(
+                "{dataset} x{scale}: {rows:,} rows, UniLOF {uni_lof_s:.2f} s,"
+                " Hampel {hampel_s:.2f} s".format(**result)
+            )
+    return results
+
+
+def print_table(results):
+    table = pd.DataFrame(results)
+    with pd.option_context(
+        "display.width", 200, "display.float_format", "{:.3g}".format
+    ):
+        print(table.to_string(index=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    pipeline = [name for name, entry in DATASETS.items() if entry[2]]
+    parser.add_argument(
+        "--datasets", nargs="+", choices=pipeline, default=pipeline
+    )
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 10, 100])
+    parser.add_argument(
+        "--max-rows",
+        type=int,
+        default=2_000_000,
+        help="skip cases with more rows, by default 2,000,000",
+    )
+    parser.add_argument(
+        "--periods",
+        type=int,
+        default=12,
+        help="periods_in_calculation of UniLOF, by default 12",
+    )
+    parser.add_argument(
+        "--lof-threshold",
+        type=float,
+        default=1.5,
+        help="threshold of UniLOF, by default 1.5",
+    )
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument(
+        "--chunk",
+        type=int,
+        default=24,
+        help="rows per chunk of the streaming filter, by default 24",
+    )
+    parser.add_argument(
+        "--output", type=Path, help="write the results as JSON"
+    )
+    args = parser.parse_args()
+
+    results = run(
+        args.datasets,
+        args.scales,
+        args.max_rows,
+        dict(
+            periods_in_calculation=args.periods, threshold=args.lof_threshold
+        ),
+        args.window,
+        args.threshold,
+        args.chunk,
+    )
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(
+                dict(environment=environment(), results=results),
+                file,
+                indent=1,
+            )
@@ -1,7 +1,8 @@
 import streamlit as st
 from pathlib import Path
 from neptoon_gui_utils import *
-import plotly.graph_objects as go
+from neptoon_gui_jobs import job_running, submit_stage_job
+from neptoon_gui_session import run_cached_stage
 
 st.title(":material/adjust: Calibration")
 
@@ -11,72 +12,193 @@ else:
 
     st.write(
         "In order to find the $N_0$ parameter, a CRNS probe needs to be calibrated on ground truth data, e.g., soil samples or TDR time serieses.",
-        "You can upload your calibration dataset here. In a future version, you may input your otherwise determined average soil moisture.",
+        "You can upload your calibration dataset of soil samples, or enter an otherwise determined field average soil moisture.",
     )
 
-    st.session_state["calibration_file"] = Path(
-        st.session_state["yaml"].sensor_config.calibration.location or ""
+    calibration_mode = st.segmented_control(
+        "Calibrate on",
+        ["Soil samples", "Single value"],
+        selection_mode="single",
+        default="Soil samples",
+        key="calibration_mode",
     )
 
-    uploaded_file = st.file_uploader(
-        "Upload files",
-        type={"csv"},
-        key="calibration_upload",
-    )
-    if uploaded_file:
-        # File upload
-        st.session_state["calibration_upload_name"] = uploaded_file.name
+    if calibration_mode == "Single value":
 
-        temp_file_path = save_uploaded_file(uploaded_file)
-        atexit.register(cleanup, temp_file_path)
+        @st.fragment
+        def make_single_value_calibration():
+            import datetime
+            import pandas as pd
+            from neptoon_gui_calibration import (
+                NeutronLookup,
+                SingleValueCalibrator,
+                calibrate_single_value,
+            )
 
-        st.session_state["calibration_upload_file"] = temp_file_path
-        st.session_state["calibration_file"] = temp_file_path
+            process = st.session_state["yaml"]
+            data_frame = process.data_hub.crns_data_frame
 
-    if st.session_state["calibration_file"]:
+            c1, c2 = st.columns(2)
+            hours = c2.number_input(
+                "Hours of data around the measurement",
+                min_value=1,
+                max_value=48,
+                value=6,
+                key="calibration_single_hours",
+            )
+            # built once per frame, every input then only looks it up
+            lookup = st.session_state.get("calibration_lookup")
+            if lookup is None or not lookup.matches(data_frame, hours):
+                lookup = NeutronLookup(data_frame, hours)
+                st.session_state["calibration_lookup"] = lookup
+            first, last = pd.to_datetime(lookup.times[[0, -1]], utc=True)
+
+            date = c1.date_input(
+                "When did you determine soil moisture?",
+                value=(first + (last - first) / 2).date(),
+                min_value=first.date(),
+                max_value=last.date(),
+                key="calibration_single_date",
+            )
+            time_of_day = c1.time_input(
+                "At what time (UTC)?",
+                value=datetime.time(12),
+                key="calibration_single_time",
+            )
+            soil_moisture = c2.number_input(
+                "Independently measured soil moisture (m³/m³)",
+                min_value=0.0,
+                max_value=1.0,
+                value=0.2,
+                step=0.01,
+                format="%.3f",
+                key="calibration_single_soil_moisture",
+            )
+            time = pd.Timestamp(
+                datetime.datetime.combine(date, time_of_day), tz="UTC"
+            )
 
-        if not st.session_state["calibration_file"].is_file():
-            st.error(
-                "File **{:}** does not exist.".format(
-                    st.session_state["calibration_file"]
+            try:
+                calibrator = SingleValueCalibrator(
+                    lookup,
+                    time,
+                    soil_moisture,
+                    process.sensor_config.sensor_info,
+                )
+            except ValueError as error:
+                st.warning(error)
+                return
+            st.write(
+                "Mean corrected neutrons: {:.0f} cph from {:} values, estimated $N_0 = {:.0f}$ cph.".format(
+                    calibrator.neutrons, calibrator.values, calibrator.n0
                 )
             )
-            st.warning("No file selected yet. Please upload your data.")
-            st.session_state["calibration_read_ready"] = False
-        else:
-            # Already uploaded
-            st.success(
-                ":material/check: Using **{:}** as calibration data.".format(
+            if st.button(
+                "Use this $N_0$",
+                type="primary",
+                disabled=job_running("Calibration"),
+            ):
+                run_cached_stage(
+                    "calibration",
+                    lambda: calibrate_single_value(
+                        process, time, soil_moisture, lookup
+                    ),
+                    single_value=(str(time), soil_moisture, hours),
+                )
+                st.session_state["calibration_finished"] = True
+                st.rerun()
+
+        make_single_value_calibration()
+
+    else:
+        st.session_state["calibration_file"] = Path(
+            st.session_state["yaml"].sensor_config.calibration.location or ""
+        )
+
+        uploaded_file = st.file_uploader(
+            "Upload files",
+            type={"csv"},
+            key="calibration_upload",
+        )
+        if uploaded_file:
+            # File upload
+            st.session_state["calibration_upload_name"] = uploaded_file.name
+
+            temp_file_path = save_uploaded_file(uploaded_file)
+            atexit.register(cleanup, temp_file_path)
+
+            st.session_state["calibration_upload_file"] = temp_file_path
+            st.session_state["calibration_file"] = temp_file_path
+
+        if st.session_state["calibration_file"]:
+
+            if not st.session_state["calibration_file"].is_file():
+                st.error(
+                    "File **{:}** does not exist.".format(
+                        st.session_state["calibration_file"]
+                    )
+                )
+                st.warning("No file selected yet. Please upload your data.")
+                st.session_state["calibration_read_ready"] = False
+            else:
+                # Already uploaded
+                st.success(
+                    ":material/check: Using **{:}** as calibration data.".format(
+                        st.session_state["calibration_file"]
+                    )
+                )
+                st.session_state["yaml"].sensor_config.calibration.location = (
                     st.session_state["calibration_file"]
                 )
-            )
-            st.session_state["yaml"].sensor_config.calibration.location = (
-                st.session_state["calibration_file"]
-            )
-            st.session_state["calibration_read_ready"] = True
+                st.session_state["calibration_read_ready"] = True
 
-            import pandas as pd
+                import pandas as pd
 
-            st.session_state["yaml"].data_hub.calibration_samples_data = (
-                pd.read_csv(st.session_state["calibration_file"])
-            )
-            st.dataframe(
-                st.session_state["yaml"].data_hub.calibration_samples_data
-            )
+                st.session_state["yaml"].data_hub.calibration_samples_data = (
+                    pd.read_csv(st.session_state["calibration_file"])
+                )
+                st.dataframe(
+                    st.session_state["yaml"].data_hub.calibration_samples_data
+                )
 
-if st.session_state["calibration_read_ready"]:
+if st.session_state["calibration_read_ready"] and (
+    st.session_state.get("calibration_mode") != "Single value"
+):
 
     ##############################################
     st.subheader(":material/adjust: Calibration")
     ##############################################
 
-    @st.cache_data(show_spinner="Calibrating")
+    replicates = st.number_input(
+        "Bootstrap replicates",
+        min_value=0,
+        max_value=100000,
+        value=1000,
+        step=500,
+        help="Resamples the soil profiles of every calibration day with replacement to give a 95 % confidence interval of $N_0$. Set to 0 to skip.",
+        key="calibration_bootstrap",
+    )
+
     def make_calibration():
-        st.session_state["yaml"]._calibrate_data()
-        st.session_state["calibration_finished"] = True
+        from neptoon_gui_calibration import calibrate
+
+        submit_stage_job(
+            "Calibration",
+            "calibration",
+            lambda process: calibrate(
+                process, bootstrap=int(replicates), seed=0
+            ),
+            flags=["calibration_finished"],
+            bootstrap=int(replicates),
+        )
+        st.rerun()
 
-    if st.button("Calibrate!", type="primary"):
+    if st.button(
+        "Calibrate!", type="primary", disabled=job_running("Calibration")
+    ):
         make_calibration()
+    if job_running("Calibration"):
+        st.info("Calibrating in the background, see the sidebar.")
 
 if st.session_state["calibration_finished"]:
     df_calibrated = st.session_state[
@@ -86,7 +208,7 @@ if st.session_state["calibration_finished"]:
     str_no = "Estimated: $N_0 = {:.0f}$ ".format(
         st.session_state["yaml"].sensor_config.sensor_info.N0,
     )
-    if len(df_calibrated["optimal_N0"].dropna() > 1):
+    if len(df_calibrated["optimal_N0"].dropna()) > 1:
         str_std = "$\pm {:.0f}$".format(
             df_calibrated["optimal_N0"].std(),
         )
@@ -94,4 +216,16 @@ if st.session_state["calibration_finished"]:
         str_std = ""
     str_unit = " cph."
     st.write(str_no + str_std + str_unit)
+    bootstrap = getattr(
+        st.session_state["yaml"].data_hub.calibrator, "bootstrap_results", None
+    )
+    if bootstrap:
+        st.write(
+            "{:g} % confidence interval of $N_0$: {:.0f} to {:.0f} cph, from {:,} bootstrap replicates.".format(
+                bootstrap["interval"][1] - bootstrap["interval"][0],
+                bootstrap["low"],
+                bootstrap["high"],
+                len(bootstrap["n0"]),
+            )
+        )
     # st.write(st.session_state["yaml"].data_hub.crns_data_frame.columns)
@@ -202,18 +202,28 @@ else:
 ##################
 st.subheader("3. Apply configuration")
 
-from neptoon.io.read import ConfigurationManager
-from neptoon.workflow import ProcessWithYaml
+from neptoon_gui_ingest import load_raw_parse_extras
+from neptoon_gui_imports import activate_magazine, timed_import
 
 
 # @st.cache_data(show_spinner="Checking YAML files...")
 def parse_yaml_files():
+    # neptoon is imported here, if the preloading has not done it yet
+    ConfigurationManager = timed_import("neptoon.io.read").ConfigurationManager
+    ProcessWithYaml = timed_import("neptoon.workflow").ProcessWithYaml
+    # lets turn on the reporting system for our data
+    activate_magazine()
+
     config = ConfigurationManager()
     config.load_configuration(file_path=st.session_state["config_sensor_file"])
     config.load_configuration(
         file_path=st.session_state["config_processing_file"]
     )
     st.session_state["yaml"] = ProcessWithYaml(configuration_object=config)
+    load_raw_parse_extras(
+        st.session_state["yaml"].sensor_config,
+        st.session_state["config_sensor_file"],
+    )
 
 
 if (
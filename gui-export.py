@@ -1,7 +1,7 @@
 import streamlit as st
 from pathlib import Path
 from neptoon_gui_utils import *
-import plotly.graph_objects as go
+from neptoon_gui_session import STAGES_RUN, get_profiler
 
 st.title(":material/save: Export")
 
@@ -13,11 +13,15 @@ if st.session_state["data_converted"]:
 
     @st.cache_data(show_spinner="Making figures...")
     def make_figures():
-        st.session_state["yaml"].data_hub.create_figures(create_all=True)
+        with get_profiler().stage(STAGES_RUN, "create_figures"):
+            st.session_state["yaml"].data_hub.create_figures(create_all=True)
 
     @st.cache_data(show_spinner="Save data...")
     def save_data():
-        st.session_state["yaml"].data_hub.save_data()
+        # stages run again in the session replace their earlier timings
+        get_profiler().to_magazine(STAGES_RUN, latest=True)
+        with get_profiler().stage(STAGES_RUN, "save_data"):
+            st.session_state["yaml"].data_hub.save_data()
 
     c11, c12, c13, c14 = st.columns(4)
     if c11.button("Make figures", type="primary"):
@@ -1,7 +1,12 @@
 import streamlit as st
 from pathlib import Path
 from neptoon_gui_utils import *
-import plotly.graph_objects as go
+from neptoon_gui_plot import plot_time_series
+from neptoon_gui_session import get_nmdb_store, run_cached_stage
+from neptoon_gui_table import show_quality_report, show_table
+from neptoon_gui_imports import lazy_import
+
+go = lazy_import("plotly.graph_objects")
 
 st.title(":material/blur_on: Neutron corrections")
 
@@ -99,9 +104,16 @@ else:
 
     select_nm()
 
-    # @st.cache_data(show_spinner="Downloading from NMDB...")
     def attach_nmdb(station="JUNG"):
-        st.session_state["yaml"]._attach_nmdb_data()
+        from neptoon_gui_nmdb import attach_nmdb_data
+
+        with st.spinner("Collecting data from NMDB..."):
+            run_cached_stage(
+                "nmdb",
+                lambda: attach_nmdb_data(
+                    st.session_state["yaml"], store=get_nmdb_store()
+                ),
+            )
 
     c1, c2 = st.columns([1, 2])
 
@@ -117,16 +129,14 @@ else:
         in st.session_state["yaml"].data_hub.crns_data_frame.columns
     ):
         st.session_state["data_nmdb_attached"] = True
-        import plotly.express as px
 
         (tab1,) = st.tabs([":material/show_chart: Plots"])
 
-        tab1.plotly_chart(
-            px.line(
-                st.session_state["yaml"].data_hub.crns_data_frame,
-                y="incoming_neutron_intensity",
-            ),
-            use_container_width=True,
+        plot_time_series(
+            tab1,
+            st.session_state["yaml"].data_hub.crns_data_frame,
+            ["incoming_neutron_intensity"],
+            key="plot_nmdb",
             color_discrete_sequence=["red"],
         )
 
@@ -144,87 +154,237 @@ if st.session_state["data_nmdb_attached"]:
     st.subheader("2. :material/flag: Quality checks")
     #################################################
 
-    c1, c2 = st.columns(2)
+    raw_neutrons = st.session_state[
+        "yaml"
+    ].process_config.neutron_quality_assessment.raw_neutrons
 
-    # Spike detection period
-    c1.number_input(
-        label="Spike detection period",
-        value=st.session_state[
-            "yaml"
-        ].process_config.neutron_quality_assessment.raw_neutrons.spike_uni_lof.periods_in_calculation,
-        key="input_quality_lof_periods",
-        min_value=0,
-        max_value=100,
-        step=1,
+    from neptoon.config.configuration_input import SpikeUniLOF
+    from neptoon_gui_spikes import DEFAULT_THRESHOLD, DEFAULT_WINDOW
+
+    spike_methods = dict(
+        spike_uni_lof="Local outlier factor",
+        spike_hampel="Rolling median (fast)",
+    )
+    c1, c2 = st.columns([1, 1])
+    c1.segmented_control(
+        "Spike detection",
+        list(spike_methods),
+        format_func=spike_methods.get,
+        default=(
+            "spike_hampel"
+            if getattr(raw_neutrons, "spike_hampel", None)
+            else "spike_uni_lof"
+        ),
+        key="input_quality_spike_method",
+    )
+    with c2.popover(":material/help: Learn more"):
+        st.markdown(
+            ":material/info: The local outlier factor (saqc's UniLOF) compares every value with the density of its neighbours in time. The rolling median (Hampel filter) flags values that deviate from the median of the window around them by more than the threshold times the median absolute deviation. It is several times faster on long records and flags all spikes found by the local outlier factor on the example stations, plus a few more."
+        )
+    spike_method = (
+        st.session_state["input_quality_spike_method"] or "spike_uni_lof"
     )
 
-    # Spike detection threshold
-    c2.number_input(
-        label="Spike detection threshold",
-        value=st.session_state[
-            "yaml"
-        ].process_config.neutron_quality_assessment.raw_neutrons.spike_uni_lof.threshold,
-        key="input_quality_lof_threshold",
-        min_value=0.0,
-        max_value=2.0,
-        step=0.01,
+    c1, c2 = st.columns(2)
+    if spike_method == "spike_uni_lof":
+        spike_uni_lof = raw_neutrons.spike_uni_lof or SpikeUniLOF()
+
+        # Spike detection period
+        c1.number_input(
+            label="Spike detection period",
+            value=spike_uni_lof.periods_in_calculation,
+            key="input_quality_lof_periods",
+            min_value=0,
+            max_value=100,
+            step=1,
+        )
+
+        # Spike detection threshold
+        c2.number_input(
+            label="Spike detection threshold",
+            value=spike_uni_lof.threshold,
+            key="input_quality_lof_threshold",
+            min_value=0.0,
+            max_value=2.0,
+            step=0.01,
+        )
+    else:
+        spike_hampel = dict(getattr(raw_neutrons, "spike_hampel", None) or {})
+
+        # Spike detection window
+        c1.number_input(
+            label="Spike detection window",
+            value=int(spike_hampel.get("window") or DEFAULT_WINDOW),
+            key="input_quality_hampel_window",
+            min_value=3,
+            max_value=201,
+            step=2,
+        )
+
+        # Spike detection threshold
+        c2.number_input(
+            label="Spike detection threshold (MADs)",
+            value=float(spike_hampel.get("threshold") or DEFAULT_THRESHOLD),
+            key="input_quality_hampel_threshold",
+            min_value=1.0,
+            max_value=20.0,
+            step=0.5,
+        )
+
+    # period and threshold inputs of the spike detection methods
+    spike_inputs = dict(
+        spike_uni_lof=dict(
+            period="input_quality_lof_periods",
+            threshold="input_quality_lof_threshold",
+            period_label="Period",
+            range=(0.0, 2.0, 0.01),
+        ),
+        spike_hampel=dict(
+            period="input_quality_hampel_window",
+            threshold="input_quality_hampel_threshold",
+            period_label="Window",
+            range=(1.0, 20.0, 0.5),
+        ),
     )
 
-    @st.cache_data(show_spinner="Checking quality...")
-    def make_quality_check():
+    @st.fragment
+    def sweep_spike_detection():
+        from neptoon_gui_sweep import SWEEP_GRIDS, SpikeSweep, sweep_input
+
+        inputs = spike_inputs[spike_method]
+        series = sweep_input(st.session_state["yaml"])
+        sweep = st.session_state.get("spike_sweep")
+        if sweep is None or not sweep.matches(series, spike_method):
+            sweep = st.session_state["spike_sweep"] = SpikeSweep(
+                series, spike_method
+            )
+        grid = SWEEP_GRIDS[spike_method]
+        periods = sorted(
+            {*grid["periods"], int(st.session_state[inputs["period"]])}
+        )
+
+        st.write(
+            "The spike scores are computed once per period, so that different thresholds are compared instantly."
+        )
+        c1, c2 = st.columns(2)
+        period = c1.select_slider(
+            inputs["period_label"],
+            options=periods,
+            value=int(st.session_state[inputs["period"]]),
+            key="sweep_period_" + spike_method,
+        )
+        low, high, step = inputs["range"]
+        threshold = c2.slider(
+            "Threshold",
+            min_value=low,
+            max_value=high,
+            step=step,
+            value=float(st.session_state[inputs["threshold"]]),
+            key="sweep_threshold_" + spike_method,
+        )
+        with st.spinner("Computing spike scores..."):
+            flags = sweep.flags(period, threshold)
+        st.write(
+            "**{:,}** of {:,} values are spikes.".format(
+                flags.sum(), flags.size
+            )
+        )
+        st.dataframe(series[flags], height=200)
+
+        def use_settings():
+            st.session_state[inputs["period"]] = int(period)
+            st.session_state[inputs["threshold"]] = float(threshold)
+
+        c1, c2 = st.columns(2)
+        if c1.button(
+            ":material/check: Use these settings", on_click=use_settings
+        ):
+            st.rerun()
+        if c2.button(":material/grid_on: Compare a grid of settings"):
+            with st.spinner("Computing spike scores..."):
+                sweep.counts(periods, grid["thresholds"])
+        if sweep.grid is not None:
+            import plotly.express as px
+
+            counts = sweep.grid.copy()
+            counts.index = counts.index.astype(str)
+            counts.columns = counts.columns.astype(str)
+            st.plotly_chart(
+                px.imshow(
+                    counts,
+                    text_auto=True,
+                    aspect="auto",
+                    color_continuous_scale="Blues",
+                    labels=dict(
+                        x="Threshold",
+                        y=inputs["period_label"],
+                        color="Spikes",
+                    ),
+                ),
+                use_container_width=True,
+            )
+
+    with st.expander(":material/tune: Tune the spike detection"):
+        sweep_spike_detection()
 
-        st.session_state["yaml"]._prepare_static_values()
+    def check_quality():
 
-        from neptoon.quality_control import (
-            QualityAssessmentFlagBuilder,
-            QualityCheck,
-            QATarget,
-            QAMethod,
+        process = st.session_state["yaml"]
+        process._prepare_static_values()
+
+        from neptoon.quality_control import QATarget
+        from neptoon_gui_quality import (
+            assess_quality,
+            clear_quality_reports,
+            compile_checks,
+            record_quality_report,
         )
 
-        qa_flags = QualityAssessmentFlagBuilder()
-        qa_flags.add_check(
-            QualityCheck(
-                target=QATarget.RELATIVE_HUMIDITY,
-                method=QAMethod.RANGE_CHECK,
-                parameters={"min": 0, "max": 100},
-            ),
-            QualityCheck(
-                target=QATarget.RAW_EPI_NEUTRONS,
-                method=QAMethod.SPIKE_UNILOF,
-                parameters={
-                    "periods_in_calculation": st.session_state[
-                        "input_quality_lof_periods"
-                    ],
-                    "threshold": st.session_state[
-                        "input_quality_lof_threshold"
-                    ],
-                },
-            ),
+        checks = compile_checks(
+            process.process_config.neutron_quality_assessment,
+            name_of_target="raw_neutrons",
+        )
+        for column, column_checks in compile_checks(
+            process.sensor_config.input_data_qa
+        ).items():
+            checks.setdefault(column, []).extend(column_checks)
+        checks.setdefault(
+            QATarget.RELATIVE_HUMIDITY.value,
+            [("flag_range", {"min": 0, "max": 100})],
         )
 
-        st.session_state["yaml"].data_hub.add_quality_flags(
-            custom_flags=qa_flags
+        clear_quality_reports(process, "quality")
+        record_quality_report(
+            process, "quality", assess_quality(process.data_hub, checks)
         )
-        st.session_state["yaml"].data_hub.apply_quality_flags()
 
-        st.session_state[
-            "yaml"
-        ].process_config.neutron_quality_assessment.raw_neutrons.spike_uni_lof.periods_in_calculation = st.session_state[
-            "input_quality_lof_periods"
-        ]
-        st.session_state[
-            "yaml"
-        ].process_config.neutron_quality_assessment.raw_neutrons.spike_uni_lof.threshold = st.session_state[
-            "input_quality_lof_threshold"
-        ]
+    def make_quality_check():
+        # the checks are compiled from the processing config
+        if spike_method == "spike_uni_lof":
+            spike_uni_lof = raw_neutrons.spike_uni_lof or SpikeUniLOF()
+            spike_uni_lof.periods_in_calculation = st.session_state[
+                "input_quality_lof_periods"
+            ]
+            spike_uni_lof.threshold = st.session_state[
+                "input_quality_lof_threshold"
+            ]
+            raw_neutrons.spike_uni_lof = spike_uni_lof
+            raw_neutrons.spike_hampel = None
+        else:
+            raw_neutrons.spike_uni_lof = None
+            raw_neutrons.spike_hampel = dict(
+                window=st.session_state["input_quality_hampel_window"],
+                threshold=st.session_state["input_quality_hampel_threshold"],
+            )
+        with st.spinner("Checking quality..."):
+            run_cached_stage("quality", check_quality)
+
         st.session_state["data_quality_checked"] = True
 
     if st.button(":material/flag: Quality check", type="primary"):
         make_quality_check()
 
 if st.session_state["data_quality_checked"]:
-    import plotly.express as px
 
     tab1, tab2, tab3 = st.tabs(
         [
@@ -234,18 +394,31 @@ if st.session_state["data_quality_checked"]:
         ]
     )
 
-    tab1.dataframe(st.session_state["yaml"].data_hub.crns_data_frame)
-    tab2.dataframe(st.session_state["yaml"].data_hub.flags_data_frame)
+    show_table(
+        tab1,
+        st.session_state["yaml"].data_hub.crns_data_frame,
+        key="table_quality",
+    )
+    show_table(
+        tab2,
+        st.session_state["yaml"].data_hub.flags_data_frame,
+        key="table_flags",
+    )
+
+    from neptoon_gui_quality import quality_report
+
+    show_quality_report(
+        tab2, quality_report(st.session_state["yaml"], "quality")
+    )
     columns_to_plot = [
         "epithermal_neutrons_raw",
         "epithermal_neutrons_cph",
     ]
-    tab3.plotly_chart(
-        px.line(
-            st.session_state["yaml"].data_hub.crns_data_frame[columns_to_plot],
-            y=columns_to_plot,
-        ),
-        use_container_width=True,
+    plot_time_series(
+        tab3,
+        st.session_state["yaml"].data_hub.crns_data_frame,
+        columns_to_plot,
+        key="plot_quality",
     )
 
     ###############################################################
@@ -308,28 +481,30 @@ if st.session_state["data_quality_checked"]:
 
     create_correction_input()
 
-    @st.cache_data(show_spinner="Making corrections...")
-    def make_corrections():
-
-        from neptoon.corrections import (
-            CorrectionType,
-            CorrectionTheory,
-        )
+    st.toggle(
+        "Keep individual correction factors",
+        value=True,
+        key="input_corrections_keep_factors",
+        help="Without them, only the corrected neutrons are added to the data, which saves memory on long records.",
+    )
 
-        st.session_state["yaml"].data_hub.select_correction(
-            correction_type=CorrectionType.INCOMING_INTENSITY,
-            correction_theory=CorrectionTheory.HAWDON_2014,
-        )
-        st.session_state["yaml"].data_hub.select_correction(
-            correction_type=CorrectionType.HUMIDITY,
-            correction_theory=CorrectionTheory.ROSOLEM_2013,
-        )
+    def correct_neutrons():
+        from neptoon_gui_corrections import fused_correct_neutrons
 
-        st.session_state["yaml"].data_hub.select_correction(
-            correction_type=CorrectionType.PRESSURE,
+        fused_correct_neutrons(
+            st.session_state["yaml"].data_hub.crns_data_frame,
+            keep_factors=st.session_state["input_corrections_keep_factors"],
         )
 
-        st.session_state["yaml"].data_hub.correct_neutrons()
+    def make_corrections():
+        with st.spinner("Making corrections..."):
+            run_cached_stage(
+                "corrections",
+                correct_neutrons,
+                keep_factors=st.session_state[
+                    "input_corrections_keep_factors"
+                ],
+            )
         st.session_state["data_corrections_made"] = True
 
     if st.button(
@@ -347,22 +522,31 @@ if st.session_state["data_corrections_made"]:
         ]
     )
 
-    tab3.dataframe(st.session_state["yaml"].data_hub.crns_data_frame)
+    show_table(
+        tab3,
+        st.session_state["yaml"].data_hub.crns_data_frame,
+        key="table_corrections",
+    )
 
     selected_columns_corr = [
-        "atmospheric_pressure_correction",
-        "humidity_correction",
-        "incoming_neutron_intensity_correction",
-    ]
-
-    data_corr_factors = st.session_state["yaml"].data_hub.crns_data_frame[
-        selected_columns_corr
+        column
+        for column in [
+            "atmospheric_pressure_correction",
+            "humidity_correction",
+            "incoming_neutron_intensity_correction",
+        ]
+        if column in st.session_state["yaml"].data_hub.crns_data_frame
     ]
 
-    tab4.plotly_chart(
-        px.line(data_corr_factors, y=selected_columns_corr),
-        use_container_width=True,
-    )
+    if selected_columns_corr:
+        plot_time_series(
+            tab4,
+            st.session_state["yaml"].data_hub.crns_data_frame,
+            selected_columns_corr,
+            key="plot_factors",
+        )
+    else:
+        tab4.info("The individual correction factors were not kept.")
 
     # st.session_state["yaml"].data_hub.crns_data_frame.loc[
     #     st.session_state["yaml"].data_hub.crns_data_frame["corrected_epithermal_neutrons"] < 300,
@@ -377,16 +561,11 @@ if st.session_state["data_corrections_made"]:
         "corrected_epithermal_neutrons",
     ]
 
-    data_corr_neutrons = st.session_state["yaml"].data_hub.crns_data_frame[
-        selected_columns_corrn
-    ]
-
-    tab5.plotly_chart(
-        px.line(
-            data_corr_neutrons,  # .rolling(24 * 4).mean(),
-            y=selected_columns_corrn,
-        ),
-        use_container_width=True,
+    plot_time_series(
+        tab5,
+        st.session_state["yaml"].data_hub.crns_data_frame,
+        selected_columns_corrn,
+        key="plot_corrected",
     )
 
     st.subheader(":material/airwave: Smoothing")
@@ -425,15 +604,12 @@ if st.session_state["data_corrections_made"]:
         ):
             show_columns.append(column_smoothed)
 
-        st.plotly_chart(
-            px.line(
-                st.session_state["yaml"].data_hub.crns_data_frame[
-                    show_columns
-                ],
-                y=show_columns,
-                # range_y=neutron_range,
-            ),
-            use_container_width=True,
+        plot_time_series(
+            st,
+            st.session_state["yaml"].data_hub.crns_data_frame,
+            show_columns,
+            key="plot_smoothed",
+            # range_y=neutron_range,
         )
         # st.write(st.session_state["yaml"].data_hub.crns_data_frame.columns)
 
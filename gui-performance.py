@@ -0,0 +1,90 @@
+import streamlit as st
+from neptoon_gui_utils import *
+from neptoon_gui_session import get_profiler
+import pandas as pd
+
+st.title(":material/speed: Performance")
+
+st.write(
+    "Wall time, CPU time, peak memory of the app and rows of the data of every processing stage of this session.",
+    "The timings of *Run all* are also added to its PDF report.",
+)
+
+profiler = get_profiler()
+records = pd.DataFrame(profiler.records())
+
+if records.empty:
+    st.info("No stage has been run yet.")
+else:
+    columns = [
+        "run",
+        "stage",
+        "started",
+        "status",
+        "cached",
+        "wall_s",
+        "cpu_s",
+        "peak_rss_mb",
+        "rows",
+    ]
+    records = records.reindex(columns=columns)
+
+    runs = list(dict.fromkeys(records["run"]))
+    run = st.selectbox("Run", runs[::-1])
+    selected = records[records["run"] == run]
+
+    import plotly.express as px
+
+    tab1, tab2 = st.tabs(
+        [":material/bar_chart: Time per stage", ":material/Table: Table"]
+    )
+    tab1.plotly_chart(
+        px.bar(
+            selected,
+            x="wall_s",
+            y="stage",
+            orientation="h",
+            hover_data=["cpu_s", "peak_rss_mb", "rows", "cached"],
+            labels=dict(wall_s="Wall time (s)", stage=""),
+        ).update_yaxes(autorange="reversed"),
+        use_container_width=True,
+    )
+    tab2.dataframe(
+        records,
+        hide_index=True,
+        column_config=dict(
+            wall_s=st.column_config.NumberColumn("Wall (s)", format="%.2f"),
+            cpu_s=st.column_config.NumberColumn("CPU (s)", format="%.2f"),
+            peak_rss_mb=st.column_config.NumberColumn(
+                "Peak RSS (MB)", format="%.0f"
+            ),
+        ),
+    )
+
+    c1, c2 = st.columns(2)
+    c1.download_button(
+        ":material/download: Export as JSON",
+        data=profiler.to_json(indent=1),
+        file_name="neptoon_performance.json",
+        mime="application/json",
+    )
+    if c2.button(":material/delete: Clear"):
+        profiler.clear()
+        st.rerun()
+
+from neptoon_gui_imports import import_times
+
+imports = pd.DataFrame(import_times(), columns=["module", "seconds", "thread"])
+with st.expander(
+    "Imports of this server: {:.1f} s".format(imports["seconds"].sum())
+):
+    st.write(
+        "Heavy libraries are imported when a stage first needs them, or in the background (*neptoon-preload*) after the first page was shown."
+    )
+    st.dataframe(
+        imports,
+        hide_index=True,
+        column_config=dict(
+            seconds=st.column_config.NumberColumn("Time (s)", format="%.2f")
+        ),
+    )
@@ -1,6 +1,10 @@
 import streamlit as st
 from pathlib import Path
 from neptoon_gui_utils import *
+from neptoon_gui_plot import plot_time_series
+from neptoon_gui_session import run_cached_stage
+from neptoon_gui_table import show_table
+from neptoon_gui_ingest import get_raw_parse_extra
 
 st.title(":material/full_stacked_bar_chart: Read data")
 
@@ -116,6 +120,19 @@ else:
                     key="input_dataraw_separator",
                 )
 
+                # parallel_workers
+                c1.number_input(
+                    label="Parallel workers",
+                    min_value=0,
+                    value=get_raw_parse_extra(
+                        st.session_state["yaml"].sensor_config,
+                        "parallel_workers",
+                    ),
+                    help="Parse the raw files in this many processes, "
+                    "0 to parse them one after another.",
+                    key="input_dataraw_parallel_workers",
+                )
+
                 with st.expander(
                     "More settings will be editable in future versions."
                 ):
@@ -136,7 +153,7 @@ else:
 
         uploaded_file = st.file_uploader(
             "Upload files",
-            type={"csv", "zip"},
+            type={"csv", "zip", "parquet", "feather"},
             key="data_preformatted_upload",
         )
         if uploaded_file:
@@ -223,12 +240,27 @@ else:
     st.subheader("2. :material/search_insights: Data inspection")
     ################################
 
-    @st.cache_data(show_spinner="Creating data table...")
     def parse_data():
-        import plotly.express as px
+        from neptoon_gui_ingest import create_data_hub
+
+        def compute():
+            progress_bar = st.progress(0.0, text="Parsing raw files...")
+
+            def show_progress(done, total, name):
+                progress_bar.progress(
+                    done / total if total else 0.0,
+                    text="Parsed {:,.0f}{:} files: {:}".format(
+                        done,
+                        " of {:,.0f}".format(total) if total else "",
+                        name,
+                    ),
+                )
+
+            create_data_hub(st.session_state["yaml"], progress=show_progress)
+            progress_bar.empty()
 
-        # with st.spinner("Creating data table..."):
-        st.session_state["yaml"].create_data_hub(return_data_hub=False)
+        with st.spinner("Creating data table..."):
+            run_cached_stage("parse", compute)
         data_hub = st.session_state["yaml"].data_hub
         st.write(
             "Parsed {:,.0f} lines and {:.0f} columns of data.".format(
@@ -244,6 +276,11 @@ else:
         ):
             # st.write(st.session_state["yaml"].sensor_config)
             if use_raw_data:
+                st.session_state[
+                    "yaml"
+                ].sensor_config.raw_data_parse_options.data_location = st.session_state[
+                    "data_raw_file"
+                ]
                 st.session_state[
                     "yaml"
                 ].sensor_config.raw_data_parse_options.column_names = [
@@ -277,7 +314,19 @@ else:
                 ].sensor_config.raw_data_parse_options.separator = st.session_state[
                     "input_dataraw_separator"
                 ]
+                st.session_state[
+                    "yaml"
+                ].sensor_config.raw_data_parse_extras = dict(
+                    parallel_workers=int(
+                        st.session_state["input_dataraw_parallel_workers"]
+                    )
+                )
             else:
+                st.session_state[
+                    "yaml"
+                ].sensor_config.time_series_data.path_to_data = st.session_state[
+                    "data_preformatted_file"
+                ]
                 st.session_state[
                     "yaml"
                 ].sensor_config.time_series_data.key_column_info.date_time_format = st.session_state[
@@ -308,13 +357,11 @@ else:
 
     @st.fragment
     def make_selection_plot():
-        import plotly.express as px
-
         tab1, tab2 = st.tabs(
             [":material/Table: Raw data table", ":material/show_chart: Plots"]
         )
 
-        tab1.dataframe(data_hub.crns_data_frame)
+        show_table(tab1, data_hub.crns_data_frame, key="table_raw")
 
         selected_columns = tab2.multiselect(
             "Which columns would you like to view?",
@@ -322,11 +369,8 @@ else:
             default="epithermal_neutrons_cph",
         )
 
-        filtered_data = data_hub.crns_data_frame[selected_columns]
-
-        tab2.plotly_chart(
-            px.line(filtered_data, y=selected_columns),
-            use_container_width=True,
+        plot_time_series(
+            tab2, data_hub.crns_data_frame, selected_columns, key="plot_raw"
         )
 
     if st.session_state["data_parsed"]:
@@ -4,7 +4,10 @@ from streamlit.logger import get_logger
 import io
 from pathlib import Path
 from neptoon_gui_utils import *
+from neptoon_gui_jobs import job_running, submit_job
+from neptoon_gui_session import STAGE_FLAGS, get_nmdb_store, get_profiler
 import pandas as pd
+from datetime import datetime
 
 st.title(":material/web_traffic: Run all")
 
@@ -13,16 +16,111 @@ if not st.session_state["yaml_checked"]:
 else:
     st.write("Run all the processing steps with a single click.")
 
-    if st.button("Run all", type="primary"):
-        with st.spinner("Running..."):
-            st.session_state["yaml"].run_full_process()
+    if st.button("Run all", type="primary", disabled=job_running("Run all")):
+        from neptoon_gui_jobs import detach, run_full_process_job
+        from neptoon_gui_profile import instrument
+
+        process = detach(st.session_state["yaml"])
+        run_full_process = run_full_process_job(
+            process, nmdb_store=get_nmdb_store()
+        )
+        instrument(
+            process,
+            get_profiler(),
+            run="Run all {:%H:%M:%S}".format(datetime.now()),
+        )
+        submit_job(
+            "Run all",
+            run_full_process,
+            flags=[
+                "config_already_parsed",
+                "data_read_ready",
+                "calibration_read_ready",
+                *STAGE_FLAGS.values(),
+            ],
+            calibration=True,
+        )
+        st.rerun()
+    if job_running("Run all"):
+        st.info(
+            "Running in the background, see the sidebar. You can use the other pages meanwhile."
+        )
+
+    #########################################
+    st.subheader("Append new data")
+    #########################################
+
+    from neptoon_gui_incremental import (
+        ProcessedStore,
+        default_store_dir,
+        run_incremental_process,
+    )
+
+    store = ProcessedStore(default_store_dir(st.session_state["yaml"]))
+    if store.state is None:
+        st.write(
+            "No processed data stored yet in **{:}**. The first run processes all data.".format(
+                store.folder
+            )
+        )
+    else:
+        st.write(
+            "Processed data from **{:}** to **{:}** is stored in **{:}**.".format(
+                store.state["start"], store.state["end"], store.folder
+            )
+        )
+
+    uploaded_file = st.file_uploader(
+        "Upload new rows (optional, otherwise the configured data is read)",
+        type={"csv", "parquet", "feather"},
+        key="data_new_rows_upload",
+    )
+
+    c1, c2, c3 = st.columns(3)
+
+    if c1.button(":material/add: Process new data", type="primary"):
+        from neptoon_gui_ingest import (
+            prepare_time_series,
+            read_time_series_file,
+        )
+
+        new_data = None
+        if uploaded_file:
+            temp_file_path = save_uploaded_file(uploaded_file)
+            atexit.register(cleanup, temp_file_path)
+            new_data = prepare_time_series(
+                st.session_state["yaml"],
+                read_time_series_file(temp_file_path),
+            )
+        with st.spinner("Processing..."):
+            try:
+                new_rows = run_incremental_process(
+                    st.session_state["yaml"],
+                    store,
+                    new_data=new_data,
+                    nmdb_store=get_nmdb_store(),
+                    progress=st.write,
+                )
+            except ValueError as error:
+                st.error(error)
+                new_rows = None
+        if new_rows == 0:
+            st.info("No rows after the end of the processed data.")
+        elif new_rows:
+            hub = st.session_state["yaml"].data_hub
+            hub.crns_data_frame, hub.flags_data_frame = store.read()
+            st.session_state["yaml"].stage_outputs = {}
             st.session_state["config_already_parsed"] = True
             st.session_state["data_read_ready"] = True
-            st.session_state["data_parsed"] = True
-            st.session_state["data_nmdb_attached"] = True
-            st.session_state["data_quality_checked"] = True
-            st.session_state["data_corrections_made"] = True
             st.session_state["calibration_read_ready"] = True
-            st.session_state["calibration_finished"] = True
-            st.session_state["data_converted"] = True
-        st.success("Done.")
+            for flag in STAGE_FLAGS.values():
+                st.session_state[flag] = True
+            st.success("Appended {:} new rows.".format(new_rows))
+
+    if c2.button(":material/compress: Compact", disabled=len(store) < 2):
+        store.compact()
+        st.rerun()
+
+    if c3.button(":material/delete: Clear", disabled=store.state is None):
+        store.clear()
+        st.rerun()
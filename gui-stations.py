@@ -0,0 +1,151 @@
+import streamlit as st
+import subprocess
+import os
+import sys
+from pathlib import Path
+from neptoon_gui_utils import *
+from neptoon_gui_jobs import job_running, session_job, submit_job
+
+st.title(":material/hub: Stations")
+
+st.write(
+    "Process several stations at once, each in a worker process of its own.",
+    "Stations that use the same reference neutron monitor share its NMDB data, which is fetched once for the time range of all of them.",
+)
+
+from neptoon_gui_batch import config_type, monitor_key, read_fleet
+
+bundled = {
+    path.stem: path
+    for path in sorted((Path.cwd() / "default_configuration").glob("*.yaml"))
+    if config_type(path) == "sensor"
+}
+selected = st.multiselect(
+    "Sensor configurations",
+    list(bundled),
+    key="fleet_sensor_selected",
+)
+uploaded_files = st.file_uploader(
+    "Upload further sensor configurations (optional)",
+    type={"yaml", "yml"},
+    accept_multiple_files=True,
+    key="fleet_sensor_uploaded",
+)
+
+processing_file = st.session_state["config_processing_file"] or (
+    Path.cwd() / "default_configuration" / "v1_processing_method.yaml"
+)
+key = monitor_key(processing_file)
+st.write(
+    "Processing with **{:}**, reference monitor **{:}** unless a sensor configuration has a `reference_neutron_monitor` section of its own.".format(
+        Path(processing_file).name,
+        "/".join(key) if key else "none",
+    )
+)
+
+c1, c2 = st.columns(2)
+workers = c1.number_input(
+    "Stations at once",
+    min_value=1,
+    max_value=32,
+    value=min(4, os.cpu_count() or 1),
+    key="fleet_workers",
+)
+output_dir = c2.text_input(
+    "Output folder", value="results", key="fleet_output_dir"
+)
+
+if st.button(
+    ":material/play_arrow: Process stations",
+    type="primary",
+    disabled=not (selected or uploaded_files) or job_running("Stations"),
+):
+    sensor_files = [bundled[name] for name in selected]
+    for uploaded_file in uploaded_files or []:
+        temp_file_path = save_uploaded_file(uploaded_file)
+        atexit.register(cleanup, temp_file_path)
+        sensor_files.append(temp_file_path)
+
+    def run(job):
+        # a command line run, as worker processes can neither be forked
+        # from the threads of the server nor spawned from its script
+        command = [
+            sys.executable,
+            "-u",
+            "-m",
+            "neptoon_gui_batch",
+            *map(str, sensor_files),
+            "--processing",
+            str(processing_file),
+            "--output",
+            output_dir,
+            "--workers",
+            str(int(workers)),
+        ]
+        done = 0
+        output = []
+        with subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        ) as runner:
+            for line in runner.stdout:
+                output.append(line)
+                words = line.split()
+                if words and words[0] in ("ok", "error", "timeout"):
+                    done += 1
+                if words and words[0] in ("ok", "error", "timeout", "nmdb"):
+                    job.report(line.strip(), done / len(sensor_files))
+        # exit code 1 if some stations failed, see the summary
+        if runner.returncode not in (0, 1):
+            raise RuntimeError("".join(output[-5:]))
+        return read_fleet(output_dir)
+
+    submit_job("Stations", run, adopt=False)
+    st.rerun()
+
+job = session_job("Stations")
+if job is not None and not job.done:
+    st.info(
+        "Running in the background, see the sidebar. You can use the other pages meanwhile."
+    )
+elif job is not None and job.status == "done":
+    fleet = job.result
+
+    st.subheader("Soil moisture")
+    soil_moisture = fleet["soil_moisture"]
+    if soil_moisture.empty:
+        st.warning("No station produced soil moisture.")
+    else:
+        import plotly.express as px
+
+        st.plotly_chart(
+            px.line(
+                soil_moisture,
+                labels=dict(value="Soil moisture (m³/m³)", variable=""),
+            ).update_xaxes(title=None),
+            use_container_width=True,
+        )
+        st.caption("Daily means, saved in **{:}**.".format(output_dir))
+
+    st.subheader("Stations")
+    st.dataframe(
+        fleet["summary"].drop(columns="traceback", errors="ignore"),
+        hide_index=True,
+        column_config=dict(
+            mean_soil_moisture=st.column_config.NumberColumn(
+                "Mean soil moisture", format="%.3f"
+            ),
+            seconds=st.column_config.NumberColumn("Time (s)", format="%.1f"),
+        ),
+    )
+
+    st.subheader("NMDB data")
+    if fleet["nmdb"].empty:
+        st.write("No NMDB data was fetched.")
+    else:
+        st.dataframe(fleet["nmdb"], hide_index=True)
+        st.caption(
+            "One fetch per reference monitor for the stations using it; downloads counts the requests to NMDB.eu for days not yet in the local store."
+        )
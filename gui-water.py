@@ -1,7 +1,9 @@
 import streamlit as st
 from pathlib import Path
 from neptoon_gui_utils import *
-import plotly.graph_objects as go
+from neptoon_gui_jobs import job_running, session_job, submit_job, submit_stage_job
+from neptoon_gui_plot import plot_time_series
+from neptoon_gui_table import show_quality_report, show_table
 
 st.title(":material/water_drop: Water")
 
@@ -13,52 +15,57 @@ else:
         "Conversion to soil moisture. Future versions will reveal more settings here."
     )
 
-    @st.cache_data(show_spinner="Converting to soil moisture")
+    # float32 columns if the data is kept compact anyway
+    dtype = "float32" if st.session_state.get("data_compact") else "float64"
+
+    def convert_to_soil_moisture(process):
+        from neptoon_gui_quality import (
+            apply_quality_assessment,
+            clear_quality_reports,
+        )
+        from neptoon_gui_soil_moisture import (
+            PHYSICAL_RANGES,
+            produce_soil_moisture,
+        )
+
+        clear_quality_reports(process, "soil_moisture")
+        # N0 bounds of the corrected neutrons, e.g. greater_than_N0
+        apply_quality_assessment(
+            process,
+            process.process_config.neutron_quality_assessment,
+            name_of_target="corrected_neutrons",
+            stage="soil_moisture",
+        )
+        produce_soil_moisture(
+            process,
+            process.sensor_config.soil_moisture_qa,
+            ranges=PHYSICAL_RANGES,
+            dtype=dtype,
+            stage="soil_moisture",
+        )
+
     def make_soil_moisture():
-        import numpy as np
-
-        st.session_state["yaml"].data_hub.create_neutron_uncertainty_bounds()
-        st.session_state["yaml"].data_hub.produce_soil_moisture_estimates()
-        dfx = st.session_state["yaml"].data_hub.crns_data_frame
-        st.session_state["yaml"].data_hub.crns_data_frame.loc[
-            dfx["soil_moisture"] < 0, "soil_moisture"
-        ] = np.nan
-        st.session_state["yaml"].data_hub.crns_data_frame.loc[
-            dfx["soil_moisture"] > 1, "soil_moisture"
-        ] = np.nan
-        st.session_state["yaml"].data_hub.crns_data_frame.loc[
-            dfx["soil_moisture_uncertainty_lower"] < 0,
-            "soil_moisture_uncertainty_lower",
-        ] = np.nan
-        st.session_state["yaml"].data_hub.crns_data_frame.loc[
-            dfx["soil_moisture_uncertainty_lower"] > 1,
-            "soil_moisture_uncertainty_lower",
-        ] = np.nan
-        st.session_state["yaml"].data_hub.crns_data_frame.loc[
-            dfx["soil_moisture_uncertainty_upper"] < 0,
-            "soil_moisture_uncertainty_upper",
-        ] = np.nan
-        st.session_state["yaml"].data_hub.crns_data_frame.loc[
-            dfx["soil_moisture_uncertainty_upper"] > 1,
-            "soil_moisture_uncertainty_upper",
-        ] = np.nan
-        st.session_state["yaml"].data_hub.crns_data_frame.loc[
-            dfx["crns_measurement_depth"] < 0, "crns_measurement_depth"
-        ] = np.nan
-        st.session_state["yaml"].data_hub.crns_data_frame.loc[
-            dfx["crns_measurement_depth"] > 100, "crns_measurement_depth"
-        ] = np.nan
-
-    if st.button("Convert!", type="primary"):
+        submit_stage_job(
+            "Soil moisture",
+            "soil_moisture",
+            convert_to_soil_moisture,
+            flags=["data_converted"],
+        )
+        st.rerun()
+
+    if st.button(
+        "Convert!", type="primary", disabled=job_running("Soil moisture")
+    ):
         make_soil_moisture()
-        st.session_state["data_converted"] = True
+    if job_running("Soil moisture"):
+        st.info(
+            "Converting to soil moisture in the background, see the sidebar."
+        )
 
 if st.session_state["data_converted"]:
 
     @st.fragment
     def make_water_plot():
-        import plotly.express as px
-
         tab1, tab2 = st.tabs(
             [
                 ":material/Table: Processed data table",
@@ -73,8 +80,16 @@ if st.session_state["data_converted"]:
             "crns_measurement_depth",
         ]
 
-        tab1.dataframe(
-            st.session_state["yaml"].data_hub.crns_data_frame[columns_to_show]
+        show_table(
+            tab1,
+            st.session_state["yaml"].data_hub.crns_data_frame,
+            key="table_water",
+            columns=columns_to_show,
+        )
+        from neptoon_gui_quality import quality_report
+
+        show_quality_report(
+            tab1, quality_report(st.session_state["yaml"], "soil_moisture")
         )
 
         selected_columns = tab2.multiselect(
@@ -83,18 +98,123 @@ if st.session_state["data_converted"]:
             default="soil_moisture",
         )
 
-        filtered_data = st.session_state["yaml"].data_hub.crns_data_frame[
-            selected_columns
-        ]
-
-        tab2.plotly_chart(
-            px.line(
-                st.session_state["yaml"].data_hub.crns_data_frame[
-                    columns_to_show
-                ],
-                y=selected_columns,
-            ),
-            use_container_width=True,
+        plot_time_series(
+            tab2,
+            st.session_state["yaml"].data_hub.crns_data_frame,
+            selected_columns,
+            key="plot_water",
         )
 
     make_water_plot()
+
+    @st.fragment
+    def make_ensemble():
+        from neptoon_gui_ensemble import ensemble_bands, ensemble_parameters
+        from neptoon_gui_soil_moisture import PHYSICAL_RANGES
+
+        means, stds = ensemble_parameters(st.session_state["yaml"])
+        st.write(
+            "Soil moisture of an ensemble with N0, bulk density, lattice water and soil organic carbon drawn from normal distributions, together with the counting error of the neutrons.",
+            "The spread of N0 is that of the calibration days, if the sensor was calibrated.",
+        )
+        c1, c2, c3 = st.columns(3)
+        members = c1.number_input(
+            "Members",
+            min_value=10,
+            max_value=100000,
+            value=1000,
+            step=100,
+            key="ensemble_members",
+        )
+        n0_std = c2.number_input(
+            "N0 standard deviation (cph)",
+            min_value=0.0,
+            value=round(stds["n0"], 1),
+            key="ensemble_n0_std",
+        )
+        counting = c3.toggle(
+            "Counting error", value=True, key="ensemble_counting"
+        )
+        c1, c2, c3 = st.columns(3)
+        bulk_density_std = c1.number_input(
+            "Bulk density standard deviation (g/cm³)",
+            min_value=0.0,
+            value=0.0,
+            step=0.01,
+            key="ensemble_bulk_density_std",
+        )
+        lattice_water_std = c2.number_input(
+            "Lattice water standard deviation",
+            min_value=0.0,
+            value=0.0,
+            step=0.001,
+            format="%.3f",
+            key="ensemble_lattice_water_std",
+        )
+        soil_organic_carbon_std = c3.number_input(
+            "Soil organic carbon standard deviation",
+            min_value=0.0,
+            value=0.0,
+            step=0.001,
+            format="%.3f",
+            key="ensemble_soil_organic_carbon_std",
+        )
+
+        if st.button(
+            ":material/stacked_line_chart: Run ensemble",
+            disabled=job_running("Ensemble"),
+        ):
+            data_frame = st.session_state["yaml"].data_hub.crns_data_frame
+            stds = dict(
+                n0=n0_std,
+                dry_soil_bulk_density=bulk_density_std,
+                lattice_water=lattice_water_std,
+                soil_organic_carbon=soil_organic_carbon_std,
+            )
+            dtype = (
+                "float32"
+                if st.session_state.get("data_compact")
+                else "float64"
+            )
+
+            def run(job):
+                job.report("Running", 0.0)
+                bands = ensemble_bands(
+                    data_frame,
+                    means,
+                    stds,
+                    members=int(members),
+                    counting=counting,
+                    dtype=dtype,
+                    ranges=PHYSICAL_RANGES,
+                )
+                job.report("Done", 1.0)
+                return bands
+
+            submit_job("Ensemble", run, adopt=False)
+            st.rerun()
+
+        job = session_job("Ensemble")
+        if job is not None and not job.done:
+            st.info("Running in the background, see the sidebar.")
+        elif job is not None and job.status == "done":
+            bands = job.result
+            plot_time_series(
+                st,
+                bands.join(
+                    st.session_state["yaml"].data_hub.crns_data_frame[
+                        ["soil_moisture"]
+                    ]
+                ),
+                ["soil_moisture", *bands.columns],
+                key="plot_ensemble",
+            )
+            width = (bands.iloc[:, -1] - bands.iloc[:, 0]).mean()
+            st.caption(
+                "Mean width of the {:} to {:} band: {:.3f} m³/m³.".format(
+                    bands.columns[0], bands.columns[-1], width
+                )
+            )
+
+    with st.expander(":material/stacked_line_chart: Uncertainty ensemble"):
+        make_ensemble()
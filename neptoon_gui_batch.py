@@ -0,0 +1,620 @@
+"""
+Headless batch processing of many stations.
+
+Each sensor YAML is processed with ProcessWithYaml.run_full_process()
+together with one processing YAML, in a pool of worker processes. Every
+station runs in a process of its own, so that a failing or hanging
+station (killed after the timeout) does not affect the others, and
+neptoon's global state is not shared between stations. Data is read
+through the faster ingestion paths of the GUI, NMDB data is served from
+the shared NMDB store. A summary of the run is written as JSON and CSV,
+the daily soil moisture of all stations as one CSV.
+
+Stations are grouped by their reference neutron monitor, that of the
+processing YAML unless the sensor YAML has a reference_neutron_monitor
+section of its own. A worker that has read its data asks the batch for
+the NMDB data of its time range and waits, without taking up one of the
+worker slots. Once all stations of a monitor have asked, the covering
+range of all of them is fetched into the store at once, and the workers
+attach it from there as slots become free. With more than MAX_WAITING
+waiting workers, the monitors are fetched for those that wait, later
+stations only fetch the days still missing in the store. The time a
+worker waits counts toward its timeout.
+
+Usage:
+    python neptoon_gui_batch.py default_configuration/*.yaml \\
+        --processing default_configuration/v1_processing_method.yaml \\
+        --output results --workers 4 --timeout 1800
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing.connection import wait
+from pathlib import Path
+
+import pandas as pd
+import yaml
+
+SUMMARY_FILE = "batch_summary"
+SOIL_MOISTURE_FILE = "fleet_soil_moisture"
+NMDB_FILE = "fleet_nmdb"
+
+# workers waiting for NMDB data at most, each keeps the data of its
+# station in memory
+MAX_WAITING = 16
+
+
+def config_type(path):
+    """Value of the "config" key of a YAML file, e.g. "sensor"."""
+    with open(path) as file:
+        content = yaml.safe_load(file)
+    return content.get("config") if isinstance(content, dict) else None
+
+
+def monitor_key(processing_file, sensor_file=None):
+    """
+    Reference neutron monitor of a processing YAML, as (station,
+    nmdb_table, resolution) with the defaults of attach_nmdb_data().
+    The entries of a reference_neutron_monitor section of the sensor
+    YAML, if given, replace those of the processing YAML. None if there
+    is no station.
+    """
+    with open(processing_file) as file:
+        content = yaml.safe_load(file) or {}
+    try:
+        monitor = content["correction_steps"]["incoming_radiation"][
+            "reference_neutron_monitor"
+        ]
+    except (KeyError, TypeError):
+        monitor = None
+    monitor = dict(monitor) if isinstance(monitor, dict) else {}
+    if sensor_file is not None:
+        with open(sensor_file) as file:
+            content = yaml.safe_load(file) or {}
+        own = content.get("reference_neutron_monitor")
+        if isinstance(own, dict):
+            monitor.update(own)
+    if not monitor.get("station"):
+        return None
+    return (
+        str(monitor["station"]),
+        str(monitor.get("nmdb_table") or "revori"),
+        str(monitor.get("resolution") or "60"),
+    )
+
+
+def nmdb_store():
+    """
+    The shared NMDB store, served from the file NEPTOON_GUI_NMDB_FIXTURE
+    instead of NMDB.eu if set, see also neptoon_gui_session.get_nmdb_store().
+    """
+    from neptoon_gui_nmdb import NMDBStore, FixtureFetcher
+
+    fixture = os.environ.get("NEPTOON_GUI_NMDB_FIXTURE")
+    return NMDBStore(fetcher=FixtureFetcher(fixture) if fixture else None)
+
+
+def process_station(
+    sensor_file,
+    processing_file,
+    output_dir=None,
+    nmdb_request=None,
+    monitor=None,
+):
+    """
+    Full processing of one station, as the "Run all" page does.
+
+    Parameters
+    ----------
+    sensor_file : Path
+        Sensor YAML
+    processing_file : Path
+        Processing YAML
+    output_dir : Path, optional
+        Where the results are saved, by default the save_folder of the
+        sensor YAML
+    nmdb_request : callable, optional
+        Called with the first and last timestamp of the data before the
+        NMDB data is attached, returns once the store covers them
+    monitor : tuple, optional
+        Reference neutron monitor as (station, nmdb_table, resolution),
+        by default that of the processing YAML
+
+    Returns
+    -------
+    dict
+        Summary entries of the station, and its daily mean soil moisture
+        as soil_moisture
+    """
+    from neptoon.columns import ColumnInfo
+    from neptoon.io.read import ConfigurationManager
+    from neptoon.workflow import ProcessWithYaml
+    from neptoon_gui_calibration import use_fast_calibration
+    from neptoon_gui_ingest import create_data_hub
+    from neptoon_gui_nmdb import attach_nmdb_data
+    from neptoon_gui_quality import use_vectorized_quality
+    from neptoon_gui_soil_moisture import use_vectorized_soil_moisture
+
+    config = ConfigurationManager()
+    config.load_configuration(file_path=sensor_file)
+    config.load_configuration(file_path=processing_file)
+    process = ProcessWithYaml(configuration_object=config)
+    if output_dir is not None:
+        process.sensor_config.data_storage.save_folder = str(output_dir)
+    radiation = process.process_config.correction_steps.incoming_radiation
+    if monitor is not None and radiation is not None:
+        reference = radiation.reference_neutron_monitor
+        reference.station, reference.nmdb_table = monitor[0], monitor[1]
+        reference.resolution = int(monitor[2])
+
+    # the GUI's replacements of the ingestion and NMDB steps
+    store = nmdb_store()
+    process.create_data_hub = lambda return_data_hub=False: create_data_hub(
+        process
+    )
+
+    def attach():
+        if nmdb_request is not None:
+            index = process.data_hub.crns_data_frame.index
+            nmdb_request(index[0], index[-1])
+        attach_nmdb_data(process, store)
+
+    process._attach_nmdb_data = attach
+    use_vectorized_quality(process)
+    use_fast_calibration(process)
+    use_vectorized_soil_moisture(process)
+    process.run_full_process()
+
+    hub = process.data_hub
+    index = hub.crns_data_frame.index
+    column = str(ColumnInfo.Name.SOIL_MOISTURE_FINAL)
+    soil_moisture = None
+    if column in hub.crns_data_frame.columns and len(index):
+        soil_moisture = hub.crns_data_frame[column].resample("1D").mean()
+    return dict(
+        name=process.sensor_config.sensor_info.name,
+        rows=len(index),
+        start=str(index[0]) if len(index) else None,
+        end=str(index[-1]) if len(index) else None,
+        N0=process.sensor_config.sensor_info.N0,
+        mean_soil_moisture=(
+            float(soil_moisture.mean()) if soil_moisture is not None else None
+        ),
+        output=str(getattr(hub.saver, "full_folder_location", "") or ""),
+        soil_moisture=soil_moisture,
+    )
+
+
+def _worker(connection, sensor_file, processing_file, output_dir, monitor):
+    def nmdb_request(start, end):
+        # the batch answers with None once the store covers the range,
+        # otherwise with the error of the download
+        connection.send(dict(nmdb=(start, end)))
+        error = connection.recv()
+        if error is not None:
+            raise RuntimeError(error)
+
+    try:
+        result = dict(
+            status="ok",
+            **process_station(
+                sensor_file,
+                processing_file,
+                output_dir,
+                nmdb_request=nmdb_request if monitor else None,
+                monitor=monitor,
+            ),
+        )
+    except BaseException as error:
+        result = dict(
+            status="error",
+            error="{:}: {:}".format(type(error).__name__, error),
+            traceback=traceback.format_exc(),
+        )
+    connection.send(result)
+    connection.close()
+
+
+def run_batch(
+    sensor_files,
+    processing_file,
+    output_dir=None,
+    workers=None,
+    timeout=None,
+    progress=print,
+    monitors=None,
+):
+    """
+    Process stations in parallel worker processes.
+
+    Parameters
+    ----------
+    sensor_files : list of Path
+        Sensor YAMLs. Files whose "config" is not "sensor" are skipped.
+    processing_file : Path
+        Processing YAML used for all stations
+    output_dir : Path, optional
+        Where the results and the summary are saved, by default the
+        save_folder of each sensor YAML and the current directory
+    workers : int, optional
+        Number of stations processed at once, by default the CPU count
+    timeout : float, optional
+        Seconds after which a station is killed, by default no limit
+    progress : callable, optional
+        Called with a message whenever a station finishes or NMDB data
+        is fetched
+    monitors : dict, optional
+        Reference neutron monitor of sensor YAMLs, as (station,
+        nmdb_table, resolution), instead of that of its YAMLs (see
+        monitor_key())
+
+    Returns
+    -------
+    pd.DataFrame
+        Summary with one row per sensor YAML
+    """
+    return run_fleet(
+        sensor_files,
+        processing_file,
+        output_dir=output_dir,
+        workers=workers,
+        timeout=timeout,
+        progress=progress,
+        monitors=monitors,
+    )["summary"]
+
+
+def run_fleet(
+    sensor_files,
+    processing_file,
+    output_dir=None,
+    workers=None,
+    timeout=None,
+    progress=print,
+    monitors=None,
+):
+    """
+    Process stations in parallel worker processes, with the NMDB data
+    fetched once per reference monitor.
+
+    Parameters are those of run_batch().
+
+    Returns
+    -------
+    dict
+        summary: one row per sensor YAML, see run_batch()
+        soil_moisture: daily mean soil moisture, one column per station
+        nmdb: one row per fetch of a monitor, with the covered range
+        and the stations it was fetched for
+    """
+    workers = workers or os.cpu_count() or 1
+    pending = []
+    results = []
+    for path in map(Path, sensor_files):
+        if Path(path).resolve() == Path(processing_file).resolve():
+            continue
+        try:
+            kind = config_type(path)
+        except (OSError, yaml.YAMLError) as error:
+            kind = error
+        if kind == "sensor":
+            pending.append(path)
+        else:
+            results.append(
+                dict(
+                    sensor_file=str(path),
+                    status="skipped",
+                    error="not a sensor config ({:})".format(kind),
+                )
+            )
+
+    store = nmdb_store()
+    overrides = {
+        Path(path): tuple(key) for path, key in (monitors or {}).items()
+    }
+    monitors = {
+        path: overrides.get(path) or monitor_key(processing_file, path)
+        for path in pending
+    }
+    # workers that have not asked for NMDB data yet, the ranges of those
+    # that wait for it, and the answers for those that got it and wait
+    # for a free slot to go on
+    reading = set()
+    requests = {}
+    answers = {}
+    fetches = []
+
+    running = {}
+    while pending or running:
+        # waiting workers do not count, they only keep their data
+        active = len(running) - len(requests) - len(answers)
+        for connection in list(answers)[: max(0, workers - active)]:
+            try:
+                connection.send(answers.pop(connection))
+            except OSError:
+                pass
+            active += 1
+        while pending and active < workers:
+            path = pending.pop(0)
+            connection, child = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=_worker,
+                args=(
+                    child,
+                    path,
+                    processing_file,
+                    output_dir,
+                    monitors[path],
+                ),
+                daemon=True,
+            )
+            worker.start()
+            child.close()
+            running[connection] = (path, worker, time.monotonic())
+            if monitors[path] is not None:
+                reading.add(connection)
+            active += 1
+
+        ready = wait(list(running), timeout=1)
+        now = time.monotonic()
+        for connection, entry in list(running.items()):
+            path, worker, started = entry
+            if connection in ready:
+                try:
+                    result = connection.recv()
+                except EOFError:
+                    worker.join()
+                    result = dict(
+                        status="error",
+                        error="worker exited with code {:}".format(
+                            worker.exitcode
+                        ),
+                    )
+                if "nmdb" in result:
+                    reading.discard(connection)
+                    requests[connection] = result["nmdb"]
+                    continue
+            elif timeout is not None and now - started > timeout:
+                worker.kill()
+                result = dict(
+                    status="timeout",
+                    error="killed after {:.0f} s".format(timeout),
+                )
+            else:
+                continue
+            worker.join()
+            connection.close()
+            del running[connection]
+            reading.discard(connection)
+            requests.pop(connection, None)
+            answers.pop(connection, None)
+            result.update(
+                sensor_file=str(path), seconds=round(now - started, 2)
+            )
+            results.append(result)
+            progress(
+                "{:>7}  {:8.1f} s  {:}{:}".format(
+                    result["status"],
+                    result["seconds"],
+                    path.name,
+                    (
+                        "  " + result["error"].splitlines()[0]
+                        if "error" in result
+                        else ""
+                    ),
+                )
+            )
+
+        fetches.extend(
+            _fetch_nmdb_data(
+                store,
+                [running[c][0] for c in reading] + pending,
+                monitors,
+                {c: running[c][0] for c in requests},
+                requests,
+                answers,
+                progress,
+            )
+        )
+
+    summary = pd.DataFrame(results)
+    order = [str(Path(path)) for path in sensor_files]
+    summary = summary.set_index("sensor_file").reindex(
+        [path for path in order if path in set(summary["sensor_file"])]
+    )
+    soil_moisture = {}
+    if "soil_moisture" in summary.columns:
+        for path, row in summary.iterrows():
+            if isinstance(row["soil_moisture"], pd.Series):
+                name = row["name"]
+                if name in soil_moisture:
+                    name = Path(path).stem
+                soil_moisture[name] = row["soil_moisture"]
+        summary = summary.drop(columns="soil_moisture")
+    soil_moisture = combine_daily(soil_moisture)
+    nmdb = pd.DataFrame(
+        fetches, columns=["monitor", "start", "end", "stations", "downloads"]
+    )
+    write_summary(summary, Path(output_dir or "."), soil_moisture, nmdb)
+    return dict(
+        summary=summary.reset_index(), soil_moisture=soil_moisture, nmdb=nmdb
+    )
+
+
+def combine_daily(series):
+    """
+    Daily series of the stations as one frame over the union of their
+    days.
+
+    The indexes of resample("1D") carry freq="D", with which pandas
+    2.3 aligns series of different spans to a few rows instead of the
+    union, so they are combined without it, in nanoseconds.
+
+    Parameters
+    ----------
+    series : dict
+        Station name: daily pd.Series
+
+    Returns
+    -------
+    pd.DataFrame
+        One column per station
+    """
+    normalised = {}
+    for name, values in series.items():
+        values = values.copy()
+        values.index = pd.DatetimeIndex(values.index.as_unit("ns"), freq=None)
+        normalised[name] = values
+    return pd.DataFrame(normalised)
+
+
+def daily_span(summary):
+    """
+    Days covered by the stations with soil moisture in a summary, the
+    union of the days from their start to their end, i.e. the rows of
+    their combined daily series.
+    """
+    rows = summary[summary["mean_soil_moisture"].notna()]
+    days = pd.DatetimeIndex([], tz="UTC")
+    for start, end in zip(rows["start"], rows["end"]):
+        days = days.union(
+            pd.date_range(
+                pd.Timestamp(start).tz_convert("UTC").floor("D"),
+                pd.Timestamp(end).tz_convert("UTC").floor("D"),
+                freq="D",
+            )
+        )
+    return len(days)
+
+
+def _fetch_nmdb_data(
+    store, unready, monitors, waiting, requests, answers, log
+):
+    """
+    Fetch the NMDB data of every monitor for which all stations that
+    are not done yet wait, or of all monitors if MAX_WAITING workers
+    wait. The requests are moved to the answers, None or an error.
+
+    Returns
+    -------
+    list of dict
+        One entry per fetch
+    """
+    groups = {}
+    for connection, path in waiting.items():
+        groups.setdefault(monitors[path], []).append(connection)
+    fetches = []
+    for key, connections in groups.items():
+        if len(requests) < MAX_WAITING and any(
+            monitors[path] == key for path in unready
+        ):
+            continue
+        ranges = [requests.pop(connection) for connection in connections]
+        start = min(first for first, _ in ranges)
+        end = max(last for _, last in ranges)
+        try:
+            downloads = store.update(*key, start, end)
+            error = None
+        except Exception as exception:
+            downloads = 0
+            error = "NMDB data of {:} could not be fetched: {:}".format(
+                "/".join(key), exception
+            )
+        for connection in connections:
+            answers[connection] = error
+        fetches.append(
+            dict(
+                monitor="/".join(key),
+                start=str(start),
+                end=str(end),
+                stations=", ".join(waiting[c].name for c in connections),
+                downloads=downloads,
+            )
+        )
+        log(
+            "{:>7}  {:} from {:%Y-%m-%d} to {:%Y-%m-%d} for {:} station(s), "
+            "{:} download(s)".format(
+                "nmdb",
+                "/".join(key),
+                pd.Timestamp(start),
+                pd.Timestamp(end),
+                len(connections),
+                downloads,
+            )
+        )
+    return fetches
+
+
+def write_summary(summary, folder, soil_moisture=None, nmdb=None):
+    """
+    Summary as JSON (with tracebacks) and CSV (without), the daily soil
+    moisture of the stations and the NMDB fetches as CSV.
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    records = summary.reset_index().astype(object)
+    records = records.where(records.notna(), None).to_dict("records")
+    with open(folder / (SUMMARY_FILE + ".json"), "w") as file:
+        json.dump(records, file, indent=1, default=str)
+    summary.drop(columns="traceback", errors="ignore").to_csv(
+        folder / (SUMMARY_FILE + ".csv")
+    )
+    if soil_moisture is not None and not soil_moisture.empty:
+        soil_moisture.to_csv(folder / (SOIL_MOISTURE_FILE + ".csv"))
+    if nmdb is not None:
+        nmdb.to_csv(folder / (NMDB_FILE + ".csv"), index=False)
+
+
+def read_fleet(folder):
+    """
+    Results of run_fleet() from the files written to its output folder,
+    e.g. by the command line runner.
+    """
+    folder = Path(folder)
+    with open(folder / (SUMMARY_FILE + ".json")) as file:
+        summary = pd.DataFrame(json.load(file))
+    path = folder / (SOIL_MOISTURE_FILE + ".csv")
+    soil_moisture = (
+        pd.read_csv(path, index_col=0, parse_dates=True)
+        if path.is_file()
+        else pd.DataFrame()
+    )
+    path = folder / (NMDB_FILE + ".csv")
+    nmdb = pd.read_csv(path) if path.is_file() else pd.DataFrame()
+    return dict(summary=summary, soil_moisture=soil_moisture, nmdb=nmdb)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("sensor_files", nargs="+", type=Path)
+    parser.add_argument("--processing", type=Path, required=True)
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--timeout", type=float, default=None, help="seconds per station"
+    )
+    args = parser.parse_args()
+    fleet = run_fleet(
+        args.sensor_files,
+        args.processing,
+        output_dir=args.output,
+        workers=args.workers,
+        timeout=args.timeout,
+    )
+    summary = fleet["summary"]
+    if not fleet["soil_moisture"].empty:
+        print(fleet["soil_moisture"].describe().T.to_string())
+        if len(fleet["soil_moisture"]) != daily_span(summary):
+            raise SystemExit(
+                "The fleet soil moisture has {:} rows, the stations span "
+                "{:} days.".format(
+                    len(fleet["soil_moisture"]), daily_span(summary)
+                )
+            )
+    counts = summary["status"].value_counts()
+    print(", ".join("{:} {:}".format(n, s) for s, n in counts.items()))
+    if (summary["status"] != "ok").any():
+        raise SystemExit(1)
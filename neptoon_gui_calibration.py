@@ -0,0 +1,886 @@
+"""
+Vectorized N0 calibration.
+
+neptoon's CalibrationStation weights the soil samples of every
+calibration day in a Python loop over the profiles, repeated until the
+field average converges, and searches N0 with a pandas apply() over
+every integer candidate of every day. Here the samples are arrays of
+profiles × depths, the vertical and horizontal footprint weights
+(Schrön et al., 2017) of all profiles of all days are computed at once
+in every iteration, and the candidates of all days are compared as one
+array of days × candidates. The results are those of neptoon, including
+its choices: the distance of a profile is rescaled again in every
+iteration, the vertical weights use a distance of 1 m, and the site
+averages of the samples are used for the total soil moisture.
+
+Calibration days can be bootstrapped by resampling their profiles with
+replacement. The replicates are solved as further groups of the same
+arrays, split over threads, which gives a confidence interval of N0.
+
+Without soil samples, N0 can also be calibrated on one field average
+soil moisture measured at some time, by inverting the Desilets equation
+for the mean corrected neutrons around that time. A NeutronLookup keeps
+the sorted times and cumulative sums of the time series, so that the
+mean of any window takes two binary searches and N0 follows every input
+interactively.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# coefficients of the radial weighting function W_r of Schrön et al.
+# (2017), as in neptoon's Schroen2017.horizontal_weighting()
+_A = dict(
+    a00=8735,
+    a01=22.689,
+    a02=11720,
+    a03=0.00978,
+    a04=9306,
+    a05=0.003632,
+    a10=2.7925e-002,
+    a11=6.6577,
+    a12=0.028544,
+    a13=0.002455,
+    a14=6.851e-005,
+    a15=12.2755,
+    a20=247970,
+    a21=23.289,
+    a22=374655,
+    a23=0.00191,
+    a24=258552,
+    a30=5.4818e-002,
+    a31=21.032,
+    a32=0.6373,
+    a33=0.0791,
+    a34=5.425e-004,
+)
+_B = dict(
+    b00=39006,
+    b01=15002337,
+    b02=2009.24,
+    b03=0.01181,
+    b04=3.146,
+    b05=16.7417,
+    b06=3727,
+    b10=6.031e-005,
+    b11=98.5,
+    b12=0.0013826,
+    b20=11747,
+    b21=55.033,
+    b22=4521,
+    b23=0.01998,
+    b24=0.00604,
+    b25=3347.4,
+    b26=0.00475,
+    b30=1.543e-002,
+    b31=13.29,
+    b32=1.807e-002,
+    b33=0.0011,
+    b34=8.81e-005,
+    b35=0.0405,
+    b36=26.74,
+)
+
+# water equivalent of soil organic carbon in neptoon's calibration
+SOC_WATER = 0.555
+BOOTSTRAP_INTERVAL = (2.5, 97.5)
+# replicates solved at once, which bounds the N0 candidates in memory
+BOOTSTRAP_CHUNK = 500
+
+
+def horizontal_weights(distance, soil_moisture, air_humidity):
+    """
+    Radial weights W_r of Schrön et al. (2017) for arrays of rescaled
+    distances, soil moisture and air humidity, NaN where an input is.
+    """
+    r, x, y = np.broadcast_arrays(
+        *(
+            np.asarray(v, dtype="float64")
+            for v in (distance, air_humidity, soil_moisture)
+        )
+    )
+    a, b = _A, _B
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        A0 = (
+            a["a00"] * (1 + a["a03"] * x) * np.exp(-a["a01"] * y)
+            + a["a02"] * (1 + a["a05"] * x)
+            - a["a04"] * y
+        )
+        A1 = (
+            (-a["a10"] + a["a14"] * x)
+            * np.exp(-a["a11"] * y / (1 + a["a15"] * y))
+            + a["a12"]
+        ) * (1 + x * a["a13"])
+        A2 = (
+            a["a20"] * (1 + a["a23"] * x) * np.exp(-a["a21"] * y)
+            + a["a22"]
+            - a["a24"] * y
+        )
+        A3 = (
+            a["a30"] * np.exp(-a["a31"] * y)
+            + a["a32"]
+            - a["a33"] * y
+            + a["a34"] * x
+        )
+        B0 = (
+            (b["b00"] - b["b01"] / (b["b02"] * y + x - 0.13))
+            * (b["b03"] - y)
+            * np.exp(-b["b04"] * y)
+            - b["b05"] * x * y
+            + b["b06"]
+        )
+        B1 = b["b10"] * (x + b["b11"]) + b["b12"] * y
+        B2 = (
+            b["b20"]
+            * (1 - b["b26"] * x)
+            * np.exp(-b["b21"] * y * (1 - x * b["b24"]))
+            + b["b22"]
+            - b["b25"] * y
+        ) * (2 + x * b["b23"])
+        B3 = (
+            (-b["b30"] + b["b34"] * x)
+            * np.exp(-b["b31"] * y / (1 + b["b35"] * x + b["b36"] * y))
+            + b["b32"]
+        ) * (2 + x * b["b33"])
+
+        near = A0 * (np.exp(-A1 * r)) + A2 * np.exp(-A3 * r)
+        far = B0 * (np.exp(-B1 * r)) + B2 * np.exp(-B3 * r)
+        weights = np.where(r < 50, near, far)
+        weights = np.where(r <= 1, near * (1 - np.exp(-3.7 * r)), weights)
+    return np.where(np.isnan(r), np.nan, weights)
+
+
+class CalibrationSamples:
+    """
+    Soil samples of the calibration days as arrays of profiles ×
+    depths, padded with NaN depths.
+
+    Parameters
+    ----------
+    data_frame : pd.DataFrame
+        Samples, as read from the calibration CSV
+    config : CalibrationConfiguration
+        Column names and date format, see calibration_config()
+
+    Attributes
+    ----------
+    days : pd.DatetimeIndex
+        Calibration days in time order
+    day : np.ndarray
+        Day of every profile, positions in days
+    distance, depth, total_volumetric, total_gravimetric : np.ndarray
+        Distance of the profiles and depth and total soil moisture of
+        their samples
+    site_bulk_density, site_lattice_water, site_organic_carbon : float
+        Averages of all samples
+    """
+
+    def __init__(self, data_frame, config):
+        data_frame = data_frame.copy()
+        time_column = config.calib_data_date_time_column_name
+        data_frame[time_column] = pd.to_datetime(
+            data_frame[time_column],
+            utc=True,
+            dayfirst=True,
+            format=config.calib_data_date_time_format,
+        )
+        self.site_bulk_density = data_frame[
+            config.bulk_density_of_sample_column
+        ].mean()
+        self.site_lattice_water = data_frame[
+            config.lattice_water_column
+        ].mean()
+        self.site_organic_carbon = data_frame[
+            config.soil_organic_carbon_column
+        ].mean()
+        if np.isnan(self.site_lattice_water):
+            self.site_lattice_water = 0
+        if np.isnan(self.site_organic_carbon):
+            self.site_organic_carbon = 0
+
+        # one profile per day and profile id, in this order
+        data_frame = data_frame.sort_values(
+            [time_column, config.profile_id_column], kind="stable"
+        )
+        keys = [time_column, config.profile_id_column]
+        profile = data_frame.groupby(keys, sort=True).ngroup().to_numpy()
+        first = np.flatnonzero(np.r_[True, profile[1:] != profile[:-1]])
+        sizes = np.diff(np.r_[first, len(profile)])
+        position = np.arange(len(profile)) - np.repeat(first, sizes)
+
+        self.days = pd.DatetimeIndex(
+            data_frame[time_column].iloc[first].unique()
+        )
+        self.day = self.days.get_indexer(data_frame[time_column].iloc[first])
+        self.distance = (
+            data_frame.groupby(keys, sort=True)[config.distance_column]
+            .median()
+            .to_numpy(dtype="float64")
+        )
+        shape = (len(first), sizes.max())
+        self.depth = np.full(shape, np.nan)
+        self.depth[profile, position] = data_frame[
+            config.sample_depth_column
+        ].to_numpy(dtype="float64")
+        gravimetric = np.full(shape, np.nan)
+        gravimetric[profile, position] = data_frame[
+            config.soil_moisture_gravimetric_column
+        ].to_numpy(dtype="float64")
+        # padding gets a weight of 0
+        self.padding = np.ones(shape, dtype=bool)
+        self.padding[profile, position] = False
+
+        self.total_gravimetric = (
+            gravimetric
+            + self.site_lattice_water
+            + self.site_organic_carbon * SOC_WATER
+        )
+        self.total_volumetric = (
+            gravimetric
+            + self.site_lattice_water
+            + self.site_organic_carbon * SOC_WATER
+        ) * self.site_bulk_density
+
+
+def day_means(time_series, days, hours, columns):
+    """
+    Means of columns of the time series in the window of hours around
+    every calibration day, as neptoon's PrepareNeutronCorrectedData.
+
+    Returns
+    -------
+    pd.DataFrame
+        Means of the columns, one row per day
+
+    Raises
+    ------
+    ValueError
+        When there is no data around a calibration day
+    """
+    index = pd.to_datetime(time_series.index, utc=True)
+    order = None
+    if not index.is_monotonic_increasing:
+        order = np.argsort(index, kind="stable")
+        index = index[order]
+    half_window = pd.Timedelta(hours=hours / 2)
+    starts = index.searchsorted(days - half_window, side="left")
+    ends = index.searchsorted(days + half_window, side="right")
+    empty = [str(day) for day, a, b in zip(days, starts, ends) if a == b]
+    if empty:
+        raise ValueError(
+            "No data around the calibration days {:}.".format(", ".join(empty))
+        )
+    values = time_series[list(columns)]
+    if order is not None:
+        values = values.iloc[order]
+    sums = values.to_numpy(dtype="float64")
+    means = [np.nanmean(sums[a:b], axis=0) for a, b in zip(starts, ends)]
+    return pd.DataFrame(means, index=days, columns=list(columns))
+
+
+def field_average_soil_moisture(
+    samples, profiles, group, groups, pressure, humidity, converge_accuracy
+):
+    """
+    Footprint weighted field average soil moisture of groups of
+    profiles, iterated until it converges for each group.
+
+    Parameters
+    ----------
+    samples : CalibrationSamples
+        Samples of all profiles
+    profiles : np.ndarray
+        Positions of the profiles in samples, repeated in bootstraps
+    group : np.ndarray
+        Group of each of profiles, e.g. its calibration day
+    groups : int
+        Number of groups
+    pressure, humidity : np.ndarray
+        Mean air pressure and humidity of each group
+    converge_accuracy : float
+        Relative change of the field average at which it is final
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Volumetric and gravimetric field average of each group
+    """
+    from neptoon.corrections import Schroen2017
+
+    padding = samples.padding[profiles]
+    # padding gets no weight
+    volumetric = np.where(padding, 0.0, samples.total_volumetric[profiles])
+    gravimetric = np.where(padding, 0.0, samples.total_gravimetric[profiles])
+    depth = samples.depth[profiles]
+    bulk_density = samples.site_bulk_density
+
+    # initial estimate: mean of all samples of the group
+    counts = (~padding & ~np.isnan(volumetric)).sum(axis=1)
+    sm_estimate = np.bincount(
+        group, weights=np.nansum(volumetric, axis=1), minlength=groups
+    ) / np.bincount(group, weights=counts, minlength=groups)
+
+    distance = samples.distance[profiles].copy()
+    field = np.full((2, groups), np.nan)
+    active = np.ones(groups, dtype=bool)
+    while active.any():
+        # only the profiles of groups that have not converged yet
+        moving = np.flatnonzero(active[group])
+        moving_group = group[moving]
+        sm_profile = sm_estimate[moving_group]
+        distance[moving] = Schroen2017.rescale_distance(
+            distance=distance[moving],
+            pressure=pressure[moving_group],
+            soil_moisture=sm_profile,
+        )
+        # neptoon's vertical_weighting() takes the default distance
+        d86 = Schroen2017.calculate_measurement_depth(
+            distance=1.0,
+            bulk_density=bulk_density,
+            soil_moisture=sm_profile,
+        )
+        vertical = np.exp(-2 * depth[moving] / d86[:, None])
+        vertical[padding[moving]] = 0
+        scale = vertical.sum(axis=1)
+        profile_averages = (
+            (volumetric[moving] * vertical).sum(axis=1) / scale,
+            (gravimetric[moving] * vertical).sum(axis=1) / scale,
+        )
+        horizontal = horizontal_weights(
+            distance[moving], profile_averages[0], humidity[moving_group]
+        )
+
+        # like np.ma.average(), profiles without a weight or a value are
+        # left out of both sums
+        averages = np.full((2, groups), np.nan)
+        for average, profile_average in zip(averages, profile_averages):
+            valid = ~np.isnan(horizontal) & ~np.isnan(profile_average)
+            total, weights = (
+                np.bincount(
+                    moving_group,
+                    weights=np.where(valid, values, 0),
+                    minlength=groups,
+                )
+                for values in (profile_average * horizontal, horizontal)
+            )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                average[active] = (total / weights)[active]
+
+        field[:, active] = averages[:, active]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            accuracy = np.abs((averages[0] - sm_estimate) / sm_estimate)
+        active &= accuracy > converge_accuracy
+        sm_estimate[active] = averages[0][active]
+    return field[0], field[1]
+
+
+def optimal_n0(neutrons, gravimetric):
+    """
+    Integer N0 between the mean neutrons and 2.5 times them for which
+    the Desilets equation gives the gravimetric soil moisture best,
+    for all days at once, as neptoon's iteration style search.
+
+    Parameters
+    ----------
+    neutrons, gravimetric : np.ndarray
+        Mean corrected neutrons and field average gravimetric soil
+        moisture of each day
+
+    Returns
+    -------
+    tuple of np.ndarray
+        N0 and absolute error of each day
+    """
+    from neptoon.corrections import neutrons_to_grav_sm_desilets
+
+    neutrons = np.asarray(neutrons, dtype="float64")
+    first = neutrons.astype("int64")
+    stop = (neutrons * 2.5).astype("int64")
+    candidates = first[:, None] + np.arange(max(1, (stop - first).max()))
+    error = np.abs(
+        neutrons_to_grav_sm_desilets(neutrons=neutrons[:, None], n0=candidates)
+        - np.asarray(gravimetric, dtype="float64")[:, None]
+    )
+    error[(candidates >= stop[:, None]) | np.isnan(error)] = np.inf
+    best = np.argmin(error, axis=1)
+    rows = np.arange(len(neutrons))
+    return candidates[rows, best], error[rows, best]
+
+
+def calibration_config(sensor_config):
+    """CalibrationConfiguration of the sensor YAML, as neptoon builds it."""
+    from neptoon.calibration import CalibrationConfiguration
+
+    calibration = sensor_config.calibration
+    names = calibration.key_column_names
+    return CalibrationConfiguration(
+        calib_data_date_time_column_name=names.date_time,
+        calib_data_date_time_format=calibration.date_time_format,
+        profile_id_column=names.profile_id,
+        distance_column=names.radial_distance_from_sensor,
+        sample_depth_column=names.sample_depth,
+        soil_moisture_gravimetric_column=names.gravimetric_soil_moisture,
+        bulk_density_of_sample_column=names.bulk_density_of_sample,
+        soil_organic_carbon_column=names.soil_organic_carbon,
+        lattice_water_column=names.lattice_water,
+    )
+
+
+class FastCalibrator:
+    """
+    Vectorized replacement of neptoon's CalibrationStation.
+
+    Parameters
+    ----------
+    calibration_data : pd.DataFrame
+        Soil samples
+    time_series_data : pd.DataFrame
+        crns_data_frame with the corrected neutrons
+    config : CalibrationConfiguration
+        See calibration_config()
+
+    Examples
+    --------
+    >>> calibrator = FastCalibrator(samples, data_hub.crns_data_frame, config)
+    >>> calibrator.find_n0_value()
+    >>> calibrator.bootstrap(1000, seed=1)
+    """
+
+    def __init__(self, calibration_data, time_series_data, config):
+        self.config = config
+        self.samples = CalibrationSamples(calibration_data, config)
+        self.means = day_means(
+            time_series_data,
+            self.samples.days,
+            config.hours_of_data_around_calib,
+            (
+                config.neutron_column_name,
+                config.air_humidity_column_name,
+                config.air_pressure_column_name,
+            ),
+        )
+        self.results = None
+        self.bootstrap_results = None
+
+    def _solve(self, profiles, group, groups, days):
+        """Field averages and N0 of groups of profiles on days."""
+        config = self.config
+        means = self.means.to_numpy()[days]
+        volumetric, gravimetric = field_average_soil_moisture(
+            self.samples,
+            profiles,
+            group,
+            groups,
+            pressure=means[:, 2],
+            humidity=means[:, 1],
+            converge_accuracy=config.converge_accuracy,
+        )
+        n0, error = optimal_n0(means[:, 0], gravimetric)
+        return volumetric, gravimetric, n0, error
+
+    def find_n0_value(self):
+        """
+        Calibrate on all days.
+
+        Returns
+        -------
+        float
+            Mean N0 of the calibration days
+        """
+        from neptoon.corrections import Schroen2017
+
+        samples = self.samples
+        days = np.arange(len(samples.days))
+        volumetric, gravimetric, n0, error = self._solve(
+            np.arange(len(samples.day)), samples.day, len(days), days
+        )
+        humidity = self.means[self.config.air_humidity_column_name]
+        pressure = self.means[self.config.air_pressure_column_name]
+        footprint = [
+            Schroen2017.calculate_footprint_radius(
+                soil_moisture=v, air_humidity=h, pressure=p
+            )
+            for v, h, p in zip(volumetric, humidity, pressure)
+        ]
+        self.results = pd.DataFrame(
+            dict(
+                calibration_day=samples.days,
+                field_average_soil_moisture_volumetric=volumetric,
+                field_average_soil_moisture_gravimetric=gravimetric,
+                horizontal_footprint_radius_in_meters=footprint,
+                # float, as neptoon returns it
+                optimal_N0=n0.astype("float64"),
+                absolute_error=error,
+            )
+        )
+        return self.results["optimal_N0"].mean()
+
+    def bootstrap(
+        self,
+        replicates=1000,
+        interval=BOOTSTRAP_INTERVAL,
+        seed=None,
+        workers=None,
+    ):
+        """
+        Confidence interval of N0 from resampling the profiles of every
+        day with replacement.
+
+        Parameters
+        ----------
+        replicates : int, optional
+            Number of resamplings
+        interval : tuple of float, optional
+            Percentiles of the interval
+        seed : int, optional
+            Seed of the resampling
+        workers : int, optional
+            Threads solving chunks of the replicates, by default one per
+            CPU up to 8
+
+        Returns
+        -------
+        dict
+            N0 of the replicates as n0, and the interval as low and high
+        """
+        samples = self.samples
+        days = len(samples.days)
+        rng = np.random.default_rng(seed)
+        members = [np.flatnonzero(samples.day == d) for d in range(days)]
+        # profiles of all replicates, drawn up front so that the result
+        # does not depend on the number of workers
+        draws = np.concatenate(
+            [
+                m[rng.integers(0, len(m), (replicates, len(m)))]
+                for m in members
+            ],
+            axis=1,
+        )
+        day_of_draw = np.concatenate(
+            [np.full(len(m), d) for d, m in enumerate(members)]
+        )
+
+        def solve(chunk):
+            count = len(chunk)
+            profiles = draws[chunk].ravel()
+            group = (
+                np.arange(count)[:, None] * days + day_of_draw[None, :]
+            ).ravel()
+            n0 = self._solve(
+                profiles, group, count * days, np.tile(np.arange(days), count)
+            )[2]
+            return n0.reshape(count, days).mean(axis=1)
+
+        workers = workers or min(8, os.cpu_count() or 1)
+        chunks = np.array_split(
+            np.arange(replicates),
+            max(workers, -(-replicates // BOOTSTRAP_CHUNK)),
+        )
+        chunks = [chunk for chunk in chunks if len(chunk)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            n0 = np.concatenate(list(pool.map(solve, chunks)))
+        low, high = np.percentile(n0, interval)
+        self.bootstrap_results = dict(
+            n0=n0, low=float(low), high=float(high), interval=interval
+        )
+        return self.bootstrap_results
+
+    def return_calibration_results_data_frame(self):
+        return self.results
+
+
+def calibrate(process, bootstrap=0, seed=None):
+    """
+    Replacement for ProcessWithYaml._calibrate_data().
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor with corrected neutrons
+    bootstrap : int, optional
+        Replicates of the bootstrap of N0, by default none
+    seed : int, optional
+        Seed of the bootstrap
+
+    Returns
+    -------
+    FastCalibrator
+        Also kept as process.data_hub.calibrator
+    """
+    from magazine import Magazine
+    from neptoon.utils.general_utils import validate_and_convert_file_path
+
+    sensor_config = process.sensor_config
+    path = validate_and_convert_file_path(
+        file_path=sensor_config.calibration.location
+    )
+    hub = process.data_hub
+    hub.calibration_samples_data = pd.read_csv(path)
+    calibrator = FastCalibrator(
+        hub.calibration_samples_data,
+        hub.crns_data_frame,
+        calibration_config(sensor_config),
+    )
+    n0 = int(calibrator.find_n0_value())
+    if bootstrap:
+        calibrator.bootstrap(bootstrap, seed=seed)
+    hub.calibrator = calibrator
+
+    # rounded as neptoon does
+    samples = calibrator.samples
+    sensor_info = hub.sensor_info
+    sensor_info.N0 = n0
+    sensor_info.avg_dry_soil_bulk_density = round(samples.site_bulk_density, 4)
+    sensor_info.avg_soil_organic_carbon = round(samples.site_organic_carbon, 4)
+    sensor_info.avg_lattice_water = round(samples.site_lattice_water)
+    sensor_config.sensor_info.N0 = n0
+    hub.crns_data_frame["N0"] = n0
+    Magazine.report(
+        "Calibration",
+        "Calibration was undertaken. The N0 number was calculated as {:}. "
+        "From the samples, the average dry soil bulk density is {:}, the "
+        "average soil organic carbon is {:}, and the average lattice water "
+        "content is {:}.",
+        n0,
+        sensor_info.avg_dry_soil_bulk_density,
+        sensor_info.avg_soil_organic_carbon,
+        sensor_info.avg_lattice_water,
+    )
+    return calibrator
+
+
+def use_fast_calibration(process):
+    """Let ProcessWithYaml.run_full_process() use calibrate()."""
+    process._calibrate_data = lambda: calibrate(process)
+    return process
+
+
+class NeutronLookup:
+    """
+    Means of the time series in a window around any time, from the
+    sorted times and cumulative sums of the values.
+
+    Parameters
+    ----------
+    time_series_data : pd.DataFrame
+        crns_data_frame with the corrected neutrons, not copied
+    hours : float, optional
+        Width of the window, by default that of neptoon's calibration
+    columns : sequence of str, optional
+        Columns to average, by default the corrected neutrons, the air
+        humidity and the air pressure
+
+    Examples
+    --------
+    >>> lookup = NeutronLookup(data_hub.crns_data_frame)
+    >>> means, counts = lookup.means(pd.Timestamp("2014-01-17 12:00"))
+    >>> neutrons, humidity, pressure = means[0]
+    """
+
+    def __init__(self, time_series_data, hours=6, columns=None):
+        from neptoon.columns import ColumnInfo
+
+        name = ColumnInfo.Name
+        self.data_frame = time_series_data
+        self.hours = hours
+        self.columns = list(
+            columns
+            or (
+                str(name.CORRECTED_EPI_NEUTRON_COUNT_FINAL),
+                str(name.AIR_RELATIVE_HUMIDITY),
+                str(name.AIR_PRESSURE),
+            )
+        )
+        index = pd.to_datetime(time_series_data.index, utc=True)
+        # in ns, whatever the resolution of the index
+        times = index.as_unit("ns").asi8
+        order = np.argsort(times, kind="stable")
+        self.times = times[order]
+        values = time_series_data[self.columns].to_numpy(dtype="float64")
+        values = values[order]
+        valid = ~np.isnan(values)
+        # sums and counts of the values before every row
+        zeros = np.zeros((1, len(self.columns)))
+        self._sums = np.vstack(
+            [zeros, np.cumsum(np.where(valid, values, 0), axis=0)]
+        )
+        self._counts = np.vstack([zeros, np.cumsum(valid, axis=0)])
+        self._half_window = pd.Timedelta(hours=hours / 2).value
+
+    def matches(self, data_frame, hours=6):
+        """Whether the lookup is one of this frame and window."""
+        return data_frame is self.data_frame and hours == self.hours
+
+    def _times(self, times):
+        times = pd.DatetimeIndex(
+            pd.to_datetime(np.atleast_1d(times), utc=True)
+        )
+        return times.as_unit("ns").asi8
+
+    def nearest(self, times):
+        """Times of the rows nearest to times."""
+        times = self._times(times)
+        after = np.clip(self.times.searchsorted(times), 1, len(self.times) - 1)
+        before = after - 1
+        closer = np.abs(self.times[before] - times) <= np.abs(
+            self.times[after] - times
+        )
+        nearest = self.times[np.where(closer, before, after)]
+        return pd.to_datetime(nearest, utc=True)
+
+    def means(self, times):
+        """
+        Means of the columns in the window around times, inclusive.
+
+        Returns
+        -------
+        tuple of np.ndarray
+            Means and numbers of values, times × columns, NaN means
+            where the window has no values
+        """
+        times = self._times(times)
+        starts = self.times.searchsorted(times - self._half_window, "left")
+        ends = self.times.searchsorted(times + self._half_window, "right")
+        counts = self._counts[ends] - self._counts[starts]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = (self._sums[ends] - self._sums[starts]) / counts
+        return means, counts.astype("int64")
+
+
+def single_value_n0(
+    neutrons,
+    soil_moisture,
+    dry_soil_bulk_density=None,
+    lattice_water=None,
+    soil_organic_carbon=None,
+):
+    """
+    N0 for which the Desilets equation, as in neptoon_gui_soil_moisture,
+    gives the measured volumetric soil moisture from the neutrons.
+    """
+    from neptoon_gui_soil_moisture import DEFAULT_BULK_DENSITY, WSOM_PER_SOC
+
+    a0, a1, a2 = 0.0808, 0.372, 0.115
+    if dry_soil_bulk_density is None:
+        dry_soil_bulk_density = DEFAULT_BULK_DENSITY
+    gravimetric = (
+        np.asarray(soil_moisture, dtype="float64") / dry_soil_bulk_density
+        + (lattice_water or 0)
+        + (soil_organic_carbon or 0) * WSOM_PER_SOC
+    )
+    return neutrons / (a0 / (gravimetric + a2) + a1)
+
+
+class SingleValueCalibrator:
+    """
+    Calibration on one field average soil moisture, with the results
+    frame of the other calibrators.
+
+    Parameters
+    ----------
+    lookup : NeutronLookup
+        Window means of the time series
+    time : datetime
+        Time of the soil moisture measurement
+    soil_moisture : float
+        Field average soil moisture (m³/m³)
+    sensor_info : SensorInfo
+        Bulk density, lattice water and soil organic carbon of the site
+    """
+
+    def __init__(self, lookup, time, soil_moisture, sensor_info):
+        from neptoon.corrections import Schroen2017
+        from neptoon_gui_soil_moisture import (
+            DEFAULT_BULK_DENSITY,
+            WSOM_PER_SOC,
+        )
+
+        means, counts = lookup.means(time)
+        neutrons, humidity, pressure = means[0]
+        if not counts[0, 0]:
+            raise ValueError(
+                "No corrected neutrons within {:g} hours around {:}, the "
+                "nearest are at {:}.".format(
+                    lookup.hours, time, lookup.nearest(time)[0]
+                )
+            )
+        parameters = dict(
+            dry_soil_bulk_density=(
+                sensor_info.avg_dry_soil_bulk_density or DEFAULT_BULK_DENSITY
+            ),
+            lattice_water=sensor_info.avg_lattice_water,
+            soil_organic_carbon=sensor_info.avg_soil_organic_carbon,
+        )
+        self.n0 = float(single_value_n0(neutrons, soil_moisture, **parameters))
+        self.neutrons = neutrons
+        self.values = int(counts[0, 0])
+        self.results = pd.DataFrame(
+            dict(
+                calibration_day=pd.to_datetime([time], utc=True),
+                field_average_soil_moisture_volumetric=[soil_moisture],
+                field_average_soil_moisture_gravimetric=[
+                    soil_moisture / parameters["dry_soil_bulk_density"]
+                    + (parameters["lattice_water"] or 0)
+                    + (parameters["soil_organic_carbon"] or 0) * WSOM_PER_SOC
+                ],
+                horizontal_footprint_radius_in_meters=[
+                    Schroen2017.calculate_footprint_radius(
+                        soil_moisture=soil_moisture,
+                        air_humidity=humidity,
+                        pressure=pressure,
+                    )
+                ],
+                optimal_N0=[round(self.n0)],
+                absolute_error=[0.0],
+            )
+        )
+
+    def return_calibration_results_data_frame(self):
+        return self.results
+
+
+def calibrate_single_value(process, time, soil_moisture, lookup=None):
+    """
+    Set N0 from one field average soil moisture.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor with corrected neutrons
+    time : datetime
+        Time of the measurement, naive times are taken as UTC
+    soil_moisture : float
+        Field average soil moisture (m³/m³)
+    lookup : NeutronLookup, optional
+        Lookup of process.data_hub.crns_data_frame, by default built
+
+    Returns
+    -------
+    SingleValueCalibrator
+        Also kept as process.data_hub.calibrator
+    """
+    from magazine import Magazine
+
+    hub = process.data_hub
+    if lookup is None or not lookup.matches(hub.crns_data_frame, lookup.hours):
+        lookup = NeutronLookup(hub.crns_data_frame)
+    calibrator = SingleValueCalibrator(
+        lookup, time, soil_moisture, process.sensor_config.sensor_info
+    )
+    n0 = round(calibrator.n0)
+    hub.calibrator = calibrator
+    hub.sensor_info.N0 = n0
+    process.sensor_config.sensor_info.N0 = n0
+    hub.crns_data_frame["N0"] = n0
+    Magazine.report(
+        "Calibration",
+        "Calibration was undertaken on a field average soil moisture of {:} "
+        "at {:}. The N0 number was calculated as {:}.",
+        soil_moisture,
+        time,
+        n0,
+    )
+    return calibrator
@@ -0,0 +1,386 @@
+"""
+Checkpoints of the processing state of a session.
+
+The state of a session is its processor, st.session_state["yaml"], and
+the flags of the steps done so far. A checkpoint keeps the frames of the
+data hub as Arrow IPC files (compressed, with the flag strings stored as
+dictionaries), the sensor and processing configs as YAML, as edited in
+the app and including the calibration results, and the flags and file
+selections as JSON. Restoring reads the frames memory-mapped, which is
+much faster than reading and processing the data again.
+
+A checkpoint is written into a temporary folder that replaces the
+previous one, so that an interrupted save leaves the previous checkpoint
+intact. The app calls restore_session() when a session starts and
+checkpoint_session() after every rerun.
+"""
+
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import streamlit as st
+
+STATE_FILE = "state.json"
+SENSOR_FILE = "sensor_config.yaml"
+PROCESS_FILE = "process_config.yaml"
+CALIBRATION_FILE = "calibration_results.arrow"
+
+# frames of the data hub that are kept
+FRAMES = ("crns_data_frame", "flags_data_frame", "calibration_samples_data")
+
+CHECKPOINT_VERSION = 1
+
+
+def default_checkpoint_dir():
+    """Checkpoints inside the neptoon cache directory."""
+    from neptoon.config.global_configuration import GlobalConfig
+
+    return GlobalConfig.get_cache_dir() / "sessions"
+
+
+def new_checkpoint_id():
+    return uuid.uuid4().hex
+
+
+def valid_checkpoint_id(checkpoint_id):
+    """Whether an ID, e.g. from the URL, is safe to use as folder name."""
+    return isinstance(checkpoint_id, str) and bool(
+        re.fullmatch("[0-9a-f]{32}", checkpoint_id)
+    )
+
+
+class RestoredCalibrator:
+    """
+    Stand-in for the CalibrationStation of a restored data hub, which
+    only provides its results.
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    def return_calibration_results_data_frame(self):
+        return self.results
+
+
+def _write_frame(data_frame, path):
+    """
+    Write a frame as Arrow IPC with its index.
+
+    Returns
+    -------
+    list of str
+        Columns of dtype object, stored as dictionaries
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    objects = [c for c, t in data_frame.dtypes.items() if t == object]
+    packed = data_frame.astype({c: "category" for c in objects})
+    table = pa.Table.from_pandas(packed, preserve_index=True)
+    feather.write_feather(table, path, compression="lz4")
+    return objects
+
+
+def _read_frame(path, objects=()):
+    import pyarrow.feather as feather
+
+    data_frame = feather.read_table(path, memory_map=True).to_pandas()
+    return data_frame.astype({c: object for c in objects})
+
+
+def _write_config(config, path):
+    """Same YAML as neptoon's YamlSaver."""
+    import yaml
+
+    data = json.loads(config.model_dump_json())
+    Path(path).write_text(
+        yaml.safe_dump(
+            data,
+            default_flow_style=False,
+            allow_unicode=True,
+            sort_keys=False,
+            indent=2,
+        )
+    )
+
+
+def _session_values(session):
+    """Split session values into JSON values and paths, skip others."""
+    values, paths = {}, {}
+    for key, value in session.items():
+        if isinstance(value, Path):
+            paths[key] = str(value)
+        elif value is None or isinstance(value, (bool, int, float, str)):
+            values[key] = value
+    return values, paths
+
+
+def save_checkpoint(folder, process, session=None):
+    """
+    Write the state of a session.
+
+    Parameters
+    ----------
+    folder : Path
+        Folder of the checkpoint, replaced if it exists
+    process : ProcessWithYaml
+        Processor of the session
+    session : dict, optional
+        Flags and file selections of the session. Values other than
+        paths and plain JSON values, e.g. uploaded files, are left out.
+
+    Returns
+    -------
+    int
+        Bytes written
+    """
+    folder = Path(folder)
+    tmp = folder.with_name(folder.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    _write_config(process.sensor_config, tmp / SENSOR_FILE)
+    _write_config(process.process_config, tmp / PROCESS_FILE)
+
+    hub = process.data_hub
+    frames = {}
+    for name in FRAMES:
+        data_frame = getattr(hub, name, None)
+        if isinstance(data_frame, pd.DataFrame):
+            frames[name] = _write_frame(data_frame, tmp / (name + ".arrow"))
+    calibrator = getattr(hub, "calibrator", None)
+    if calibrator is not None:
+        _write_frame(
+            calibrator.return_calibration_results_data_frame(),
+            tmp / CALIBRATION_FILE,
+        )
+
+    values, paths = _session_values(session or {})
+    state = dict(
+        version=CHECKPOINT_VERSION,
+        saved=datetime.now().isoformat(timespec="seconds"),
+        frames=frames,
+        calibrator=calibrator is not None,
+        raw_data_parse_extras=getattr(
+            process.sensor_config, "raw_data_parse_extras", None
+        ),
+        session=values,
+        paths=paths,
+    )
+    with open(tmp / STATE_FILE, "w") as file:
+        json.dump(state, file, indent=1, default=str)
+
+    old = folder.with_name(folder.name + ".old")
+    if folder.exists():
+        os.replace(folder, old)
+    os.replace(tmp, folder)
+    shutil.rmtree(old, ignore_errors=True)
+    return sum(path.stat().st_size for path in folder.iterdir())
+
+
+def checkpoint_state(folder):
+    """State of a checkpoint, None if there is none."""
+    folder = Path(folder)
+    if not (folder / STATE_FILE).is_file():
+        # a save was interrupted after moving the previous one away
+        folder = folder.with_name(folder.name + ".old")
+    path = folder / STATE_FILE
+    if not path.is_file():
+        return None
+    with open(path) as file:
+        state = json.load(file)
+    if state.get("version") != CHECKPOINT_VERSION:
+        return None
+    state["folder"] = str(folder)
+    return state
+
+
+def load_checkpoint(folder):
+    """
+    Restore the state of a session.
+
+    Parameters
+    ----------
+    folder : Path
+        Folder of the checkpoint
+
+    Returns
+    -------
+    tuple or None
+        The processor with its data hub, and the session values with
+        the paths of files that still exist. None if there is no
+        checkpoint.
+    """
+    from neptoon.hub import CRNSDataHub
+    from neptoon.io.read import ConfigurationManager
+    from neptoon.workflow import ProcessWithYaml
+
+    state = checkpoint_state(folder)
+    if state is None:
+        return None
+    folder = Path(state["folder"])
+
+    config = ConfigurationManager()
+    config.load_configuration(file_path=folder / SENSOR_FILE)
+    config.load_configuration(file_path=folder / PROCESS_FILE)
+    process = ProcessWithYaml(configuration_object=config)
+    if state["raw_data_parse_extras"] is not None:
+        process.sensor_config.raw_data_parse_extras = state[
+            "raw_data_parse_extras"
+        ]
+    process.stage_outputs = {}
+
+    frames = {
+        name: _read_frame(folder / (name + ".arrow"), objects)
+        for name, objects in state["frames"].items()
+    }
+    if "crns_data_frame" in frames:
+        process.data_hub = CRNSDataHub(
+            crns_data_frame=frames["crns_data_frame"],
+            sensor_info=process.sensor_config.sensor_info,
+        )
+        process.data_hub.flags_data_frame = frames.get("flags_data_frame")
+        if "calibration_samples_data" in frames:
+            process.data_hub.calibration_samples_data = frames[
+                "calibration_samples_data"
+            ]
+        if state["calibrator"]:
+            process.data_hub.calibrator = RestoredCalibrator(
+                _read_frame(folder / CALIBRATION_FILE)
+            )
+
+    session = dict(state["session"])
+    for key, value in state["paths"].items():
+        session[key] = Path(value) if Path(value).exists() else None
+    return process, session
+
+
+def prune_checkpoints(folder, max_age_days=7):
+    """Remove checkpoints not saved for max_age_days."""
+    folder = Path(folder)
+    if not folder.is_dir():
+        return
+    limit = time.time() - max_age_days * 86400
+    for path in folder.iterdir():
+        if path.is_dir() and path.stat().st_mtime < limit:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def checkpoints_enabled():
+    return os.environ.get("NEPTOON_GUI_CHECKPOINTS", "1") != "0"
+
+
+@st.cache_resource
+def get_checkpoint_dir():
+    """
+    Folder of the session checkpoints, set with
+    NEPTOON_GUI_CHECKPOINT_DIR (default in the neptoon cache).
+    Checkpoints older than NEPTOON_GUI_CHECKPOINT_DAYS (default 7) are
+    removed when the server starts.
+    """
+    folder = os.environ.get("NEPTOON_GUI_CHECKPOINT_DIR")
+    folder = Path(folder) if folder else default_checkpoint_dir()
+    prune_checkpoints(
+        folder, float(os.environ.get("NEPTOON_GUI_CHECKPOINT_DAYS", 7))
+    )
+    return folder
+
+
+def restore_session():
+    """
+    Give a new session its checkpoint ID, which is kept in the URL
+    (?session=...), and restore the checkpoint of an ID from the URL,
+    e.g. after a browser refresh or a server restart.
+
+    Returns
+    -------
+    str or None
+        Time the restored checkpoint was saved, None if nothing was
+        restored
+    """
+    if "checkpoint_id" in st.session_state or not checkpoints_enabled():
+        return None
+    checkpoint_id = st.query_params.get("session")
+    if not valid_checkpoint_id(checkpoint_id):
+        checkpoint_id = new_checkpoint_id()
+    st.session_state["checkpoint_id"] = checkpoint_id
+    st.session_state["checkpoint_saved"] = None
+    st.query_params["session"] = checkpoint_id
+
+    folder = get_checkpoint_dir() / checkpoint_id
+    state = checkpoint_state(folder)
+    if state is None:
+        return None
+
+    from neptoon_gui_imports import activate_magazine
+
+    activate_magazine()
+    with st.spinner("Restoring the session..."):
+        process, session = load_checkpoint(folder)
+    st.session_state["yaml"] = process
+    for key, value in session.items():
+        st.session_state[key] = value
+    st.session_state["checkpoint_saved"] = _checkpoint_signature(
+        session.keys()
+    )
+    return state["saved"]
+
+
+def _checkpoint_signature(keys):
+    """
+    Cheap signature of the session state. Frames are compared by
+    identity and shape, the stages replace them rather than changing
+    their values in place.
+    """
+    from neptoon_gui_stages import config_fingerprint
+
+    process = st.session_state.get("yaml")
+    if process is None:
+        return None
+    hub = process.data_hub
+    frames = [
+        (id(frame), frame.shape, tuple(frame.columns))
+        for frame in (
+            getattr(hub, name, None)
+            for name in ("crns_data_frame", "flags_data_frame")
+        )
+        if frame is not None
+    ]
+    return (
+        id(process),
+        id(hub),
+        id(getattr(hub, "calibrator", None)),
+        tuple(frames),
+        config_fingerprint(process.sensor_config, process.process_config),
+        tuple(repr(st.session_state.get(key)) for key in keys),
+    )
+
+
+def checkpoint_session(keys):
+    """
+    Save the session state, i.e. the processor and the session values
+    of keys, if it changed since the last checkpoint.
+    """
+    checkpoint_id = st.session_state.get("checkpoint_id")
+    if checkpoint_id is None or not checkpoints_enabled():
+        return
+    # multipage navigation drops the query parameters
+    if st.query_params.get("session") != checkpoint_id:
+        st.query_params["session"] = checkpoint_id
+
+    signature = _checkpoint_signature(keys)
+    if signature is None or signature == st.session_state["checkpoint_saved"]:
+        return
+    save_checkpoint(
+        get_checkpoint_dir() / checkpoint_id,
+        st.session_state["yaml"],
+        {key: st.session_state.get(key) for key in keys},
+    )
+    st.session_state["checkpoint_saved"] = signature
@@ -0,0 +1,170 @@
+"""
+Compact dtypes for the frames of a data hub.
+
+Over the processing, crns_data_frame collects dozens of float64 columns
+and the static sensor values, repeated in every row, while
+flags_data_frame holds one string per cell. Here float columns are
+downcast to float32 where the round trip stays within a relative
+tolerance, integers to int32, and repeated strings (the flags, the
+sensor name, ...) are stored as categoricals, i.e. one byte per cell
+plus the few distinct strings. pandas operations and comparisons such
+as flags == "UNFLAGGED" keep working on the compact frames.
+"""
+
+import numpy as np
+import pandas as pd
+
+# largest relative error allowed when downcasting to float32
+FLOAT_RTOL = 1e-6
+
+
+def frame_bytes(data_frame):
+    """Memory used by a frame including its index, 0 for None."""
+    if data_frame is None:
+        return 0
+    return int(data_frame.memory_usage(deep=True, index=True).sum())
+
+
+def _fits_float32(values, rtol):
+    with np.errstate(over="ignore", invalid="ignore"):
+        compact = values.astype("float32")
+        error = np.abs(compact.astype("float64") - values)
+        allowed = rtol * np.abs(values)
+    finite = np.isfinite(values)
+    return bool(
+        np.array_equal(np.isfinite(compact), finite)
+        and (error[finite] <= allowed[finite]).all()
+    )
+
+
+def compact_dtypes(data_frame, rtol=FLOAT_RTOL, max_category_share=0.5):
+    """
+    Compact dtypes for the columns of a frame.
+
+    Parameters
+    ----------
+    data_frame : pd.DataFrame
+        Frame to compact
+    rtol : float, optional
+        Largest relative error of a float column downcast to float32,
+        by default FLOAT_RTOL
+    max_category_share : float, optional
+        Object columns with fewer distinct values than this share of
+        the rows become categoricals, by default 0.5
+
+    Returns
+    -------
+    dict
+        New dtypes of the columns that can be compacted
+    """
+    dtypes = {}
+    for column, dtype in data_frame.dtypes.items():
+        if dtype == "float64":
+            values = data_frame[column].to_numpy()
+            if _fits_float32(values, rtol):
+                dtypes[column] = "float32"
+        elif dtype == "int64":
+            values = data_frame[column].to_numpy()
+            limits = np.iinfo("int32")
+            if not len(values) or (
+                values.min() >= limits.min and values.max() <= limits.max
+            ):
+                dtypes[column] = "int32"
+        elif dtype == object:
+            unique = data_frame[column].nunique(dropna=False)
+            if unique <= max_category_share * max(len(data_frame), 1):
+                dtypes[column] = "category"
+    return dtypes
+
+
+def compact_frame(data_frame, **kwargs):
+    """
+    Copy of a frame with compact dtypes, see compact_dtypes().
+
+    Returns
+    -------
+    pd.DataFrame
+        The compact frame, or data_frame itself if nothing changed
+    """
+    if data_frame is None:
+        return None
+    dtypes = compact_dtypes(data_frame, **kwargs)
+    if not dtypes:
+        return data_frame
+    return data_frame.astype(dtypes)
+
+
+def compact_hub(data_hub, **kwargs):
+    """
+    Compact crns_data_frame and flags_data_frame of a data hub.
+
+    Parameters
+    ----------
+    data_hub : CRNSDataHub
+        Data hub, changed in place
+    **kwargs
+        Passed to compact_dtypes()
+
+    Returns
+    -------
+    tuple of int
+        Bytes used by both frames before and after
+    """
+    before = after = 0
+    for name in ("crns_data_frame", "flags_data_frame"):
+        data_frame = getattr(data_hub, name)
+        compact = compact_frame(data_frame, **kwargs)
+        before += frame_bytes(data_frame)
+        after += frame_bytes(compact)
+        if compact is not data_frame:
+            setattr(data_hub, name, compact)
+    return before, after
+
+
+def hub_key(data_hub):
+    """
+    Cheap key of the frames of a data hub, which changes when a frame
+    is replaced or gains or loses rows or columns.
+    """
+    key = []
+    for name in ("crns_data_frame", "flags_data_frame"):
+        data_frame = getattr(data_hub, name, None)
+        if data_frame is None:
+            key.append(None)
+        else:
+            key.append(
+                (id(data_frame), data_frame.shape, tuple(data_frame.dtypes))
+            )
+    return tuple(key)
+
+
+def memory_report(data_hub):
+    """
+    Memory used per column of the frames of a data hub.
+
+    Returns
+    -------
+    pd.DataFrame
+        frame, column, dtype and MB, largest first
+    """
+    rows = []
+    for name in ("crns_data_frame", "flags_data_frame"):
+        data_frame = getattr(data_hub, name, None)
+        if data_frame is None:
+            continue
+        usage = data_frame.memory_usage(deep=True, index=True)
+        for column, used in usage.items():
+            rows.append(
+                dict(
+                    frame=name,
+                    column=column,
+                    dtype=str(
+                        data_frame.index.dtype
+                        if column == "Index"
+                        else data_frame.dtypes[column]
+                    ),
+                    MB=used / 2**20,
+                )
+            )
+    report = pd.DataFrame(rows, columns=["frame", "column", "dtype", "MB"])
+    return report.sort_values("MB", ascending=False, ignore_index=True)
@@ -0,0 +1,256 @@
+"""
+Fused neutron correction kernel.
+
+neptoon applies every correction with row-wise DataFrame.apply() calls
+and multiplies the factor columns afterwards. Here the pressure,
+humidity and incoming intensity factors and the corrected epithermal
+neutrons are computed in one pass over float64 arrays, using the same
+formulas from neptoon.corrections. The factor columns (and the
+intermediate columns neptoon writes, such as the absolute humidity) can
+be left out of the frame.
+
+Corrections are given as (correction type, theory) pairs with the
+values of neptoon's CorrectionType and CorrectionTheory, or the enums
+themselves. A theory of None selects neptoon's default.
+"""
+
+import numpy as np
+
+# corrections of the "Make corrections" step, in the order in which
+# neptoon multiplies them after they are selected there
+GUI_CORRECTIONS = (
+    ("incoming_intensity", "hawdon_2014"),
+    ("humidity", "rosolem_2013"),
+    ("pressure", None),
+)
+
+SUPPORTED = dict(
+    pressure=(None, "zreda_2012"),
+    humidity=(None, "rosolem_2013"),
+    incoming_intensity=(None, "hawdon_2014", "zreda_2012"),
+)
+
+
+def _missing(data_frame, column):
+    return column not in data_frame or data_frame[column].isnull().all()
+
+
+def _values(data_frame, column):
+    """Column as contiguous float64 array, without a copy if possible."""
+    if _missing(data_frame, column):
+        raise ValueError(
+            "Required column is missing or empty: {:}".format(column)
+        )
+    return np.ascontiguousarray(data_frame[column].to_numpy(dtype="float64"))
+
+
+def pressure_factor(data_frame, columns):
+    """Zreda et al. (2012) pressure factor, as neptoon computes it."""
+    from neptoon.columns import ColumnInfo
+    from neptoon.corrections import calc_beta_coefficient, calc_mean_pressure
+
+    name = ColumnInfo.Name
+    factor_column = str(name.PRESSURE_CORRECTION)
+    if not _missing(data_frame, factor_column):
+        # neptoon does not overwrite an existing factor either
+        return _values(data_frame, factor_column)
+
+    if _missing(data_frame, str(name.MEAN_PRESSURE)):
+        mean_pressure = calc_mean_pressure(
+            _values(data_frame, str(name.ELEVATION))
+        )
+        columns[str(name.MEAN_PRESSURE)] = mean_pressure
+    else:
+        mean_pressure = _values(data_frame, str(name.MEAN_PRESSURE))
+
+    if _missing(data_frame, str(name.BETA_COEFFICIENT)):
+        beta = calc_beta_coefficient(
+            mean_pressure,
+            _values(data_frame, str(name.LATITUDE)),
+            _values(data_frame, str(name.ELEVATION)),
+            _values(data_frame, str(name.SITE_CUTOFF_RIGIDITY)),
+        )
+        columns[str(name.BETA_COEFFICIENT)] = beta
+    else:
+        beta = _values(data_frame, str(name.BETA_COEFFICIENT))
+
+    if np.nanmax(beta) >= 1:
+        raise ValueError(
+            "The beta_coeff is > 1 which suggests "
+            "the incorrect function is being used. "
+            "Use pressure_correction_l_coeff() instead"
+        )
+    pressure = _values(data_frame, str(name.AIR_PRESSURE))
+    factor = np.exp(beta * (pressure - mean_pressure))
+    columns[factor_column] = factor
+    return factor
+
+
+def humidity_factor(data_frame, columns, reference_absolute_humidity=0):
+    """Rosolem et al. (2013) humidity factor."""
+    from neptoon.columns import ColumnInfo
+    from neptoon.corrections import (
+        calc_absolute_humidity,
+        calc_actual_vapour_pressure,
+        calc_saturation_vapour_pressure,
+        humidity_correction_rosolem2013,
+    )
+
+    name = ColumnInfo.Name
+    temperature = _values(data_frame, str(name.AIR_TEMPERATURE))
+    saturation = calc_saturation_vapour_pressure(temperature)
+    actual = calc_actual_vapour_pressure(
+        saturation, _values(data_frame, str(name.AIR_RELATIVE_HUMIDITY))
+    )
+    absolute = calc_absolute_humidity(actual, temperature)
+    factor = humidity_correction_rosolem2013(
+        absolute, reference_absolute_humidity
+    )
+    columns[str(name.SATURATION_VAPOUR_PRESSURE)] = saturation
+    columns[str(name.ACTUAL_VAPOUR_PRESSURE)] = actual
+    columns[str(name.ABSOLUTE_HUMIDITY)] = absolute
+    columns[str(name.HUMIDITY_CORRECTION)] = factor
+    return factor
+
+
+def intensity_factor(data_frame, columns, theory=None):
+    """Hawdon et al. (2014) or Zreda et al. (2012) intensity factor."""
+    from neptoon.columns import ColumnInfo
+    from neptoon.corrections import (
+        incoming_intensity_correction,
+        rc_correction_hawdon,
+    )
+
+    name = ColumnInfo.Name
+    incoming = _values(data_frame, str(name.INCOMING_NEUTRON_INTENSITY))
+    reference = _values(data_frame, str(name.REFERENCE_INCOMING_NEUTRON_VALUE))
+    if theory == "zreda_2012":
+        rc_scaling = 1
+    else:
+        rc_scaling = rc_correction_hawdon(
+            _values(data_frame, str(name.SITE_CUTOFF_RIGIDITY)),
+            _values(data_frame, str(name.REFERENCE_MONITOR_CUTOFF_RIGIDITY)),
+        )
+        columns[str(name.RC_CORRECTION_FACTOR)] = rc_scaling
+    factor = incoming_intensity_correction(incoming, reference, rc_scaling)
+    columns[str(name.INTENSITY_CORRECTION)] = factor
+    return factor
+
+
+def fused_correct_neutrons(
+    data_frame, corrections=GUI_CORRECTIONS, keep_factors=True
+):
+    """
+    Compute the correction factors and the corrected epithermal
+    neutrons in one pass.
+
+    Parameters
+    ----------
+    data_frame : pd.DataFrame
+        crns_data_frame with the static values and NMDB data attached,
+        the columns are added in place
+    corrections : sequence of tuple, optional
+        (correction type, theory) pairs in the order of multiplication,
+        by default those of the "Make corrections" step
+    keep_factors : bool, optional
+        Write the factor columns and the intermediate columns (e.g.
+        absolute_humidity, rc_correction_factor), by default True. If
+        False, only corrected_epithermal_neutrons is added.
+
+    Returns
+    -------
+    pd.DataFrame
+        The same frame
+
+    Raises
+    ------
+    ValueError
+        When a correction is not supported or a required column is
+        missing
+    """
+    from neptoon.columns import ColumnInfo
+
+    columns = {}
+    corrected = _values(
+        data_frame, str(ColumnInfo.Name.EPI_NEUTRON_COUNT_FINAL)
+    ).copy()
+    for correction_type, theory in corrections:
+        correction_type = getattr(correction_type, "value", correction_type)
+        theory = getattr(theory, "value", theory)
+        if theory not in SUPPORTED.get(correction_type, ()):
+            raise ValueError(
+                "The {:} correction {:} is not supported by the fused "
+                "correction.".format(correction_type, theory)
+            )
+        if correction_type == "pressure":
+            factor = pressure_factor(data_frame, columns)
+        elif correction_type == "humidity":
+            factor = humidity_factor(data_frame, columns)
+        else:
+            factor = intensity_factor(data_frame, columns, theory)
+        corrected *= factor
+
+    if keep_factors:
+        for column, values in columns.items():
+            data_frame[column] = values
+    data_frame[str(ColumnInfo.Name.CORRECTED_EPI_NEUTRON_COUNT)] = corrected
+    return data_frame
+
+
+def corrections_from_config(process_config):
+    """
+    Corrections selected in the processing YAML, in the order of
+    neptoon's CorrectionSelectorWithYaml.
+
+    Returns
+    -------
+    list of tuple or None
+        (correction type, theory) pairs, None if the config selects a
+        correction that the fused kernel does not support
+    """
+    steps = process_config.correction_steps
+    selected = (
+        ("pressure", steps.air_pressure),
+        ("humidity", steps.air_humidity),
+        ("incoming_intensity", steps.incoming_radiation),
+        ("above_ground_biomass", steps.above_ground_biomass),
+    )
+    corrections = []
+    for correction_type, step in selected:
+        method = getattr(step, "method", None)
+        if method is None or str(method).lower() == "none":
+            continue
+        method = str(method).lower()
+        # the other intensity methods are not selectable from the YAML
+        # in neptoon either
+        if correction_type == "incoming_intensity" and method != "hawdon_2014":
+            return None
+        if method not in SUPPORTED.get(correction_type, ()):
+            return None
+        corrections.append((correction_type, method))
+    return corrections
+
+
+def correct_neutrons_from_config(process, keep_factors=True):
+    """
+    Replacement for ProcessWithYaml._select_corrections() and
+    _correct_neutrons(), which falls back to them if the config selects
+    a correction the fused kernel does not support.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor with a data_hub
+    keep_factors : bool, optional
+        See fused_correct_neutrons()
+    """
+    corrections = corrections_from_config(process.process_config)
+    if corrections is None:
+        process._select_corrections()
+        process._correct_neutrons()
+        return
+    fused_correct_neutrons(
+        process.data_hub.crns_data_frame,
+        corrections=corrections,
+        keep_factors=keep_factors,
+    )
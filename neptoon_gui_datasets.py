@@ -0,0 +1,47 @@
+"""
+Process-wide registry of parsed datasets.
+
+Sessions that read the same data with the same settings, e.g. one of
+the examples of the configuration page, share a single parsed base
+frame. The registry is a stage cache of its own for the "parse" stage,
+keyed like it by the hash of the data files and the parser config, so
+that the base frames are not evicted by the outputs of later stages.
+A dataset requested by several sessions at once is parsed only once.
+
+The registered frames are never handed out. Sessions get shallow
+copies, and with pandas' copy-on-write mode (see
+enable_copy_on_write()) a session only copies the columns it changes,
+so that 40 sessions on the same example share one frame.
+"""
+
+import pandas as pd
+
+from neptoon_gui_stages import StageCache
+
+
+def enable_copy_on_write():
+    """
+    Turn on pandas' copy-on-write mode for the whole process, which is
+    the default from pandas 3.0 on.
+    """
+    pd.set_option("mode.copy_on_write", True)
+
+
+class DatasetRegistry(StageCache):
+    """
+    Shared read-only store of parsed datasets.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Budget for the frames held, by default 1 GB. The least recently
+        used datasets are evicted first.
+
+    Examples
+    --------
+    >>> registry = DatasetRegistry()
+    >>> run_stage(process, "parse", config, parse_data, registry)
+    """
+
+    def __init__(self, max_bytes=1024 * 2**20):
+        super().__init__(max_bytes=max_bytes)
@@ -0,0 +1,252 @@
+"""
+Ensemble uncertainty of the soil moisture.
+
+The uncertainty bounds of neptoon only reflect the counting statistics
+of the neutrons. Here N0, the dry soil bulk density, the lattice water
+and the soil organic carbon are sampled from normal distributions, e.g.
+N0 with the spread of the calibration days, optionally together with
+the counting error of every value. All members are converted with the
+Desilets equation at once as a 2-D array of rows × members, and the
+percentiles of the members give bands of the soil moisture. The rows
+are processed in chunks that fit a memory budget, so that ensembles of
+thousands of members also work on records of many years.
+"""
+
+import numpy as np
+import pandas as pd
+
+PARAMETERS = (
+    "n0",
+    "dry_soil_bulk_density",
+    "lattice_water",
+    "soil_organic_carbon",
+)
+# N0 and the bulk density must be positive and the fractions must not be
+# negative, samples outside are drawn again
+POSITIVE = ("n0", "dry_soil_bulk_density")
+PERCENTILES = (5, 50, 95)
+MEMORY_BUDGET = 256 * 2**20
+# arrays of rows × members alive at once while a chunk is converted
+_ARRAYS_PER_CHUNK = 1
+
+
+def ensemble_parameters(process):
+    """
+    Parameters of the sensor and their spread where it is known.
+
+    Returns
+    -------
+    tuple of dict
+        Means and standard deviations by parameter name, the standard
+        deviation of N0 is that of the calibration days if the sensor
+        was calibrated, the others are 0
+    """
+    from neptoon_gui_soil_moisture import DEFAULT_BULK_DENSITY
+
+    sensor_info = process.sensor_config.sensor_info
+    means = dict(
+        n0=sensor_info.N0,
+        dry_soil_bulk_density=(
+            sensor_info.avg_dry_soil_bulk_density or DEFAULT_BULK_DENSITY
+        ),
+        lattice_water=sensor_info.avg_lattice_water or 0,
+        soil_organic_carbon=sensor_info.avg_soil_organic_carbon or 0,
+    )
+    stds = dict.fromkeys(PARAMETERS, 0.0)
+    calibrator = getattr(process.data_hub, "calibrator", None)
+    if calibrator is not None:
+        n0 = calibrator.return_calibration_results_data_frame()["optimal_N0"]
+        if n0.count() > 1:
+            stds["n0"] = float(n0.std())
+    return means, stds
+
+
+def sample_parameters(members, means, stds, rng=None):
+    """
+    Normally distributed samples of the parameters, values outside
+    their range are drawn again, see POSITIVE.
+
+    Parameters
+    ----------
+    members : int
+        Number of samples
+    means, stds : dict
+        Means and standard deviations by parameter name, see PARAMETERS
+    rng : np.random.Generator, optional
+        Random numbers, by default unseeded
+
+    Returns
+    -------
+    dict
+        Arrays of the samples by parameter name
+    """
+    rng = rng or np.random.default_rng()
+    samples = {}
+    for name in PARAMETERS:
+        if means.get(name) is None:
+            raise ValueError("No value of {:} to sample.".format(name))
+        mean, std = float(means[name]), float(stds.get(name) or 0)
+        if mean <= 0 and name in POSITIVE:
+            raise ValueError(
+                "{:} must be positive, not {:}.".format(name, mean)
+            )
+        values = np.full(members, mean)
+        redraw = np.full(members, std > 0)
+        while redraw.any():
+            values[redraw] = rng.normal(mean, std, redraw.sum())
+            redraw = values <= 0 if name in POSITIVE else values < 0
+        samples[name] = values
+    return samples
+
+
+def rows_per_chunk(members, memory_budget=MEMORY_BUDGET, dtype="float64"):
+    """Rows converted at once so that the chunk fits the memory budget."""
+    size = _ARRAYS_PER_CHUNK * members * np.dtype(dtype).itemsize
+    return max(1, int(memory_budget // size))
+
+
+def ensemble_percentiles(
+    neutrons,
+    samples,
+    percentiles=PERCENTILES,
+    counting_uncertainty=None,
+    rng=None,
+    memory_budget=MEMORY_BUDGET,
+    dtype="float64",
+):
+    """
+    Percentiles of the soil moisture of all members.
+
+    Parameters
+    ----------
+    neutrons : array_like
+        Corrected neutrons
+    samples : dict
+        Parameter samples, see sample_parameters()
+    percentiles : sequence of float, optional
+        Percentiles between 0 and 100
+    counting_uncertainty : array_like, optional
+        Standard deviation of the counting error of the neutrons, each
+        member gets its own error if given
+    rng : np.random.Generator, optional
+        Random numbers of the counting errors
+    memory_budget : int, optional
+        Bytes for the members of a chunk of rows
+    dtype : str, optional
+        "float64" or "float32", which halves the memory of a chunk
+
+    Returns
+    -------
+    np.ndarray
+        Percentiles × rows, NaN for rows without neutrons
+    """
+    from neptoon_gui_soil_moisture import neutrons_to_soil_moisture
+
+    rng = rng or np.random.default_rng()
+    neutrons = np.asarray(neutrons, dtype=dtype)
+    # members along the last axis, where the percentiles are taken
+    parameters = [
+        np.asarray(samples[name], dtype=dtype)[None, :] for name in PARAMETERS
+    ]
+    members = parameters[0].shape[1]
+    valid = np.isfinite(neutrons)
+    if counting_uncertainty is not None:
+        counting_uncertainty = np.asarray(counting_uncertainty, dtype=dtype)
+        valid &= np.isfinite(counting_uncertainty)
+    rows = np.flatnonzero(valid)
+
+    bands = np.full((len(percentiles), len(neutrons)), np.nan)
+    chunk = rows_per_chunk(members, memory_budget, dtype)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, len(rows), chunk):
+            positions = rows[start : start + chunk]
+            counts = neutrons[positions][:, None]
+            theta = None
+            if counting_uncertainty is not None:
+                theta = rng.standard_normal(
+                    (len(positions), members), dtype=dtype
+                )
+                theta *= counting_uncertainty[positions][:, None]
+                theta += counts
+                counts = theta
+            theta = neutrons_to_soil_moisture(counts, *parameters, out=theta)
+            bands[:, positions] = np.percentile(
+                theta, percentiles, axis=1, overwrite_input=True
+            )
+    return bands
+
+
+def ensemble_bands(
+    data_frame,
+    means,
+    stds,
+    members=1000,
+    percentiles=PERCENTILES,
+    counting=True,
+    seed=None,
+    memory_budget=MEMORY_BUDGET,
+    dtype="float64",
+    ranges=None,
+):
+    """
+    Percentile bands of the soil moisture of an ensemble.
+
+    Parameters
+    ----------
+    data_frame : pd.DataFrame
+        crns_data_frame with the raw and final corrected neutrons
+    means, stds : dict
+        See sample_parameters() and ensemble_parameters()
+    members : int, optional
+        Size of the ensemble
+    percentiles : sequence of float, optional
+        Percentiles of the bands
+    counting : bool, optional
+        Whether the counting error of the neutrons is sampled too
+    seed : int, optional
+        Seed of the random numbers, for reproducible bands
+    memory_budget : int, optional
+        See ensemble_percentiles()
+    dtype : str, optional
+        See ensemble_percentiles()
+    ranges : dict, optional
+        Physical ranges, see neptoon_gui_soil_moisture.PHYSICAL_RANGES,
+        values of the bands outside the soil moisture range are set to
+        NaN
+
+    Returns
+    -------
+    pd.DataFrame
+        soil_moisture_p5 etc., one column per percentile
+    """
+    from neptoon.columns import ColumnInfo
+    from neptoon_gui_soil_moisture import mask_columns
+
+    rng = np.random.default_rng(seed)
+    name = ColumnInfo.Name
+    neutrons = data_frame[str(name.CORRECTED_EPI_NEUTRON_COUNT_FINAL)]
+    neutrons = neutrons.to_numpy(dtype="float64")
+    counting_uncertainty = None
+    if counting:
+        raw = data_frame[str(name.EPI_NEUTRON_COUNT_RAW)]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            counting_uncertainty = (
+                1 / np.sqrt(raw.to_numpy(dtype="float64")) * neutrons
+            )
+    bands = ensemble_percentiles(
+        neutrons,
+        sample_parameters(members, means, stds, rng),
+        percentiles=percentiles,
+        counting_uncertainty=counting_uncertainty,
+        rng=rng,
+        memory_budget=memory_budget,
+        dtype=dtype,
+    )
+    column = str(name.SOIL_MOISTURE)
+    columns = {
+        "{:}_p{:g}".format(column, percentile): values
+        for percentile, values in zip(percentiles, bands)
+    }
+    if ranges and column in ranges:
+        mask_columns(columns, dict.fromkeys(columns, ranges[column]))
+    return pd.DataFrame(columns, index=data_frame.index)
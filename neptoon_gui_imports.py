@@ -0,0 +1,147 @@
+"""
+Lazy and timed imports of the heavy libraries.
+
+Importing neptoon takes seconds, plotly.express and magazine a good
+fraction of one. The app and its pages therefore import them only where
+a stage needs them, through timed_import() or a lazy_import() proxy, so
+that the first page and the "You need to ... first" pages render without
+them. After the first page is shown, preload() imports them in a
+background thread, so that they are usually loaded by the time the user
+applies a configuration. The time of every import is kept in
+import_times(), logged, and shown on the Performance page.
+"""
+
+import importlib
+import os
+import sys
+import threading
+import time
+import types
+
+from streamlit.logger import get_logger
+
+# imported in the background after the first page, slowest first
+HEAVY_MODULES = (
+    "neptoon.workflow",
+    "neptoon.io.read",
+    "magazine",
+    "plotly.express",
+    "plotly.graph_objects",
+)
+
+logger = get_logger(__name__)
+
+_times = {}
+_lock = threading.Lock()
+_preloader = None
+
+
+def timed_import(name):
+    """
+    Import a module and record how long it took if it was not loaded.
+
+    Parameters
+    ----------
+    name : str
+        Module name, e.g. "neptoon.workflow"
+
+    Returns
+    -------
+    module
+        The imported module
+    """
+    # a module that another thread is still importing is already in
+    # sys.modules, import_module() waits until it is complete
+    loaded = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if loaded:
+        return module
+    seconds = time.perf_counter() - start
+    with _lock:
+        # another thread may have finished the same import meanwhile
+        _times.setdefault(
+            name,
+            dict(
+                module=name,
+                seconds=seconds,
+                thread=threading.current_thread().name,
+            ),
+        )
+    logger.info("Imported %s in %.2f s", name, seconds)
+    return module
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    Examples
+    --------
+    >>> go = LazyModule("plotly.graph_objects")
+    >>> fig = go.Figure()  # imports plotly.graph_objects
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+
+    def __getattr__(self, attribute):
+        return getattr(timed_import(self.__name__), attribute)
+
+    def __dir__(self):
+        return dir(timed_import(self.__name__))
+
+
+def lazy_import(name):
+    """
+    The module if it is loaded, otherwise a LazyModule for it. A module
+    that is still being imported is waited for.
+    """
+    if name in sys.modules:
+        return importlib.import_module(name)
+    return LazyModule(name)
+
+
+def activate_magazine():
+    """Turn on neptoon's reporting, which goes into the PDF report."""
+    timed_import("magazine").Magazine.active = True
+
+
+def preload(modules=HEAVY_MODULES):
+    """
+    Import modules in a background thread, once per process. Turned off
+    with the environment variable NEPTOON_GUI_PRELOAD=0.
+
+    Returns
+    -------
+    threading.Thread or None
+        The thread, None if preloading is turned off
+    """
+    global _preloader
+    if os.environ.get("NEPTOON_GUI_PRELOAD", "1") == "0":
+        return None
+    with _lock:
+        if _preloader is None:
+            _preloader = threading.Thread(
+                target=_preload,
+                args=(modules,),
+                name="neptoon-preload",
+                daemon=True,
+            )
+            _preloader.start()
+    return _preloader
+
+
+def _preload(modules):
+    for name in modules:
+        try:
+            timed_import(name)
+        except Exception:
+            logger.exception("Preloading %s failed", name)
+    activate_magazine()
+
+
+def import_times():
+    """Recorded imports, oldest first, as dicts with module and seconds."""
+    with _lock:
+        return [dict(record) for record in _times.values()]
@@ -0,0 +1,527 @@
+"""
+Incremental processing of new station data.
+
+The processed output of a station is kept in an append-only store of
+Parquet parts. An update only processes the rows after the stored end,
+preceded by the lookback window that the rolling operations need: the
+spike detection (spike_uni_lof: periods_in_calculation, spike_hampel:
+window), the persistence checks, the smoothing window and the
+nearest-time alignment of the NMDB data, reaching back to the value
+that rate_of_change compares the new values with. The cost of an
+update therefore grows with the new rows, not with the history.
+
+Calibration is only done in the first run; its results are kept in the
+store and reused for every update.
+"""
+
+import json
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from neptoon_gui_stages import CALIBRATION_RESULTS, config_fingerprint
+
+STATE_FILE = "state.json"
+CONTEXT_FILE = "context.parquet"
+
+
+def default_store_dir(process):
+    """Store location of a station inside the neptoon cache directory."""
+    from neptoon.config.global_configuration import GlobalConfig
+
+    info = process.sensor_config.sensor_info
+    name = info.identifier or info.name or "station"
+    return GlobalConfig.get_cache_dir() / "processed" / str(name)
+
+
+def processing_fingerprint(process):
+    """
+    Fingerprint of the settings the stored output depends on. Results
+    of the calibration are left out, they are kept in the store.
+    """
+    sensor = process.sensor_config
+    sensor_info = {
+        key: value
+        for key, value in sensor.sensor_info.model_dump(mode="json").items()
+        if key not in CALIBRATION_RESULTS
+    }
+    return config_fingerprint(
+        process.process_config,
+        sensor.time_series_data.key_column_info,
+        sensor.input_data_qa,
+        sensor.soil_moisture_qa,
+        sensor_info,
+    )
+
+
+class ProcessedStore:
+    """
+    Append-only store of the processed output of one station.
+
+    Every update writes one part with the processed rows and one with
+    their flags. A part may start before the end of the previous one,
+    when rows of the lookback window were recomputed; reading keeps the
+    latest version of every timestamp. The unflagged input of the
+    lookback window is kept separately as context for the next update.
+
+    Parameters
+    ----------
+    folder : Path
+        Folder of the store, created when needed
+
+    Examples
+    --------
+    >>> store = ProcessedStore(default_store_dir(process))
+    >>> run_incremental_process(process, store, new_data=new_rows)
+    >>> crns_data_frame, flags_data_frame = store.read()
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    @property
+    def state(self):
+        """Settings, calibration results and extent of the stored data."""
+        path = self.folder / STATE_FILE
+        if not path.is_file():
+            return None
+        with open(path) as file:
+            return json.load(file)
+
+    @property
+    def end(self):
+        """Last processed timestamp or None for an empty store."""
+        state = self.state
+        return None if state is None else pd.Timestamp(state["end"])
+
+    def __len__(self):
+        state = self.state
+        return 0 if state is None else state["parts"]
+
+    def _part(self, number, kind="data"):
+        return self.folder / "{:}-{:05d}.parquet".format(kind, number)
+
+    def context(self):
+        """Unflagged input rows of the lookback window."""
+        path = self.folder / CONTEXT_FILE
+        return pd.read_parquet(path) if path.is_file() else None
+
+    def append(self, crns_data_frame, flags_data_frame, context, **state):
+        """
+        Write a new part and update the state.
+
+        Parameters
+        ----------
+        crns_data_frame : pd.DataFrame
+            Processed rows
+        flags_data_frame : pd.DataFrame
+            Flags of the processed rows
+        context : pd.DataFrame
+            Input rows to start the next update with
+        **state
+            Entries of the state to set
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        number = len(self)
+        _write_parquet(crns_data_frame, self._part(number))
+        _write_parquet(flags_data_frame, self._part(number, "flags"))
+        _write_parquet(context, self.folder / CONTEXT_FILE)
+
+        new_state = self.state or {}
+        new_state.update(state)
+        new_state.update(
+            parts=number + 1,
+            start=str(new_state.get("start") or crns_data_frame.index[0]),
+            end=str(crns_data_frame.index[-1]),
+        )
+        self._write_state(new_state)
+
+    def _write_state(self, state):
+        tmp = self.folder / (STATE_FILE + ".tmp")
+        with open(tmp, "w") as file:
+            json.dump(state, file, indent=1, default=str)
+        os.replace(tmp, self.folder / STATE_FILE)
+
+    def read(self, start=None):
+        """
+        Processed rows and flags, optionally from start on.
+
+        Parts before the one that covers start are not read.
+
+        Returns
+        -------
+        tuple of pd.DataFrame
+            crns_data_frame and flags_data_frame
+        """
+        frames = {"data": [], "flags": []}
+        for number in reversed(range(len(self))):
+            for kind, parts in frames.items():
+                parts.append(pd.read_parquet(self._part(number, kind)))
+            if start is not None and frames["data"][-1].index[0] <= start:
+                break
+        return tuple(_latest(parts[::-1], start) for parts in frames.values())
+
+    def compact(self):
+        """Rewrite all parts into a single one."""
+        if len(self) < 2:
+            return
+        crns_data_frame, flags_data_frame = self.read()
+        _write_parquet(crns_data_frame, self._part(0))
+        _write_parquet(flags_data_frame, self._part(0, "flags"))
+        state = self.state
+        for number in range(1, state["parts"]):
+            self._part(number).unlink()
+            self._part(number, "flags").unlink()
+        state["parts"] = 1
+        self._write_state(state)
+
+    def clear(self):
+        """Remove the stored output, the next run processes all data."""
+        if not self.folder.is_dir():
+            return
+        for path in self.folder.glob("*.parquet"):
+            path.unlink()
+        (self.folder / STATE_FILE).unlink(missing_ok=True)
+
+
+def _write_parquet(data_frame, path):
+    tmp = path.with_suffix(".tmp")
+    data_frame.to_parquet(tmp)
+    os.replace(tmp, path)
+
+
+def _latest(parts, start=None):
+    data_frame = pd.concat(parts)
+    data_frame = data_frame[~data_frame.index.duplicated(keep="last")]
+    if start is not None:
+        data_frame = data_frame[data_frame.index >= start]
+    return data_frame
+
+
+def window_periods(window, resolution):
+    """Number of time steps covered by an int or time string window."""
+    if isinstance(window, str):
+        return math.ceil(pd.Timedelta(window) / pd.Timedelta(resolution))
+    return int(window)
+
+
+def lookback_periods(process):
+    """
+    Rows before the new data that an update has to recompute.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor holding the configs
+
+    Returns
+    -------
+    context : int
+        Rows of input to process in front of the new rows
+    replace : int
+        Last stored rows whose results change with the new rows, they
+        are part of the context and recomputed
+    """
+    process_config = process.process_config
+    resolution = (
+        process.sensor_config.time_series_data.temporal.input_resolution
+    )
+    # nearest-time alignment of NMDB data can use one step on each side
+    context, replace = 1, 1
+
+    raw = process_config.neutron_quality_assessment.raw_neutrons
+    spike = getattr(raw, "spike_uni_lof", None) if raw else None
+    if spike is not None:
+        # the scores use neighbours in time on both sides, and the
+        # neighbours of these neighbours
+        periods = int(spike.periods_in_calculation or 20)
+        context = max(context, 2 * periods)
+        replace = max(replace, periods)
+    hampel = getattr(raw, "spike_hampel", None) if raw else None
+    if hampel:
+        from neptoon_gui_spikes import DEFAULT_WINDOW, HampelStream
+
+        window = dict(hampel).get("window") or DEFAULT_WINDOW
+        # the lag of the streaming filter, see HampelStream
+        lag = HampelStream(window=window).lag
+        context = max(context, 2 * lag)
+        replace = max(replace, lag)
+
+    smoothing = process_config.data_smoothing
+    if smoothing.smooth_corrected_neutrons or smoothing.smooth_soil_moisture:
+        window = window_periods(smoothing.settings.window, resolution)
+        if smoothing.settings.algorithm == "savitsky_golay":
+            # a centred filter, which fits the last half window anew
+            replace = max(replace, window // 2 + 1)
+        context = max(context, window)
+
+    for column, name, params in quality_checks(process):
+        if name == "persistance_check":
+            # a constant window flags the window - 1 values before its
+            # end, which need the window - 1 values before them
+            window = int(params.get("window") or 0)
+            context += max(window - 1, 0)
+            replace += max(window - 1, 0)
+
+    return replace + context, replace
+
+
+def quality_checks(process):
+    """
+    The quality checks of all sections that run_pipeline() applies, as
+    (column, check name, parameters).
+    """
+    from neptoon_gui_quality import compile_checks
+
+    sections = (
+        process.process_config.neutron_quality_assessment,
+        process.sensor_config.input_data_qa,
+        process.sensor_config.soil_moisture_qa,
+    )
+    return [
+        (column, name, params)
+        for section in sections
+        for column, checks in compile_checks(section).items()
+        for name, params in checks
+    ]
+
+
+def rate_of_change_rows(process, data_hub, replace):
+    """
+    Rows from the end of a processed data hub back to the value that
+    rate_of_change compares the first of the last replace rows with,
+    i.e. the last value before them that passed the checks before
+    rate_of_change. 0 without such a check or value.
+    """
+    from neptoon_gui_quality import CHECK_BITS, UNFLAGGED
+
+    earlier = [
+        name
+        for name, bit in CHECK_BITS.items()
+        if bit < CHECK_BITS["rate_of_change"]
+    ]
+    crns_data_frame = data_hub.crns_data_frame
+    flags_data_frame = data_hub.flags_data_frame
+    end = len(crns_data_frame) - replace
+    rows = 0
+    for column, name, params in quality_checks(process):
+        if name != "rate_of_change" or column not in crns_data_frame:
+            continue
+        values = crns_data_frame[column].iloc[:end]
+        labels = flags_data_frame[column].iloc[:end].astype(str)
+        # flagged values are masked, those flagged from rate_of_change
+        # on were seen by it
+        seen = (labels != UNFLAGGED) & ~labels.str.contains("|".join(earlier))
+        valid = np.flatnonzero(values.notna().to_numpy() | seen.to_numpy())
+        if len(valid):
+            rows = max(rows, len(crns_data_frame) - valid[-1])
+    return rows
+
+
+def run_pipeline(process, calibration=None, nmdb_store=None):
+    """
+    Steps of ProcessWithYaml.run_full_process() on process.data_hub,
+    without figures and saving, and with the fused corrections.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor with a data_hub
+    calibration : dict, optional
+        Results of an earlier calibration, see CALIBRATION_RESULTS.
+        They are set at the point where the sensor would be calibrated,
+        so that the columns are the same as in the calibrated run. By
+        default the sensor is calibrated if this is set in the config.
+    nmdb_store : NMDBStore, optional
+        Store for the NMDB data, by default neptoon's online path
+    """
+    from neptoon.columns import ColumnInfo
+    from neptoon_gui_calibration import calibrate
+    from neptoon_gui_corrections import correct_neutrons_from_config
+    from neptoon_gui_nmdb import attach_nmdb_data
+    from neptoon_gui_quality import (
+        apply_quality_assessment,
+        clear_quality_reports,
+    )
+    from neptoon_gui_soil_moisture import produce_soil_moisture
+
+    clear_quality_reports(process, "run")
+    if nmdb_store is None:
+        process._attach_nmdb_data()
+    else:
+        attach_nmdb_data(process, store=nmdb_store)
+    process._prepare_static_values()
+    apply_quality_assessment(
+        process,
+        partial_config=process.process_config.neutron_quality_assessment,
+        name_of_target="raw_neutrons",
+    )
+    apply_quality_assessment(
+        process,
+        partial_config=process.sensor_config.input_data_qa,
+        name_of_target=None,
+    )
+    correct_neutrons_from_config(process)
+
+    if process.sensor_config.calibration.calibrate:
+        if calibration is None:
+            calibrate(process)
+        else:
+            for key, value in calibration.items():
+                setattr(process.sensor_config.sensor_info, key, value)
+            process.data_hub.crns_data_frame["N0"] = (
+                process.sensor_config.sensor_info.N0
+            )
+
+    if process.sensor_config.sensor_info.N0 is None:
+        raise ValueError(
+            "Cannot proceed with quality assessment or processing "
+            "without an N0 number. Supply an N0 number in the YAML "
+            "file or use site calibration"
+        )
+
+    apply_quality_assessment(
+        process,
+        partial_config=process.process_config.neutron_quality_assessment,
+        name_of_target="corrected_neutrons",
+    )
+    smoothing = process.process_config.data_smoothing
+    if smoothing.smooth_corrected_neutrons:
+        process._smooth_data(
+            column_to_smooth=str(ColumnInfo.Name.CORRECTED_EPI_NEUTRON_COUNT),
+        )
+    produce_soil_moisture(process)
+    if smoothing.smooth_soil_moisture:
+        process._smooth_data(
+            column_to_smooth=str(ColumnInfo.Name.SOIL_MOISTURE_FINAL),
+        )
+    apply_quality_assessment(
+        process,
+        partial_config=process.sensor_config.soil_moisture_qa,
+        name_of_target=None,
+    )
+
+
+def run_incremental_process(
+    process, store, new_data=None, nmdb_store=None, progress=None
+):
+    """
+    Process the rows after the end of the store and append them.
+
+    An empty store is filled by processing all data, including the
+    calibration. Later calls process the new rows together with the
+    lookback window from lookback_periods() and replace the stored
+    rows of that window whose results changed.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor holding the configs, its data_hub is set to the
+        processed rows of this update
+    store : ProcessedStore
+        Store of the processed output
+    new_data : pd.DataFrame, optional
+        Frame formatted for the CRNSDataHub, e.g. from
+        neptoon_gui_ingest.prepare_time_series(). Rows up to the end of
+        the store are skipped. By default the data source of the config
+        is imported, which reads the full file again.
+    nmdb_store : NMDBStore, optional
+        Store for the NMDB data, by default neptoon's online path
+    progress : callable, optional
+        Called with a message before the processing starts
+
+    Returns
+    -------
+    int
+        Number of new rows appended
+
+    Raises
+    ------
+    ValueError
+        When the settings differ from those of the stored output
+    """
+    from neptoon.hub import CRNSDataHub
+
+    if new_data is None:
+        from neptoon_gui_ingest import (
+            import_preformatted_data,
+            import_raw_data,
+        )
+
+        if process.sensor_config.raw_data_parse_options.parse_raw_data:
+            new_data = import_raw_data(process)
+        else:
+            new_data = import_preformatted_data(process)
+
+    fingerprint = processing_fingerprint(process)
+    state = store.state
+    sensor_info = process.sensor_config.sensor_info
+    context_rows, replace_rows = lookback_periods(process)
+
+    if state is None:
+        context = new_data.iloc[:0]
+    else:
+        if state["fingerprint"] != fingerprint:
+            raise ValueError(
+                "The settings differ from those of the processed data in "
+                "{:}. Clear the store to process all data again.".format(
+                    store.folder
+                )
+            )
+        new_data = new_data[new_data.index > store.end]
+        context = store.context()
+
+    if new_data.empty:
+        return 0
+    if progress is not None:
+        progress(
+            "Processing {:} new and {:} previous rows".format(
+                len(new_data), len(context)
+            )
+        )
+
+    data_frame = pd.concat([context, new_data])
+    process.data_hub = CRNSDataHub(
+        crns_data_frame=data_frame,
+        sensor_info=sensor_info,
+    )
+    run_pipeline(
+        process,
+        calibration=None if state is None else state["calibration"],
+        nmdb_store=nmdb_store,
+    )
+
+    hub = process.data_hub
+    # the input rows, as flagged values are masked in the data hub
+    rows = max(context_rows, rate_of_change_rows(process, hub, replace_rows))
+    next_context = pd.concat(
+        [context.iloc[-rows:], new_data.iloc[-rows:]]
+    ).iloc[-rows:]
+    first = len(context) - min(replace_rows, len(context))
+    crns_data_frame = hub.crns_data_frame.iloc[first:]
+    flags_data_frame = hub.flags_data_frame.iloc[first:]
+    if state is not None:
+        # static values that were already set in sensor_info, e.g. by
+        # a calibration in the GUI, add columns the first run lacked
+        crns_data_frame = crns_data_frame.reindex(columns=state["columns"])
+        flags_data_frame = flags_data_frame.reindex(
+            columns=state["flag_columns"]
+        )
+
+    store.append(
+        crns_data_frame,
+        flags_data_frame,
+        next_context,
+        fingerprint=fingerprint,
+        columns=list(crns_data_frame.columns),
+        flag_columns=list(flags_data_frame.columns),
+        calibration={
+            key: getattr(sensor_info, key) for key in CALIBRATION_RESULTS
+        },
+    )
+    hub.crns_data_frame = crns_data_frame
+    hub.flags_data_frame = flags_data_frame
+    return len(new_data)
@@ -0,0 +1,613 @@
+"""
+Faster ingestion of time series data into a CRNSDataHub.
+
+Preformatted data can be read from CSV or from columnar files (Parquet,
+Feather). After the first parse of a CSV, the formatted frame is kept
+as a typed Parquet sidecar keyed by the file hash and the column and
+temporal settings, so that later parses skip CSV and datetime parsing.
+
+Raw data is streamed member by member from its folder or archive and
+parsed in chunks of bounded size into typed columns, optionally in a
+pool of worker processes (raw_data_parse_options: parallel_workers).
+"""
+
+import hashlib
+import io
+import json
+import os
+import tarfile
+import zipfile
+from pathlib import Path
+
+import pandas as pd
+
+COLUMNAR_READERS = {
+    ".parquet": pd.read_parquet,
+    ".pq": pd.read_parquet,
+    ".feather": pd.read_feather,
+    ".arrow": pd.read_feather,
+}
+
+# keys of raw_data_parse_options used here in addition to neptoon's
+RAW_PARSE_EXTRAS = dict(
+    # worker processes for parsing raw files, 0 or 1 to parse serially
+    parallel_workers=0,
+)
+
+
+def default_sidecar_dir():
+    """Sidecar location inside the neptoon cache directory."""
+    from neptoon.config.global_configuration import GlobalConfig
+
+    return GlobalConfig.get_cache_dir() / "time_series_sidecars"
+
+
+def file_hash(path, chunk_size=2**20):
+    """SHA-256 of a file's content, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sidecar_key(path, sensor_config):
+    """
+    Key of the formatted frame of a preformatted file.
+
+    Besides the file content, the result depends on key_column_info,
+    the temporal settings and the install date (data before it is cut).
+    """
+    tmp = sensor_config.time_series_data
+    settings = dict(
+        key_column_info=tmp.key_column_info.model_dump(),
+        temporal=tmp.temporal.model_dump(),
+        install_date=sensor_config.sensor_info.install_date,
+    )
+    digest = hashlib.sha256(file_hash(path).encode())
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:32]
+
+
+def read_time_series_file(path):
+    """
+    Read a preformatted time series file as it is, without formatting.
+
+    Parameters
+    ----------
+    path : Path
+        CSV, Parquet or Feather file
+
+    Returns
+    -------
+    pd.DataFrame
+        The table of the file
+    """
+    path = Path(path)
+    reader = COLUMNAR_READERS.get(path.suffix.lower())
+    if reader is None:
+        return pd.read_csv(path)
+    data_frame = reader(path)
+    # a datetime index written by pandas comes back as the index
+    if isinstance(data_frame.index, pd.DatetimeIndex):
+        data_frame = data_frame.reset_index()
+    return data_frame
+
+
+def prepare_time_series(process, data_frame):
+    """
+    Same as ProcessWithYaml._prepare_time_series() for a given frame,
+    but with the datetime columns joined column-wise.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor holding the sensor_config
+    data_frame : pd.DataFrame
+        Table as read from the file
+
+    Returns
+    -------
+    pd.DataFrame
+        Frame formatted for the CRNSDataHub
+    """
+    from neptoon.io.read.data_ingest import (
+        InputDataFrameFormattingConfig,
+        FormatDataForCRNSDataHub,
+    )
+
+    config = InputDataFrameFormattingConfig()
+    config.yaml_information = process.sensor_config
+    config.build_from_yaml()
+    joined = not isinstance(config.date_time_columns, str)
+    data_frame, config.date_time_columns = _join_date_time_columns(
+        data_frame, config.date_time_columns
+    )
+    process.input_formatter_config = config
+
+    data_formatter = FormatDataForCRNSDataHub(
+        data_frame=data_frame,
+        config=config,
+    )
+    data_frame = data_formatter.format_data_and_return_data_frame()
+    if joined:
+        # neptoon's joined series carries no name
+        data_frame.index.name = None
+    return data_frame
+
+
+def import_preformatted_data(process, sidecar_dir=None, use_sidecar=True):
+    """
+    Import the file from time_series_data.path_to_data.
+
+    Columnar files are formatted directly. CSV files are served from
+    their sidecar if one matches, otherwise they are parsed and the
+    sidecar is written.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor holding the sensor_config
+    sidecar_dir : Path, optional
+        Where sidecars are kept, by default in the neptoon cache
+    use_sidecar : bool, optional
+        Read and write sidecars for CSV files, by default True
+
+    Returns
+    -------
+    pd.DataFrame
+        Frame formatted for the CRNSDataHub
+    """
+    from neptoon.io.read.data_ingest import validate_and_convert_file_path
+
+    path = validate_and_convert_file_path(
+        file_path=process.sensor_config.time_series_data.path_to_data,
+    )
+    if path.suffix.lower() in COLUMNAR_READERS or not use_sidecar:
+        process.raw_data_parsed = read_time_series_file(path)
+        return prepare_time_series(process, process.raw_data_parsed)
+
+    sidecar_dir = Path(sidecar_dir or default_sidecar_dir())
+    sidecar = sidecar_dir / (
+        sidecar_key(path, process.sensor_config) + ".parquet"
+    )
+    if sidecar.is_file():
+        return pd.read_parquet(sidecar)
+
+    process.raw_data_parsed = read_time_series_file(path)
+    data_frame = prepare_time_series(process, process.raw_data_parsed)
+
+    sidecar_dir.mkdir(parents=True, exist_ok=True)
+    tmp = sidecar.with_suffix(".tmp")
+    data_frame.to_parquet(tmp)
+    os.replace(tmp, sidecar)
+    return data_frame
+
+
+class StreamingRawParser:
+    """
+    Parses raw sensor files from a folder, a zip or tar archive, or a
+    single file, without extracting or merging them first.
+
+    Members are opened lazily one at a time. Their data lines are
+    collected into chunks of at most chunk_lines lines, and each chunk
+    is converted to typed columns before the next one is read, so the
+    memory besides the resulting frame does not grow with the archive.
+    Lines are filtered in the same way as by neptoon's
+    ParseFilesIntoDataFrame.
+
+    Parameters
+    ----------
+    parse_options : RawDataParseConfig
+        The raw_data_parse_options of the sensor config
+    date_time_columns : list, optional
+        Datetime columns, a single one is parsed to datetime64
+    date_time_format : str, optional
+        Format of the datetime column
+    chunk_lines : int, optional
+        Maximum number of lines parsed at once, by default 20000
+
+    Examples
+    --------
+    >>> parser = StreamingRawParser(sensor_config.raw_data_parse_options)
+    >>> df = parser.parse(progress=lambda n, total, name: print(n, total))
+    """
+
+    def __init__(
+        self,
+        parse_options,
+        date_time_columns=None,
+        date_time_format=None,
+        chunk_lines=20_000,
+    ):
+        from neptoon.io.read.data_ingest import (
+            validate_and_convert_file_path,
+        )
+
+        self.options = parse_options
+        self.location = validate_and_convert_file_path(
+            parse_options.data_location
+        )
+        self.date_time_column = (
+            date_time_columns[0]
+            if date_time_columns and len(date_time_columns) == 1
+            else None
+        )
+        self.date_time_format = date_time_format
+        self.chunk_lines = chunk_lines
+
+    def _wanted(self, name):
+        name = Path(name).name
+        return name.startswith(self.options.prefix or "") and name.endswith(
+            self.options.suffix or ""
+        )
+
+    def list_files(self):
+        """
+        Sorted names of the files to parse, relative to the folder or
+        archive. None for tar archives, which can only be streamed.
+        """
+        if self.location.is_dir():
+            return sorted(
+                path.relative_to(self.location).as_posix()
+                for path in self.location.rglob("*")
+                if path.is_file() and self._wanted(path.name)
+            )
+        if zipfile.is_zipfile(self.location):
+            with zipfile.ZipFile(self.location) as archive:
+                return sorted(
+                    info.filename
+                    for info in archive.infolist()
+                    if not info.is_dir() and self._wanted(info.filename)
+                )
+        if tarfile.is_tarfile(self.location):
+            return None
+        return [self.location.name]
+
+    def count_files(self):
+        """Number of files to parse, None for tar archives."""
+        names = self.list_files()
+        return None if names is None else len(names)
+
+    def iter_files(self, names=None):
+        """
+        Yields (name, text file) for every file to parse, opening only
+        one at a time. Tar archives are read as a stream.
+
+        Parameters
+        ----------
+        names : list, optional
+            Subset of list_files() to read, by default all of them
+        """
+        encoding = self.options.encoding
+        if self.location.is_dir():
+            for name in self.list_files() if names is None else names:
+                with open(self.location / name, encoding=encoding) as file:
+                    yield name, file
+        elif zipfile.is_zipfile(self.location):
+            if names is None:
+                names = self.list_files()
+            with zipfile.ZipFile(self.location) as archive:
+                for name in names:
+                    with io.TextIOWrapper(
+                        archive.open(name), encoding=encoding
+                    ) as file:
+                        yield name, file
+        elif tarfile.is_tarfile(self.location):
+            with tarfile.open(self.location, mode="r|*") as archive:
+                for member in archive:
+                    if not member.isfile() or not self._wanted(member.name):
+                        continue
+                    if names is not None and member.name not in names:
+                        continue
+                    with io.TextIOWrapper(
+                        archive.extractfile(member), encoding=encoding
+                    ) as file:
+                        yield member.name, file
+        else:
+            with open(self.location, encoding=encoding) as file:
+                yield self.location.name, file
+
+    def infer_column_names(self):
+        """Column names from the header of the first file."""
+        files = self.iter_files()
+        try:
+            _, file = next(files)
+            for _ in range(self.options.skip_lines):
+                next(file, None)
+            headers = []
+            for line in file:
+                if self.options.separator in line and line.startswith(
+                    self.options.starts_with
+                ):
+                    headers.append(line)
+                    if not self.options.multi_header:
+                        break
+        finally:
+            files.close()
+
+        header_list = self.options.separator.join(headers).split(
+            self.options.separator
+        )
+        if self.options.strip_names:
+            header_list = [s.strip() for s in header_list]
+        if self.options.remove_prefix:
+            header_list = [
+                s.removeprefix(self.options.remove_prefix) for s in header_list
+            ]
+        return header_list
+
+    def _data_lines(self, file):
+        for _ in range(self.options.skip_lines):
+            next(file, None)
+        strip_left = self.options.parser_kw.strip_left
+        digit_first = self.options.parser_kw.digit_first
+        for line in file:
+            if strip_left:
+                line = line.lstrip()
+            # if the line starts with a number, it likely is actual data
+            if digit_first and not line[:1].isdigit():
+                continue
+            if not line.endswith("\n"):
+                line += "\n"
+            yield line
+
+    def iter_chunks(self, column_names, progress=None, names=None, skip=None):
+        """
+        Yields typed DataFrames of at most chunk_lines rows.
+
+        Parameters
+        ----------
+        column_names : list
+            Names of the columns
+        progress : callable, optional
+            Called as progress(files_done, files_total, name) after
+            every file, files_total is None for tar archives
+        names : list, optional
+            Subset of list_files() to read, by default all of them
+        skip : int, optional
+            Data lines to drop at the very beginning, by default
+            skip_lines, since neptoon skips them once more on the merged
+            data
+        """
+        total = self.count_files() if progress else None
+        skip = self.options.skip_lines if skip is None else skip
+        lines = []
+        files = enumerate(self.iter_files(names), start=1)
+        for number, (name, file) in files:
+            for line in self._data_lines(file):
+                if skip > 0:
+                    skip -= 1
+                    continue
+                lines.append(line)
+                if len(lines) >= self.chunk_lines:
+                    yield self._parse_chunk(lines, column_names)
+                    lines = []
+            if progress:
+                progress(number, total, name)
+        if lines:
+            yield self._parse_chunk(lines, column_names)
+
+    def _parse_chunk(self, lines, column_names):
+        chunk = pd.read_csv(
+            io.StringIO("".join(lines)),
+            names=column_names,
+            skipinitialspace=self.options.skip_initial_space,
+            sep=self.options.separator,
+            decimal=self.options.decimal,
+            on_bad_lines="skip",  # ignore all lines with bad columns
+            dtype=object,
+            index_col=False,
+        )
+        for column in chunk.columns:
+            if column == self.date_time_column:
+                chunk[column] = pd.to_datetime(
+                    chunk[column],
+                    format=self.date_time_format,
+                    errors="coerce",
+                )
+            elif self.options.decimal.strip() == ".":
+                # neptoon replaces other decimal marks in the strings
+                # later on, so only the default case can be typed here
+                chunk[column] = pd.to_numeric(chunk[column], errors="coerce")
+        return chunk
+
+    def parse(self, progress=None, workers=None):
+        """
+        Parses all files into one DataFrame.
+
+        Parameters
+        ----------
+        progress : callable, optional
+            See iter_chunks()
+        workers : int, optional
+            Number of worker processes. With more than one, contiguous
+            batches of files are parsed in a process pool. The batches
+            are joined in file order, so the result is identical to the
+            serial one, and duplicate timestamps are resolved alike by
+            the formatting step. Tar archives are always read serially.
+
+        Returns
+        -------
+        pd.DataFrame
+            Typed raw data, one column per raw column
+        """
+        column_names = self.options.column_names or self.infer_column_names()
+        names = self.list_files() if workers and workers > 1 else None
+        if names is None or len(names) < 2:
+            return _concat_chunks(
+                self.iter_chunks(column_names, progress=progress),
+                column_names,
+            )
+        return self._parse_parallel(column_names, names, workers, progress)
+
+    def _parse_parallel(self, column_names, names, workers, progress):
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        n_batches = min(len(names), workers * 4)
+        batches = [
+            names[
+                i * len(names) // n_batches : (i + 1) * len(names) // n_batches
+            ]
+            for i in range(n_batches)
+        ]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    _parse_files,
+                    self,
+                    column_names,
+                    batch,
+                    # the merged-data skip only concerns the first lines
+                    self.options.skip_lines if i == 0 else 0,
+                ): batch
+                for i, batch in enumerate(batches)
+            }
+            done = 0
+            for future in as_completed(futures):
+                done += len(futures[future])
+                if progress:
+                    progress(done, len(names), futures[future][-1])
+            frames = [future.result() for future in futures]
+        return _concat_chunks(frames, column_names)
+
+
+def _parse_files(parser, column_names, names, skip):
+    """Process pool task of StreamingRawParser.parse()."""
+    return _concat_chunks(
+        parser.iter_chunks(column_names, names=names, skip=skip),
+        column_names,
+    )
+
+
+def _concat_chunks(chunks, column_names):
+    """Concatenates typed chunks column by column."""
+    parts = {column: [] for column in column_names}
+    for chunk in chunks:
+        for column in chunk.columns:
+            parts[column].append(chunk[column])
+    parts = {column: [x for x in parts[column] if len(x)] for column in parts}
+    if not any(parts.values()):
+        return pd.DataFrame(columns=column_names, dtype=object)
+    # concatenate column by column to free the parts on the way
+    return pd.DataFrame(
+        {
+            column: pd.concat(parts.pop(column), ignore_index=True)
+            for column in column_names
+        }
+    )
+
+
+def load_raw_parse_extras(sensor_config, file_path):
+    """
+    Read the keys of raw_data_parse_options that neptoon's
+    RawDataParseConfig does not know and drops on validation, and keep
+    them as sensor_config.raw_data_parse_extras.
+
+    Parameters
+    ----------
+    sensor_config : SensorConfig
+        Sensor config loaded from file_path
+    file_path : str | Path
+        The sensor YAML file
+    """
+    import yaml
+
+    with open(file_path) as f:
+        options = (yaml.safe_load(f) or {}).get("raw_data_parse_options")
+    options = options or {}
+    sensor_config.raw_data_parse_extras = {
+        key: default if options.get(key) is None else options[key]
+        for key, default in RAW_PARSE_EXTRAS.items()
+    }
+
+
+def get_raw_parse_extra(sensor_config, key):
+    """Value of an extra raw_data_parse_options key, or its default."""
+    extras = getattr(sensor_config, "raw_data_parse_extras", None) or {}
+    return extras.get(key, RAW_PARSE_EXTRAS[key])
+
+
+def import_raw_data(process, progress=None, chunk_lines=20_000, workers=None):
+    """
+    Import the raw files from raw_data_parse_options.data_location with
+    the StreamingRawParser.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor holding the sensor_config
+    progress : callable, optional
+        See StreamingRawParser.iter_chunks()
+    chunk_lines : int, optional
+        Maximum number of lines parsed at once, by default 20000
+    workers : int, optional
+        Worker processes for parsing, by default parallel_workers from
+        raw_data_parse_options (0, serial)
+
+    Returns
+    -------
+    pd.DataFrame
+        Frame formatted for the CRNSDataHub
+    """
+    tmp = process.sensor_config.time_series_data.key_column_info
+    parser = StreamingRawParser(
+        process.sensor_config.raw_data_parse_options,
+        date_time_columns=tmp.date_time_columns,
+        date_time_format=tmp.date_time_format,
+        chunk_lines=chunk_lines,
+    )
+    if workers is None:
+        workers = get_raw_parse_extra(
+            process.sensor_config, "parallel_workers"
+        )
+    process.raw_data_parsed = parser.parse(progress=progress, workers=workers)
+    return prepare_time_series(process, process.raw_data_parsed)
+
+
+def create_data_hub(process, progress=None, **kwargs):
+    """
+    Replacement for ProcessWithYaml.create_data_hub(return_data_hub=False)
+    which streams raw data and uses the columnar path for preformatted
+    data.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor whose data_hub is created
+    progress : callable, optional
+        Progress callback for raw data, see
+        StreamingRawParser.iter_chunks()
+    **kwargs
+        Passed to import_preformatted_data()
+    """
+    from neptoon.hub import CRNSDataHub
+
+    if process.sensor_config.raw_data_parse_options.parse_raw_data:
+        data_frame = import_raw_data(process, progress=progress)
+    else:
+        data_frame = import_preformatted_data(process, **kwargs)
+
+    process.data_hub = CRNSDataHub(
+        crns_data_frame=data_frame,
+        sensor_info=process.sensor_config.sensor_info,
+    )
+
+
+def _join_date_time_columns(data_frame, date_time_columns):
+    """
+    neptoon joins the datetime columns row by row, which dominates the
+    parse time of long files. Joining whole columns gives the same
+    strings, and a single column is passed on with its own dtype.
+    """
+    if isinstance(date_time_columns, str):
+        return data_frame, date_time_columns
+    if len(date_time_columns) == 1:
+        return data_frame, date_time_columns[0]
+
+    joined = data_frame[date_time_columns[0]].astype(str)
+    for column in date_time_columns[1:]:
+        joined = joined + " " + data_frame[column].astype(str)
+    data_frame = data_frame.drop(columns=date_time_columns)
+    data_frame["date_time"] = joined
+    return data_frame, "date_time"
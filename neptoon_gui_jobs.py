@@ -0,0 +1,489 @@
+"""
+Background jobs for long processing steps.
+
+A job runs in a thread of a process-wide pool, so that the Streamlit
+script thread of a session stays responsive and the work goes on when
+the user navigates to another page. Jobs work on a detached copy of the
+session's processor, which the session adopts when it collects the
+finished job. Threads are used rather than processes because the data
+hub with its frames then does not need to be sent back and forth.
+
+submit_job() and submit_stage_job() start the jobs of a session,
+collect_jobs() adopts their results and show_jobs() shows their
+progress in the sidebar.
+"""
+
+import copy
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import streamlit as st
+
+from neptoon_gui_session import (
+    STAGE_FLAGS,
+    STAGES_RUN,
+    compact_session_hub,
+    get_dataset_registry,
+    get_profiler,
+    get_stage_cache,
+)
+
+# steps of ProcessWithYaml.run_full_process() in the order of their
+# calls, used to report its progress
+FULL_PROCESS_STEPS = (
+    ("create_data_hub", "Reading data"),
+    ("_attach_nmdb_data", "Attaching NMDB data"),
+    ("_prepare_static_values", "Preparing static values"),
+    ("_apply_quality_assessment", "Quality assessment"),
+    ("_apply_quality_assessment", "Quality assessment"),
+    ("_select_corrections", "Selecting corrections"),
+    ("_correct_neutrons", "Correcting neutrons"),
+    ("_calibrate_data", "Calibrating"),
+    ("_apply_quality_assessment", "Quality assessment"),
+    ("_smooth_data", "Smoothing"),
+    ("_create_neutron_uncertainty_bounds", "Uncertainty bounds"),
+    ("_produce_soil_moisture_estimates", "Soil moisture"),
+    ("_smooth_data", "Smoothing"),
+    ("_apply_quality_assessment", "Quality assessment"),
+    ("_create_figures", "Creating figures"),
+    ("_save_data", "Saving data"),
+    ("_yaml_saver", "Saving the configuration"),
+)
+
+
+class Job:
+    """
+    A function running in the background, with its progress events.
+
+    Parameters
+    ----------
+    name : str
+        Shown to the user, e.g. "Calibration"
+    function : callable
+        Called with the job, so that it can call job.report(). Its
+        return value becomes job.result.
+    """
+
+    def __init__(self, name, function):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.function = function
+        self.status = "pending"
+        self.events = []
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Job({:}, {:}, {:})".format(self.id, self.name, self.status)
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed")
+
+    @property
+    def progress(self):
+        """Latest reported fraction, None if none was reported."""
+        with self._lock:
+            for _, _, fraction in reversed(self.events):
+                if fraction is not None:
+                    return fraction
+        return None
+
+    @property
+    def message(self):
+        """Latest reported message."""
+        with self._lock:
+            return self.events[-1][1] if self.events else ""
+
+    @property
+    def seconds(self):
+        """Running time so far or in total."""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def report(self, message, fraction=None):
+        """Add a progress event, may be called from any thread."""
+        with self._lock:
+            self.events.append((time.time(), message, fraction))
+
+    def run(self):
+        self.started = time.time()
+        self.status = "running"
+        try:
+            self.result = self.function(self)
+            self.status = "done"
+        except BaseException as error:
+            self.error = "{:}: {:}".format(type(error).__name__, error)
+            self.traceback = traceback.format_exc()
+            self.status = "failed"
+        finally:
+            self.finished = time.time()
+
+
+class JobRunner:
+    """
+    Thread pool running jobs, shared by all sessions.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Jobs running at once, by default 2. Further jobs wait.
+    keep : int, optional
+        Finished jobs kept for lookup by their ID, by default 100
+    """
+
+    def __init__(self, max_workers=2, keep=100):
+        self.keep = keep
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="neptoon-job"
+        )
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def submit(self, name, function):
+        """
+        Start a job.
+
+        Returns
+        -------
+        Job
+            The job, running or waiting for a free worker
+        """
+        job = Job(name, function)
+        with self._lock:
+            self._jobs[job.id] = job
+            finished = [key for key, j in self._jobs.items() if j.done]
+            for key in finished[: max(0, len(finished) - self.keep)]:
+                del self._jobs[key]
+        self._executor.submit(job.run)
+        return job
+
+    def get(self, job_id):
+        """Job with this ID, None if it is unknown or forgotten."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        """All jobs that are kept, oldest first."""
+        with self._lock:
+            return list(self._jobs.values())
+
+
+def detach(process):
+    """
+    Copy of a processor that a job can change while the session keeps
+    using the original. The configs are copied, the frames of the data
+    hub too (lazily with pandas' copy-on-write mode), the stage outputs
+    are shared as they are not changed.
+    """
+    job_process = copy.copy(process)
+    job_process.sensor_config = copy.deepcopy(process.sensor_config)
+    job_process.process_config = copy.deepcopy(process.process_config)
+    job_process.stage_outputs = dict(getattr(process, "stage_outputs", {}))
+    job_process.quality_reports = dict(
+        getattr(process, "quality_reports", None) or {}
+    )
+    if process.data_hub is not None:
+        deep = not pd.get_option("mode.copy_on_write")
+        hub = copy.copy(process.data_hub)
+        hub.sensor_info = job_process.sensor_config.sensor_info
+        hub.crns_data_frame = hub.crns_data_frame.copy(deep=deep)
+        if hub.flags_data_frame is not None:
+            hub.flags_data_frame = hub.flags_data_frame.copy(deep=deep)
+        job_process.data_hub = hub
+    return job_process
+
+
+def adopt(process, job_process, calibration=False):
+    """
+    Take over the data hub, stage outputs and quality reports of a
+    finished job.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor of the session
+    job_process : ProcessWithYaml
+        Result of the job, see detach()
+    calibration : bool, optional
+        Also take over the calibration results of the sensor_info, by
+        default False
+    """
+    from neptoon_gui_stages import CALIBRATION_RESULTS
+
+    process.data_hub = job_process.data_hub
+    process.stage_outputs = job_process.stage_outputs
+    process.quality_reports = getattr(job_process, "quality_reports", None)
+    if calibration:
+        for key in CALIBRATION_RESULTS:
+            setattr(
+                process.sensor_config.sensor_info,
+                key,
+                getattr(job_process.sensor_config.sensor_info, key),
+            )
+    if process.data_hub is not None:
+        process.data_hub.sensor_info = process.sensor_config.sensor_info
+
+
+def report_steps(process, job, steps=FULL_PROCESS_STEPS):
+    """
+    Let the step methods of a (detached) processor report to a job
+    when they are called.
+    """
+    labels = dict(steps)
+    calls = []
+
+    def wrap(method, label):
+        def reporting(*args, **kwargs):
+            calls.append(label)
+            job.report(label, min(len(calls) / (len(steps) + 1), 1.0))
+            return method(*args, **kwargs)
+
+        return reporting
+
+    for name, label in labels.items():
+        method = getattr(process, name, None)
+        if method is not None:
+            setattr(process, name, wrap(method, label))
+    return process
+
+
+def run_full_process_job(process, nmdb_store=None):
+    """
+    Job function running ProcessWithYaml.run_full_process().
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Detached processor, see detach()
+    nmdb_store : NMDBStore, optional
+        Store for the NMDB data, by default neptoon's online path
+    """
+    from neptoon_gui_calibration import use_fast_calibration
+    from neptoon_gui_quality import use_vectorized_quality
+    from neptoon_gui_soil_moisture import use_vectorized_soil_moisture
+
+    use_vectorized_quality(process)
+    use_fast_calibration(process)
+    use_vectorized_soil_moisture(process)
+    if nmdb_store is not None:
+        from neptoon_gui_nmdb import attach_nmdb_data
+
+        process._attach_nmdb_data = lambda: attach_nmdb_data(
+            process, nmdb_store
+        )
+
+    def run(job):
+        report_steps(process, job).run_full_process()
+        # the cached stage outputs describe an older data hub
+        process.stage_outputs = {}
+        job.report("Done", 1.0)
+        return process
+
+    return run
+
+
+@st.cache_resource
+def get_job_runner():
+    """
+    Process-wide pool of background jobs. NEPTOON_GUI_JOB_WORKERS jobs
+    run at once (default 2).
+    """
+    return JobRunner(
+        max_workers=int(os.environ.get("NEPTOON_GUI_JOB_WORKERS", 2))
+    )
+
+
+def session_job(name):
+    """The latest job of the session with this name, or None."""
+    entry = st.session_state.get("jobs", {}).get(name)
+    return entry["job"] if entry else None
+
+
+def job_running(name):
+    job = session_job(name)
+    return job is not None and not job.done
+
+
+def submit_job(
+    name, function, flags=(), reset=(), calibration=False, adopt=True
+):
+    """
+    Run a job for st.session_state["yaml"] in the background, see
+    neptoon_gui_jobs.py.
+
+    Parameters
+    ----------
+    name : str
+        Name of the job, one job per name and session is tracked
+    function : callable
+        Called with the job, returns the detached processor that the
+        session adopts when the job is done
+    flags : sequence of str, optional
+        Session flags set when the result is adopted
+    reset : sequence of str, optional
+        Session flags cleared when the result is adopted
+    calibration : bool, optional
+        Whether the calibration results are adopted too
+    adopt : bool, optional
+        Whether the result is a processor to adopt, otherwise the page
+        of the job uses job.result itself
+
+    Returns
+    -------
+    Job
+    """
+    job = get_job_runner().submit(name, function)
+    st.session_state.setdefault("jobs", {})[name] = dict(
+        job=job,
+        process=st.session_state["yaml"],
+        flags=tuple(flags),
+        reset=tuple(reset),
+        calibration=calibration,
+        adopt=adopt,
+        adopted=False,
+    )
+    return job
+
+
+def submit_stage_job(name, stage, compute, flags=(), **params):
+    """
+    Run a processing stage through the stage cache as a background job,
+    the counterpart of run_cached_stage().
+
+    Parameters
+    ----------
+    name : str
+        Name of the job
+    stage : str
+        One of neptoon_gui_stages.STAGES
+    compute : callable
+        Runs the stage, called with the detached processor
+    flags : sequence of str, optional
+        Session flags set when the result is adopted
+    **params
+        Stage settings given in the GUI, part of the cache key
+    """
+    from neptoon_gui_compact import compact_hub
+    from neptoon_gui_profile import data_rows
+    from neptoon_gui_stages import STAGES, run_stage, stage_config
+
+    process = detach(st.session_state["yaml"])
+    profiler = get_profiler()
+    compact = bool(st.session_state.get("data_compact"))
+    if compact:
+        params["compact"] = True
+    config = stage_config(process, stage, **params)
+    cache = get_dataset_registry() if stage == STAGES[0] else get_stage_cache()
+
+    def compute_and_compact():
+        compute(process)
+        if compact:
+            compact_hub(process.data_hub)
+
+    def run(job):
+        job.report("Running", 0.0)
+        with profiler.stage(
+            STAGES_RUN, stage, rows=lambda: data_rows(process)
+        ) as record:
+            hit = record["cached"] = run_stage(
+                process, stage, config, compute_and_compact, cache
+            )
+        job.report("Restored from the cache" if hit else "Done", 1.0)
+        return process
+
+    return submit_job(
+        name,
+        run,
+        flags=flags,
+        reset=[
+            STAGE_FLAGS[later] for later in STAGES[STAGES.index(stage) + 1 :]
+        ],
+        calibration=stage == "calibration",
+    )
+
+
+def collect_jobs():
+    """
+    Adopt the results of the finished jobs of the session.
+
+    Returns
+    -------
+    list of Job
+        The jobs that finished since the last call
+    """
+    finished = []
+    for entry in st.session_state.get("jobs", {}).values():
+        job = entry["job"]
+        if not job.done or entry["adopted"]:
+            continue
+        entry["adopted"] = True
+        finished.append(job)
+        # a configuration loaded meanwhile is not overwritten
+        if (
+            job.status != "done"
+            or not entry.get("adopt", True)
+            or entry["process"] is not st.session_state["yaml"]
+        ):
+            continue
+        adopt(
+            st.session_state["yaml"],
+            job.result,
+            calibration=entry["calibration"],
+        )
+        for flag in entry["reset"]:
+            st.session_state[flag] = False
+        for flag in entry["flags"]:
+            st.session_state[flag] = True
+        compact_session_hub()
+    return finished
+
+
+def show_jobs():
+    """
+    Progress of the jobs of the session, polled every second while one
+    is running. The app is rerun when a job finishes.
+    """
+    jobs = st.session_state.get("jobs", {})
+    if not jobs:
+        return
+    running = any(not entry["job"].done for entry in jobs.values())
+
+    @st.fragment(run_every=1 if running else None)
+    def poll():
+        for entry in jobs.values():
+            job = entry["job"]
+            if job.done and not entry["adopted"]:
+                st.rerun()
+            if job.status == "failed":
+                st.error("**{:}** failed: {:}".format(job.name, job.error))
+            elif job.done:
+                st.caption(
+                    ":material/check: {:} finished in {:.0f} s".format(
+                        job.name, job.seconds
+                    )
+                )
+            else:
+                st.progress(
+                    job.progress or 0.0,
+                    text="{:}: {:} ({:.0f} s)".format(
+                        job.name, job.message or "waiting", job.seconds
+                    ),
+                )
+
+    poll()
@@ -0,0 +1,371 @@
+"""
+Disk-backed store for neutron monitor data from NMDB.eu.
+
+Each series is kept per station, table and resolution as a pair of
+plain numpy arrays (timestamps and counts). Requests are served by
+memory-mapped reads, and only the days not yet covered by the store
+are downloaded and merged into it.
+"""
+
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+
+DAY_NS = 86_400 * 10**9
+
+FIXTURE_FILE = (
+    Path(__file__).parent
+    / "example_data"
+    / "nmdb_JUNG_revori_60_fixture.txt.gz"
+)
+
+
+def default_cache_dir():
+    """Store location inside the neptoon cache directory."""
+    from neptoon.config.global_configuration import GlobalConfig
+
+    return GlobalConfig.get_cache_dir() / "nmdb_store"
+
+
+def fetch_from_nmdb(station, nmdb_table, resolution, start, end):
+    """
+    Download whole days of neutron monitor data from NMDB.eu.
+
+    Parameters
+    ----------
+    station : str
+        NMDB station code, e.g. "JUNG"
+    nmdb_table : str
+        NMDB table, e.g. "revori"
+    resolution : str | int
+        Resolution in minutes
+    start, end : pd.Timestamp
+        First and last day to download (inclusive)
+
+    Returns
+    -------
+    pd.DataFrame
+        Column "count" with a UTC DatetimeIndex
+    """
+    from neptoon.external.nmdb_data_collection import (
+        NMDBConfig,
+        DataFetcher,
+    )
+
+    config = NMDBConfig(
+        start_date_wanted=start,
+        end_date_wanted=end,
+        station=station,
+        nmdb_table=nmdb_table,
+        resolution=str(resolution),
+    )
+    data = DataFetcher(config).fetch_and_parse_http_data()
+    if not isinstance(data, pd.DataFrame):
+        raise ValueError(
+            "Could not parse NMDB data for {:} from {:%Y-%m-%d} to "
+            "{:%Y-%m-%d}.".format(station, start, end)
+        )
+    return data
+
+
+class FixtureFetcher:
+    """
+    Stand-in for fetch_from_nmdb() that serves requests from a local
+    file in NMDB ASCII format, so that the store works without network.
+    """
+
+    def __init__(
+        self,
+        path=FIXTURE_FILE,
+        station="JUNG",
+        nmdb_table="revori",
+        resolution="60",
+    ):
+        self.path = Path(path)
+        self.key = (station, nmdb_table, str(resolution))
+        self._data = None
+
+    def __call__(self, station, nmdb_table, resolution, start, end):
+        if (station, nmdb_table, str(resolution)) != self.key:
+            raise ValueError(
+                "The local NMDB fixture only provides {:}/{:}/{:} min, "
+                "not {:}/{:}/{:} min.".format(
+                    *self.key, station, nmdb_table, resolution
+                )
+            )
+        if self._data is None:
+            data = pd.read_csv(self.path, sep=";", comment="#", index_col=0)
+            data.columns = ["count"]
+            data.index = pd.to_datetime(data.index).tz_localize("UTC")
+            self._data = data
+        return self._data.loc[start : end + pd.Timedelta(days=1, seconds=-1)]
+
+
+class NMDBStore:
+    """
+    Persistent local store for NMDB series.
+
+    Every key (station, table, resolution) has three files in the
+    cache directory: the sorted timestamps as int64 nanoseconds, the
+    counts as float64, and a JSON list of whole-day intervals that have
+    already been requested from NMDB.
+
+    Examples
+    --------
+    >>> store = NMDBStore(fetcher=FixtureFetcher())
+    >>> df = store.get("JUNG", "revori", 60, "2016-01-01", "2016-02-01")
+    """
+
+    def __init__(self, cache_dir=None, fetcher=None):
+        self.cache_dir = Path(cache_dir or default_cache_dir())
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.fetcher = fetcher or fetch_from_nmdb
+
+    def _paths(self, station, nmdb_table, resolution):
+        stem = "nmdb_{:}_{:}_{:}".format(station, nmdb_table, resolution)
+        return dict(
+            times=self.cache_dir / (stem + ".times.npy"),
+            counts=self.cache_dir / (stem + ".counts.npy"),
+            coverage=self.cache_dir / (stem + ".coverage.json"),
+        )
+
+    def coverage(self, station, nmdb_table, resolution):
+        """Sorted list of [start, end) day intervals in nanoseconds."""
+        path = self._paths(station, nmdb_table, resolution)["coverage"]
+        if not path.is_file():
+            return []
+        return json.loads(path.read_text())
+
+    def missing_intervals(self, station, nmdb_table, resolution, start, end):
+        """
+        Day intervals within [start, end] that are not yet in the store.
+
+        Returns
+        -------
+        list of tuple
+            (first_day, last_day) pairs as pd.Timestamp, inclusive
+        """
+        lo = _floor_day(start)
+        hi = _floor_day(end) + DAY_NS
+        missing = []
+        for c_lo, c_hi in self.coverage(station, nmdb_table, resolution):
+            if c_hi <= lo or c_lo >= hi:
+                continue
+            if c_lo > lo:
+                missing.append((lo, c_lo))
+            lo = max(lo, c_hi)
+        if lo < hi:
+            missing.append((lo, hi))
+        return [
+            (pd.Timestamp(a, tz="UTC"), pd.Timestamp(b - DAY_NS, tz="UTC"))
+            for a, b in missing
+        ]
+
+    def _load(self, station, nmdb_table, resolution, mmap_mode="r"):
+        paths = self._paths(station, nmdb_table, resolution)
+        if not paths["times"].is_file():
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="float64")
+        return (
+            np.load(paths["times"], mmap_mode=mmap_mode),
+            np.load(paths["counts"], mmap_mode=mmap_mode),
+        )
+
+    def _save(self, station, nmdb_table, resolution, times, counts, cover):
+        paths = self._paths(station, nmdb_table, resolution)
+        # write next to the target and swap, so readers never see a
+        # half-written file
+        for key, value in (("times", times), ("counts", counts)):
+            tmp = paths[key].with_suffix(".tmp.npy")
+            np.save(tmp, value)
+            os.replace(tmp, paths[key])
+        tmp = paths["coverage"].with_suffix(".tmp")
+        tmp.write_text(json.dumps(cover))
+        os.replace(tmp, paths["coverage"])
+
+    @contextmanager
+    def _locked(self, station, nmdb_table, resolution, shared=False):
+        """
+        Lock of a key across processes, e.g. batch workers that share
+        the store: exclusive for writers, shared for readers, so that a
+        reader never sees the new times with the old counts. Not
+        available on Windows.
+        """
+        if fcntl is None:
+            yield
+            return
+        path = self._paths(station, nmdb_table, resolution)["times"]
+        with open(path.with_suffix(".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def update(self, station, nmdb_table, resolution, start, end):
+        """
+        Download the missing days within [start, end] and merge them
+        into the stored series.
+
+        Returns
+        -------
+        int
+            Number of downloaded intervals
+        """
+        if not self.missing_intervals(
+            station, nmdb_table, resolution, start, end
+        ):
+            return 0
+        with self._locked(station, nmdb_table, resolution):
+            return self._update(station, nmdb_table, resolution, start, end)
+
+    def _update(self, station, nmdb_table, resolution, start, end):
+        # checked again, another process may have downloaded meanwhile
+        missing = self.missing_intervals(
+            station, nmdb_table, resolution, start, end
+        )
+        if not missing:
+            return 0
+
+        downloads = [
+            self.fetcher(station, nmdb_table, resolution, first, last)
+            for first, last in missing
+        ]
+
+        times, counts = self._load(
+            station, nmdb_table, resolution, mmap_mode=None
+        )
+        new_times = [times] + [
+            d.index.tz_convert("UTC").as_unit("ns").asi8 for d in downloads
+        ]
+        new_counts = [counts] + [
+            d["count"].to_numpy(dtype="float64") for d in downloads
+        ]
+        times = np.concatenate(new_times)
+        counts = np.concatenate(new_counts)
+        # stored values come first, so they win over re-downloaded ones
+        times, first = np.unique(times, return_index=True)
+        counts = counts[first]
+
+        # the current day is still incomplete on NMDB, never mark it done
+        today = _floor_day(pd.Timestamp.now(tz="UTC"))
+        cover = self.coverage(station, nmdb_table, resolution)
+        for first_day, last_day in missing:
+            lo = first_day.value
+            hi = min(last_day.value + DAY_NS, today)
+            if lo < hi:
+                cover.append([lo, hi])
+        self._save(
+            station,
+            nmdb_table,
+            resolution,
+            times,
+            counts,
+            _merge_intervals(cover),
+        )
+        return len(missing)
+
+    def read(self, station, nmdb_table, resolution, start, end):
+        """
+        Read the stored series within [start, end] without downloading.
+
+        Returns
+        -------
+        pd.DataFrame
+            Column "count" with a UTC DatetimeIndex named "datetime"
+        """
+        with self._locked(station, nmdb_table, resolution, shared=True):
+            times, counts = self._load(station, nmdb_table, resolution)
+        # the mapped files stay valid when _save() replaces them
+        lo = np.searchsorted(times, _floor_day(start), side="left")
+        hi = np.searchsorted(times, _floor_day(end) + DAY_NS, side="left")
+        index = pd.DatetimeIndex(
+            np.asarray(times[lo:hi]).view("datetime64[ns]"), tz="UTC"
+        )
+        index.name = "datetime"
+        return pd.DataFrame({"count": np.array(counts[lo:hi])}, index=index)
+
+    def get(self, station, nmdb_table, resolution, start, end):
+        """Update the store for [start, end] and read the series."""
+        self.update(station, nmdb_table, resolution, start, end)
+        return self.read(station, nmdb_table, resolution, start, end)
+
+
+def attach_nmdb_data(process, store):
+    """
+    Store-backed replacement for ProcessWithYaml._attach_nmdb_data().
+
+    The data is attached with neptoon's NMDBDataAttacher, so the new
+    columns are identical to those of the online path.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor with a parsed data_hub
+    store : NMDBStore
+        Store to serve the neutron monitor data from
+    """
+    from neptoon.columns import ColumnInfo
+    from neptoon.external.nmdb_data_collection import NMDBDataAttacher
+    from magazine import Magazine
+
+    tmp = process.process_config.correction_steps.incoming_radiation
+    station = tmp.reference_neutron_monitor.station
+    nmdb_table = tmp.reference_neutron_monitor.nmdb_table or "revori"
+    resolution = str(tmp.reference_neutron_monitor.resolution or "60")
+
+    attacher = NMDBDataAttacher(
+        data_frame=process.data_hub.crns_data_frame,
+        new_column_name=str(ColumnInfo.Name.INCOMING_NEUTRON_INTENSITY),
+    )
+    attacher.configure(
+        station=station, resolution=resolution, nmdb_table=nmdb_table
+    )
+    index = process.data_hub.crns_data_frame.index
+    attacher.tmp_data = store.get(
+        station, nmdb_table, resolution, index[0], index[-1]
+    )
+    if attacher.tmp_data.empty:
+        raise ValueError(
+            "No NMDB data available for {:} between {:} and {:}.".format(
+                station, index[0], index[-1]
+            )
+        )
+    attacher.attach_data()
+    process.data_hub.crns_data_frame = attacher.return_data_frame()
+
+    Magazine.report(
+        "NMDB",
+        "Neutron monitoring data was attached from NMDB.eu. The station "
+        "used was {:} at a resolution of {:} minutes. The data table used "
+        "was {:}.",
+        station,
+        resolution,
+        nmdb_table,
+    )
+
+
+def _floor_day(value):
+    """Start of the UTC day of a timestamp, in nanoseconds."""
+    value = pd.Timestamp(value)
+    if value.tzinfo is None:
+        value = value.tz_localize("UTC")
+    return value.tz_convert("UTC").floor("D").value
+
+
+def _merge_intervals(intervals):
+    merged = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return merged
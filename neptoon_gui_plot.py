@@ -0,0 +1,302 @@
+"""
+Downsampling of time series for plotting.
+
+A browser cannot show more points of a trace than the chart has pixels,
+so sending all rows of multi-year 10-minute data only costs transfer
+and rendering time. Here the rows of a visible time range are reduced
+to a fixed budget per column, either with min/max buckets (cheap, keeps
+every spike) or with Largest-Triangle-Three-Buckets (LTTB, keeps the
+visual shape with fewer points). Gaps in the data stay gaps.
+plot_time_series() draws such a chart on a page.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+METHODS = ("minmax", "lttb")
+
+
+def _buckets(length, n_buckets):
+    """Start positions of n_buckets buckets of equal row count."""
+    return np.linspace(0, length, n_buckets + 1).astype("int64")
+
+
+def _gap_indices(values, edges):
+    """First missing value of each bucket that has one."""
+    missing = np.flatnonzero(np.isnan(values))
+    if not len(missing):
+        return missing
+    bucket = np.searchsorted(edges, missing, side="right") - 1
+    first = np.ones(len(missing), dtype=bool)
+    first[1:] = bucket[1:] != bucket[:-1]
+    return missing[first]
+
+
+def minmax_indices(values, n_out):
+    """
+    Indices of the minimum and maximum of every bucket.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        float values, NaN for missing
+    n_out : int
+        Number of points to keep, two per bucket
+
+    Returns
+    -------
+    np.ndarray
+        Sorted row indices, including the first missing value of each
+        bucket so that gaps are not bridged
+    """
+    length = len(values)
+    n_buckets = max(1, n_out // 2)
+    if length <= n_out:
+        return np.arange(length)
+    size = -(-length // n_buckets)
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:length] = values
+    padded = padded.reshape(n_buckets, size)
+    valid = ~np.isnan(padded).all(axis=1)
+    offsets = np.arange(n_buckets) * size
+    lows = np.where(np.isnan(padded), np.inf, padded).argmin(axis=1)
+    highs = np.where(np.isnan(padded), -np.inf, padded).argmax(axis=1)
+    edges = np.append(offsets, length)
+    indices = np.concatenate(
+        [
+            (offsets + lows)[valid],
+            (offsets + highs)[valid],
+            _gap_indices(values, edges),
+            [0, length - 1],
+        ]
+    )
+    return np.unique(indices)
+
+
+def lttb_indices(x, values, n_out):
+    """
+    Indices selected by Largest-Triangle-Three-Buckets (Steinarsson,
+    2013), computed on the non-missing values.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Monotonic positions, e.g. the time stamps as integers
+    values : np.ndarray
+        float values, NaN for missing
+    n_out : int
+        Number of points to keep
+
+    Returns
+    -------
+    np.ndarray
+        Sorted row indices, including the first missing value of each
+        bucket so that gaps are not bridged
+    """
+    length = len(values)
+    if length <= n_out:
+        return np.arange(length)
+    valid = np.flatnonzero(~np.isnan(values))
+    if len(valid) <= max(n_out, 2):
+        selected = valid
+    else:
+        xs = x[valid].astype("float64")
+        ys = values[valid]
+        edges = _buckets(len(valid) - 2, n_out - 2) + 1
+        selected = np.empty(n_out, dtype="int64")
+        selected[0] = 0
+        selected[-1] = len(valid) - 1
+        previous = 0
+        for bucket in range(n_out - 2):
+            start, stop = edges[bucket], edges[bucket + 1]
+            if bucket + 2 < len(edges):
+                after = slice(edges[bucket + 1], edges[bucket + 2])
+            else:
+                after = slice(len(valid) - 1, len(valid))
+            x_mean = xs[after].mean()
+            y_mean = ys[after].mean()
+            areas = np.abs(
+                (xs[previous] - x_mean) * (ys[start:stop] - ys[previous])
+                - (xs[previous] - xs[start:stop]) * (y_mean - ys[previous])
+            )
+            previous = start + int(areas.argmax())
+            selected[bucket + 1] = previous
+        selected = valid[selected]
+    gaps = _gap_indices(values, _buckets(length, max(1, n_out)))
+    return np.unique(np.concatenate([selected, gaps]))
+
+
+def downsample(data_frame, columns=None, max_points=2000, method="minmax"):
+    """
+    Rows of a time series frame needed to draw it with a budget of
+    points per column.
+
+    Parameters
+    ----------
+    data_frame : pd.DataFrame
+        Time series with a DatetimeIndex
+    columns : list of str, optional
+        Columns to plot, by default all
+    max_points : int, optional
+        Points per column, by default 2000
+    method : str, optional
+        "minmax" or "lttb", by default "minmax"
+
+    Returns
+    -------
+    pd.DataFrame
+        The union of the rows selected for each column, or data_frame
+        itself if it is short enough
+    """
+    if method not in METHODS:
+        raise ValueError(
+            "Unknown downsampling method {:}, use one of {:}".format(
+                method, METHODS
+            )
+        )
+    columns = list(data_frame.columns if columns is None else columns)
+    data_frame = data_frame[columns]
+    if len(data_frame) <= max_points:
+        return data_frame
+
+    x = data_frame.index.asi8 if hasattr(data_frame.index, "asi8") else None
+    if x is None:
+        x = np.arange(len(data_frame))
+    indices = []
+    for column in columns:
+        values = pd.to_numeric(data_frame[column], errors="coerce")
+        values = values.to_numpy(dtype="float64", na_value=np.nan)
+        if method == "lttb":
+            indices.append(lttb_indices(x, values, max_points))
+        else:
+            indices.append(minmax_indices(values, max_points))
+    if not indices:
+        return data_frame.iloc[:0]
+    return data_frame.iloc[np.unique(np.concatenate(indices))]
+
+
+def align_bound(bound, tz):
+    """
+    A time bound as pd.Timestamp comparable with an index in time zone
+    tz. Naive bounds are taken in tz. None stays None.
+    """
+    if bound is None:
+        return None
+    bound = pd.Timestamp(bound)
+    if tz is not None and bound.tzinfo is None:
+        bound = bound.tz_localize(tz)
+    elif tz is None and bound.tzinfo is not None:
+        bound = bound.tz_convert(None)
+    return bound
+
+
+def visible(data_frame, start=None, end=None):
+    """
+    Rows of data_frame between start and end (inclusive). Naive bounds
+    are taken in the time zone of the index.
+    """
+    tz = getattr(data_frame.index, "tz", None)
+    bounds = [align_bound(bound, tz) for bound in (start, end)]
+    if bounds == [None, None]:
+        return data_frame
+    return data_frame.loc[bounds[0] : bounds[1]]
+
+
+# points per column sent to the browser by plot_time_series()
+PLOT_POINTS = int(os.environ.get("NEPTOON_GUI_PLOT_POINTS", 2000))
+
+
+def plot_time_series(
+    container, data_frame, columns, key, method="minmax", **kwargs
+):
+    """
+    Line chart of time series columns, downsampled to PLOT_POINTS per
+    column (see neptoon_gui_plot.py). For longer series, a slider sets
+    the visible range and selecting a box on the chart zooms into it;
+    the data is downsampled again for the visible range, so zooming
+    in shows more detail.
+
+    Parameters
+    ----------
+    container : DeltaGenerator
+        Where the chart is drawn, e.g. st or a tab
+    data_frame : pd.DataFrame
+        Time series with a DatetimeIndex
+    columns : list of str
+        Columns to plot
+    key : str
+        Unique key of the chart
+    method : str, optional
+        "minmax" or "lttb", by default "minmax"
+    **kwargs
+        Passed to plotly.express.line()
+    """
+    import plotly.express as px
+
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    data = data_frame[columns]
+    zoomable = isinstance(data.index, pd.DatetimeIndex) and (
+        len(data) > PLOT_POINTS
+    )
+    range_key = key + "_range"
+    if zoomable:
+        index = data.index
+        if index.tz is not None:
+            index = index.tz_localize(None)
+        first, last = index.min().to_pydatetime(), index.max().to_pydatetime()
+        zoom = st.session_state.pop(key + "_zoom", None)
+        if zoom is not None:
+            st.session_state[range_key] = zoom
+        stored = st.session_state.get(range_key)
+        if stored is not None:
+            start, end = max(stored[0], first), min(stored[1], last)
+            if start < end:
+                st.session_state[range_key] = (start, end)
+            else:
+                del st.session_state[range_key]
+        # the default is only given when the range is not set already
+        value = (
+            {} if range_key in st.session_state else dict(value=(first, last))
+        )
+        step = max((last - first) / 1000, pd.Series(index).diff().median())
+        start, end = container.slider(
+            "Visible range",
+            min_value=first,
+            max_value=last,
+            step=pd.Timedelta(step).ceil("min").to_pytimedelta(),
+            format="YYYY-MM-DD HH:mm",
+            key=range_key,
+            help="Select a box on the chart to zoom in. The chart shows "
+            "at most {:} points per column.".format(PLOT_POINTS),
+            **value,
+        )
+        data = visible(data, start, end)
+
+    figure = px.line(
+        downsample(data, columns, max_points=PLOT_POINTS, method=method),
+        y=columns,
+        **kwargs,
+    )
+    if not zoomable:
+        container.plotly_chart(figure, use_container_width=True, key=key)
+        return
+
+    event = container.plotly_chart(
+        figure,
+        use_container_width=True,
+        key=key,
+        on_select="rerun",
+        selection_mode="box",
+    )
+    boxes = event.selection.get("box", []) if event else []
+    box = tuple(boxes[0].get("x", ())) if boxes else None
+    if box and box != st.session_state.get(key + "_box"):
+        st.session_state[key + "_box"] = box
+        start, end = sorted(pd.Timestamp(x).to_pydatetime() for x in box[:2])
+        start, end = start.replace(tzinfo=None), end.replace(tzinfo=None)
+        if start < end:
+            st.session_state[key + "_zoom"] = (start, end)
+            st.rerun()
@@ -0,0 +1,201 @@
+"""
+Timing and memory of the processing stages.
+
+Every stage run through the GUI, and every step of
+ProcessWithYaml.run_full_process(), is recorded with its wall time, the
+CPU time of its thread, the peak resident memory of the app process
+while it ran, and the number of rows of the data afterwards. The records
+are shown on the Performance page, can be exported as JSON, and the
+timings of a full run are reported to the Magazine, so that they appear
+in the PDF report.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# Magazine topic published in the PDF report by neptoon
+MAGAZINE_TOPIC = "Data Preparation"
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes():
+    """Resident memory of the process, its peak if unavailable."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        # ru_maxrss is in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _PeakSampler(threading.Thread):
+    """Samples the resident memory until stopped."""
+
+    def __init__(self, interval=0.02):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = rss_bytes()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, rss_bytes())
+        return self.peak
+
+
+class Profiler:
+    """
+    Thread-safe record of stage timings.
+
+    Parameters
+    ----------
+    keep : int, optional
+        Number of records kept, by default 500
+
+    Examples
+    --------
+    >>> profiler = Profiler()
+    >>> with profiler.stage("Run all", "correct_neutrons", rows=count):
+    ...     process._correct_neutrons()
+    >>> profiler.to_json()
+    """
+
+    def __init__(self, keep=500):
+        self._records = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    @contextmanager
+    def stage(self, run, stage, rows=None):
+        """
+        Record the block as a stage.
+
+        Parameters
+        ----------
+        run : str
+            Name of the run the stage belongs to, e.g. "Run all"
+        stage : str
+            Name of the stage
+        rows : callable, optional
+            Returns the number of rows after the stage
+
+        Yields
+        ------
+        dict
+            The record, which the block can add fields to
+        """
+        record = dict(
+            run=run,
+            stage=stage,
+            started=datetime.now().isoformat(timespec="seconds"),
+        )
+        sampler = _PeakSampler()
+        sampler.start()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+            record["status"] = "ok"
+        except BaseException:
+            record["status"] = "failed"
+            raise
+        finally:
+            record["wall_s"] = time.perf_counter() - wall
+            record["cpu_s"] = time.thread_time() - cpu
+            record["peak_rss_mb"] = sampler.stop() / 2**20
+            try:
+                record["rows"] = rows() if rows else None
+            except Exception:
+                record["rows"] = None
+            with self._lock:
+                self._records.append(record)
+
+    def records(self, run=None, latest=False):
+        """
+        Copies of the records, of one run if given, oldest first. With
+        latest, only the last record of each stage is kept, e.g. for a
+        run whose stages were repeated in a session.
+        """
+        with self._lock:
+            records = [
+                dict(record)
+                for record in self._records
+                if run is None or record["run"] == run
+            ]
+        if latest:
+            last = {record["stage"]: i for i, record in enumerate(records)}
+            records = [records[i] for i in sorted(last.values())]
+        return records
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.records(), **kwargs)
+
+    def to_magazine(self, run, latest=False):
+        """
+        Report the timings of a run to the Magazine, of the last record
+        of each stage only with latest (see records()).
+        """
+        from magazine import Magazine
+
+        records = self.records(run, latest=latest)
+        if not records:
+            return
+        Magazine.report(
+            MAGAZINE_TOPIC,
+            "Processing time: {:.1f} s in total. {:}.",
+            sum(record["wall_s"] for record in records),
+            ", ".join(
+                "{:} {:.1f} s".format(record["stage"], record["wall_s"])
+                for record in records
+            ),
+        )
+
+
+def data_rows(process):
+    """Rows of the data hub of a processor, None without one."""
+    hub = getattr(process, "data_hub", None)
+    frame = getattr(hub, "crns_data_frame", None)
+    return None if frame is None else len(frame)
+
+
+def instrument(process, profiler, run):
+    """
+    Record the steps of ProcessWithYaml.run_full_process() of a
+    (detached) processor. The timings up to the saving are reported to
+    the Magazine before the data and the PDF report are saved.
+    """
+    from neptoon_gui_jobs import FULL_PROCESS_STEPS
+
+    def wrap(name, method):
+        def profiled(*args, **kwargs):
+            if name == "_save_data":
+                profiler.to_magazine(run)
+            with profiler.stage(
+                run, name.lstrip("_"), rows=lambda: data_rows(process)
+            ):
+                return method(*args, **kwargs)
+
+        return profiled
+
+    for name in dict(FULL_PROCESS_STEPS):
+        method = getattr(process, name, None)
+        if method is not None:
+            setattr(process, name, wrap(name, method))
+    return process
@@ -0,0 +1,407 @@
+"""
+Vectorized quality assessment.
+
+neptoon builds one saqc check per configured entry and masks the whole
+crns_data_frame after every section. Here all checks configured for a
+section are compiled per target column and evaluated in one pass over
+its values with numpy: the point checks (flag_range, greater_than_N0,
+below_N0_factor) first, then the checks that look at neighbouring
+values (rate_of_change, persistance_check, spike_uni_lof, spike_hampel)
+on the values that passed. Every check sets its bit in an integer flag
+per value, so that one masking per column suffices. Spikes are found
+with saqc's flagUniLOF, on this one column, or with the faster Hampel
+filter of neptoon_gui_spikes.
+
+In flags_data_frame, a value stays "UNFLAGGED" or gets a label naming
+its checks, e.g. "BAD: flag_range", so that neptoon's masking and saving
+(flags == "UNFLAGGED") work as before.
+
+Checks in the YAML files, under a target such as raw_neutrons or
+air_relative_humidity::
+
+    flag_range: {min: 0, max: 100}
+    greater_than_N0: {percent_maximum: 1.075}
+    below_N0_factor: {percent_minimum: 0.3}
+    spike_uni_lof: {periods_in_calculation: 12, threshold: 1.5}
+    spike_hampel: {window: 25, threshold: 5}
+    rate_of_change: {max_change: 300}          # per time step
+    persistance_check: {window: 12, threshold: 0, min_periods: 6}
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+# bit of every check in the flag of a value, in the order of evaluation
+CHECK_BITS = dict(
+    flag_range=1,
+    greater_than_N0=2,
+    below_N0_factor=4,
+    rate_of_change=8,
+    persistance_check=16,
+    spike_uni_lof=32,
+    spike_hampel=64,
+)
+
+UNFLAGGED = "UNFLAGGED"
+
+
+def target_column(name):
+    """Column of a QA target of the YAML files, e.g. raw_neutrons."""
+    from neptoon.quality_control.saqc_methods_and_params import (
+        QATarget,
+        YamlRegistry,
+    )
+
+    if name == "air_humidity":
+        # field name of neptoon's QAConfig for air_relative_humidity
+        return QATarget.RELATIVE_HUMIDITY.value
+    return YamlRegistry.get_target(name).value
+
+
+def _params(value):
+    if value is None:
+        return None
+    if hasattr(value, "model_dump"):
+        return value.model_dump()
+    return dict(value)
+
+
+def compile_checks(partial_config, name_of_target=None, N0=None):
+    """
+    Checks of a config section, grouped by target column.
+
+    Parameters
+    ----------
+    partial_config : BaseConfig
+        E.g. process_config.neutron_quality_assessment or
+        sensor_config.input_data_qa
+    name_of_target : str, optional
+        Only this target of the section, e.g. "raw_neutrons", by
+        default all of them
+    N0 : float, optional
+        N0 for the greater_than_N0 and below_N0_factor checks, which
+        are skipped without it
+
+    Returns
+    -------
+    dict
+        Column name: list of (check name, parameters), in the order of
+        CHECK_BITS
+    """
+    if partial_config is None:
+        return {}
+    sections = partial_config.model_dump()
+    if name_of_target is not None:
+        sections = {name_of_target: sections.get(name_of_target)}
+
+    checks = {}
+    for target, section in sections.items():
+        if not isinstance(section, dict):
+            continue
+        compiled = []
+        for name in CHECK_BITS:
+            params = _params(section.get(name))
+            if params is None:
+                continue
+            if name in ("greater_than_N0", "below_N0_factor"):
+                if N0 is None:
+                    continue
+                params["N0"] = N0
+            compiled.append((name, params))
+        unknown = set(section) - set(CHECK_BITS)
+        unknown = [key for key in unknown if section[key] is not None]
+        if unknown:
+            raise ValueError(
+                "Unknown quality checks for {:}: {:}".format(
+                    target, ", ".join(sorted(unknown))
+                )
+            )
+        if compiled:
+            column = target_column(target)
+            checks.setdefault(column, []).extend(compiled)
+    return checks
+
+
+def _flag_range(values, index, params):
+    low = params.get("min")
+    high = params.get("max")
+    low = -np.inf if low is None else low
+    high = np.inf if high is None else high
+    with np.errstate(invalid="ignore"):
+        return (values < low) | (values > high)
+
+
+def _greater_than_n0(values, index, params):
+    with np.errstate(invalid="ignore"):
+        return values > params["N0"] * params["percent_maximum"]
+
+
+def _below_n0_factor(values, index, params):
+    with np.errstate(invalid="ignore"):
+        return values < params["N0"] * params["percent_minimum"]
+
+
+def _rate_of_change(values, index, params):
+    """Values that differ from the previous valid one by max_change."""
+    flagged = np.zeros(len(values), dtype=bool)
+    valid = np.flatnonzero(np.isfinite(values))
+    if len(valid) > 1:
+        change = np.abs(np.diff(values[valid]))
+        flagged[valid[1:]] = change > params["max_change"]
+    return flagged
+
+
+def _persistance_check(values, index, params):
+    """
+    Values within windows of window values, at least min_periods of
+    them valid, that vary by threshold at most, like saqc's
+    flagConstants.
+    """
+    window = int(params.get("window") or 0)
+    if window < 2:
+        return np.zeros(len(values), dtype=bool)
+    threshold = params.get("threshold") or 0
+    min_periods = int(params.get("min_periods") or window)
+    series = pd.Series(values)
+    rolling = series.rolling(window, min_periods=min_periods)
+    constant = (rolling.max() - rolling.min() <= threshold).to_numpy()
+    # a constant window ending at j flags the values j-window+1 ... j
+    ends = pd.Series(constant[::-1].astype(float))
+    covered = ends.rolling(window, min_periods=1).max().to_numpy()[::-1]
+    return (covered > 0) & np.isfinite(values)
+
+
+def _spike_uni_lof(values, index, params):
+    from saqc import SaQC
+
+    column = "values"
+    qc = SaQC(pd.DataFrame({column: values}, index=index), scheme="simple")
+    qc = qc.flagUniLOF(
+        field=column,
+        n=params.get("periods_in_calculation") or 20,
+        thresh=params.get("threshold") or 1.5,
+        algorithm=params.get("algorithm") or "ball_tree",
+    )
+    return (qc.flags.to_pandas()[column] != UNFLAGGED).to_numpy()
+
+
+def _spike_hampel(values, index, params):
+    from neptoon_gui_spikes import (
+        DEFAULT_THRESHOLD,
+        DEFAULT_WINDOW,
+        hampel_flags,
+    )
+
+    return hampel_flags(
+        values,
+        window=params.get("window") or DEFAULT_WINDOW,
+        threshold=params.get("threshold") or DEFAULT_THRESHOLD,
+    )
+
+
+CHECKS = dict(
+    flag_range=_flag_range,
+    greater_than_N0=_greater_than_n0,
+    below_N0_factor=_below_n0_factor,
+    rate_of_change=_rate_of_change,
+    persistance_check=_persistance_check,
+    spike_uni_lof=_spike_uni_lof,
+    spike_hampel=_spike_hampel,
+)
+
+
+def flag_column(values, index, checks, report=None, column=None):
+    """
+    Evaluate the checks of a column.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Values of the column
+    index : pd.DatetimeIndex
+        Their timestamps
+    checks : list of tuple
+        (check name, parameters), see compile_checks()
+    report : list, optional
+        Gets a dict with column, check, flagged and seconds per check
+    column : str, optional
+        Column name for the report
+
+    Returns
+    -------
+    np.ndarray
+        Bit flags of the values, see CHECK_BITS
+    """
+    values = np.asarray(values, dtype="float64")
+    bits = np.zeros(len(values), dtype="uint8")
+    for name, params in checks:
+        start = time.perf_counter()
+        # checks see the values that passed the checks before them
+        passed = np.where(bits == 0, values, np.nan)
+        flagged = CHECKS[name](passed, index, params) & (bits == 0)
+        bits[flagged] |= CHECK_BITS[name]
+        if report is not None:
+            report.append(
+                dict(
+                    column=column,
+                    check=name,
+                    flagged=int(flagged.sum()),
+                    seconds=time.perf_counter() - start,
+                )
+            )
+    return bits
+
+
+def flag_labels(bits):
+    """Labels of bit flags for flags_data_frame, as a categorical."""
+    codes, inverse = np.unique(bits, return_inverse=True)
+    labels = []
+    for code in codes:
+        names = [name for name, bit in CHECK_BITS.items() if code & bit]
+        labels.append("BAD: " + ", ".join(names) if names else UNFLAGGED)
+    return pd.Categorical.from_codes(inverse.reshape(-1), labels)
+
+
+def flags_frame(data_hub):
+    """
+    Shallow copy of the flags_data_frame of a data hub, or a new one
+    with all values "UNFLAGGED" if there is none.
+    """
+    if data_hub.flags_data_frame is None:
+        return pd.DataFrame(
+            UNFLAGGED,
+            index=data_hub.crns_data_frame.index,
+            columns=data_hub.crns_data_frame.columns,
+        )
+    return data_hub.flags_data_frame.copy(deep=False)
+
+
+def label_flags(flags_data_frame, column, bits):
+    """
+    Label the values of a column flagged by bit flags in
+    flags_data_frame, in place. Values already flagged keep their
+    label.
+
+    Returns
+    -------
+    np.ndarray
+        True for the flagged values
+    """
+    flagged = bits != 0
+    if not flagged.any():
+        if column not in flags_data_frame.columns:
+            flags_data_frame[column] = UNFLAGGED
+        return flagged
+    labels = pd.Series(flag_labels(bits), index=flags_data_frame.index)
+    labels = labels.astype(object)
+    if column in flags_data_frame.columns:
+        labels = (
+            flags_data_frame[column].astype(object).where(~flagged, labels)
+        )
+    flags_data_frame[column] = labels
+    return flagged
+
+
+def assess_quality(data_hub, checks):
+    """
+    Apply compiled checks to a data hub.
+
+    The checked values are set to NaN in crns_data_frame and labelled
+    in flags_data_frame, which is created with all values "UNFLAGGED"
+    if there is none. Values already flagged keep their label.
+
+    Parameters
+    ----------
+    data_hub : CRNSDataHub
+        Data hub, changed in place
+    checks : dict
+        See compile_checks()
+
+    Returns
+    -------
+    pd.DataFrame
+        column, check, flagged and seconds per check
+    """
+    report = []
+    flags_data_frame = flags_frame(data_hub)
+    crns_data_frame = data_hub.crns_data_frame.copy(deep=False)
+
+    for column, column_checks in checks.items():
+        if column not in crns_data_frame.columns:
+            continue
+        bits = flag_column(
+            crns_data_frame[column].to_numpy(),
+            crns_data_frame.index,
+            column_checks,
+            report=report,
+            column=column,
+        )
+        flagged = label_flags(flags_data_frame, column, bits)
+        if flagged.any():
+            crns_data_frame[column] = crns_data_frame[column].mask(flagged)
+
+    data_hub.crns_data_frame = crns_data_frame
+    data_hub.flags_data_frame = flags_data_frame
+    return pd.DataFrame(
+        report, columns=["column", "check", "flagged", "seconds"]
+    )
+
+
+def apply_quality_assessment(
+    process, partial_config, name_of_target=None, stage="run"
+):
+    """
+    Replacement for ProcessWithYaml._apply_quality_assessment().
+
+    The report is also added to process.quality_reports[stage].
+
+    Returns
+    -------
+    pd.DataFrame
+        Report of the checks, see assess_quality()
+    """
+    checks = compile_checks(
+        partial_config,
+        name_of_target=name_of_target,
+        N0=process.sensor_config.sensor_info.N0,
+    )
+    report = assess_quality(process.data_hub, checks)
+    record_quality_report(process, stage, report)
+    return report
+
+
+def record_quality_report(process, stage, report):
+    """Keep a report of checks in process.quality_reports[stage]."""
+    reports = getattr(process, "quality_reports", None)
+    if reports is None:
+        reports = process.quality_reports = {}
+    reports.setdefault(stage, []).append(report)
+
+
+def quality_report(process, stage):
+    """
+    Reports of the checks of a stage in one table, None if there are
+    none, e.g. if the stage was restored from the stage cache.
+    """
+    reports = getattr(process, "quality_reports", None) or {}
+    if not reports.get(stage):
+        return None
+    return pd.concat(reports[stage], ignore_index=True)
+
+
+def clear_quality_reports(process, stage):
+    reports = getattr(process, "quality_reports", None)
+    if reports:
+        reports.pop(stage, None)
+
+
+def use_vectorized_quality(process):
+    """Let ProcessWithYaml.run_full_process() use the vectorized checks."""
+    process._apply_quality_assessment = (
+        lambda partial_config, name_of_target=None: apply_quality_assessment(
+            process, partial_config, name_of_target
+        )
+    )
+    return process
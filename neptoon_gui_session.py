@@ -0,0 +1,154 @@
+"""
+Process-wide resources and session state shared by the pages.
+
+Resources are created once per server process with st.cache_resource,
+the state of a session is kept in st.session_state. The topic modules
+behind them do not depend on Streamlit, so that the batch and benchmark
+scripts can use them as well.
+"""
+
+import os
+
+import streamlit as st
+
+
+@st.cache_resource
+def get_nmdb_store():
+    """
+    Process-wide NMDB store. Set NEPTOON_GUI_NMDB_FIXTURE to a local
+    file in NMDB ASCII format to work without network access.
+    """
+    from neptoon_gui_nmdb import NMDBStore, FixtureFetcher
+
+    fixture = os.environ.get("NEPTOON_GUI_NMDB_FIXTURE")
+    return NMDBStore(fetcher=FixtureFetcher(fixture) if fixture else None)
+
+
+# session flags telling that a stage has been run
+STAGE_FLAGS = dict(
+    parse="data_parsed",
+    nmdb="data_nmdb_attached",
+    quality="data_quality_checked",
+    corrections="data_corrections_made",
+    calibration="calibration_finished",
+    soil_moisture="data_converted",
+)
+
+
+@st.cache_resource
+def get_stage_cache():
+    """
+    Process-wide cache of stage outputs. Its budget can be set in MB
+    with NEPTOON_GUI_STAGE_CACHE_MB (default 512).
+    """
+    from neptoon_gui_stages import StageCache
+
+    budget = float(os.environ.get("NEPTOON_GUI_STAGE_CACHE_MB", 512))
+    return StageCache(max_bytes=int(budget * 2**20))
+
+
+@st.cache_resource
+def get_dataset_registry():
+    """
+    Process-wide registry of parsed datasets, shared read-only by all
+    sessions. Its budget can be set in MB with NEPTOON_GUI_DATASETS_MB
+    (default 1024).
+    """
+    from neptoon_gui_datasets import DatasetRegistry
+
+    budget = float(os.environ.get("NEPTOON_GUI_DATASETS_MB", 1024))
+    return DatasetRegistry(max_bytes=int(budget * 2**20))
+
+
+# run name of the stages started on the processing pages
+STAGES_RUN = "Stages"
+
+
+def get_profiler():
+    """Stage timings of the session, see neptoon_gui_profile.py."""
+    from neptoon_gui_profile import Profiler
+
+    if "profiler" not in st.session_state:
+        st.session_state["profiler"] = Profiler()
+    return st.session_state["profiler"]
+
+
+def compact_session_hub():
+    """
+    Compact the frames of the session's data hub (see
+    neptoon_gui_compact.py) if this is turned on in the sidebar.
+    """
+    from neptoon_gui_compact import compact_hub
+
+    process = st.session_state.get("yaml")
+    hub = getattr(process, "data_hub", None)
+    if st.session_state.get("data_compact") and hub is not None:
+        compact_hub(hub)
+
+
+def session_memory_report():
+    """
+    Memory report of the session's data hub (see memory_report()), kept
+    until its frames change, as the deep scan of object columns takes
+    long for large data. None without a data hub.
+    """
+    from neptoon_gui_compact import hub_key, memory_report
+
+    hub = getattr(st.session_state.get("yaml"), "data_hub", None)
+    if hub is None:
+        return None
+    key = hub_key(hub)
+    cached = st.session_state.get("memory_report")
+    if cached is None or cached[0] != key:
+        cached = st.session_state["memory_report"] = (key, memory_report(hub))
+    return cached[1]
+
+
+def run_cached_stage(stage, compute, **params):
+    """
+    Run a processing stage of st.session_state["yaml"] through the
+    stage cache and reset the flags of the stages after it.
+
+    Parameters
+    ----------
+    stage : str
+        One of neptoon_gui_stages.STAGES
+    compute : callable
+        Runs the stage, called without arguments
+    **params
+        Stage settings given in the GUI, part of the cache key
+
+    Returns
+    -------
+    bool
+        True if the output was restored from the cache
+    """
+    from neptoon_gui_profile import data_rows
+    from neptoon_gui_stages import STAGES, run_stage, stage_config
+
+    process = st.session_state["yaml"]
+    if st.session_state.get("data_compact"):
+        # compact outputs are cached apart from the full ones
+        params["compact"] = True
+
+    def compute_and_compact():
+        compute()
+        compact_session_hub()
+
+    with get_profiler().stage(
+        STAGES_RUN, stage, rows=lambda: data_rows(process)
+    ) as record:
+        hit = record["cached"] = run_stage(
+            process,
+            stage,
+            stage_config(process, stage, **params),
+            compute_and_compact,
+            cache=(
+                get_dataset_registry()
+                if stage == STAGES[0]
+                else get_stage_cache()
+            ),
+        )
+    for later in STAGES[STAGES.index(stage) + 1 :]:
+        st.session_state[STAGE_FLAGS[later]] = False
+    return hit
@@ -0,0 +1,322 @@
+"""
+Vectorized soil moisture conversion with uncertainty bounds.
+
+neptoon converts the corrected neutrons, both count bounds and the
+measurement depth with one row-wise DataFrame.apply() each, and the
+*Soil moisture* page then masked values outside their physical range
+with two .loc passes per column. Here the Poisson uncertainty of the
+neutrons, the count bounds, the soil moisture with its bounds and the
+measurement depth are computed from arrays in one pass, with the same
+formulas as neptoon. The soil moisture checks of the sensor YAML and
+the physical ranges are applied to the arrays before they are written,
+so every column is written once.
+
+Like in neptoon, the upper soil moisture bound comes from the lower
+count bound and vice versa, and the depth is computed from the soil
+moisture before it is checked or masked.
+"""
+
+import numpy as np
+
+# values outside are physically impossible and set to NaN
+PHYSICAL_RANGES = dict(
+    soil_moisture=(0, 1),
+    soil_moisture_uncertainty_lower=(0, 1),
+    soil_moisture_uncertainty_upper=(0, 1),
+    crns_measurement_depth=(0, 100),
+)
+
+# radius (m) at which neptoon computes the measurement depth
+DEPTH_RADIUS = 50
+
+# neptoon's defaults for parameters missing from the sensor YAML
+DEFAULT_BULK_DENSITY = 1.42
+
+# water equivalent of soil organic matter per soil organic carbon
+WSOM_PER_SOC = 0.556
+
+
+def _values(data_frame, column, dtype):
+    if column not in data_frame:
+        raise ValueError("Required column is missing: {:}".format(column))
+    return np.ascontiguousarray(data_frame[column].to_numpy(dtype=dtype))
+
+
+def neutrons_to_soil_moisture(
+    neutrons,
+    n0,
+    dry_soil_bulk_density,
+    lattice_water,
+    soil_organic_carbon,
+    out=None,
+):
+    """
+    Desilets et al. (2010) conversion, as neptoon computes it but in
+    place on one array, which can be given as out.
+    """
+    a0, a1, a2 = 0.0808, 0.372, 0.115
+    wsom = soil_organic_carbon * WSOM_PER_SOC
+    theta = np.divide(neutrons, n0, out=out)
+    theta -= a1
+    np.divide(a0, theta, out=theta)
+    theta -= a2
+    theta -= lattice_water
+    theta -= wsom
+    theta *= dry_soil_bulk_density
+    return theta
+
+
+def measurement_depth(soil_moisture, dry_soil_bulk_density, radius):
+    """Schrön et al. (2017) D86 in cm, as neptoon computes it."""
+    return (
+        1
+        / dry_soil_bulk_density
+        * (
+            8.321
+            + 0.14249
+            # a Python float, which keeps float32 arrays float32
+            * (0.96655 + float(np.exp(-0.01 * radius)))
+            * (20 + soil_moisture)
+            / (0.0429 + soil_moisture)
+        )
+    )
+
+
+def soil_moisture_columns(
+    data_frame,
+    n0,
+    dry_soil_bulk_density=None,
+    lattice_water=None,
+    soil_organic_carbon=None,
+    radius=DEPTH_RADIUS,
+    dtype="float64",
+):
+    """
+    Neutron uncertainty, count bounds, soil moisture, its bounds and
+    the measurement depth from the corrected neutrons.
+
+    Parameters
+    ----------
+    data_frame : pd.DataFrame
+        crns_data_frame with the raw and final corrected neutrons
+    n0 : float
+        N0 calibration term
+    dry_soil_bulk_density : float, optional
+        In g/cm³, by default 1.42 as in neptoon
+    lattice_water, soil_organic_carbon : float, optional
+        In decimal percent, by default 0
+    radius : float, optional
+        Distance (m) of the measurement depth
+    dtype : str, optional
+        "float64", or "float32" to compute and store the columns at
+        single precision
+
+    Returns
+    -------
+    dict
+        New arrays by column name
+    """
+    from neptoon.columns import ColumnInfo
+
+    if n0 is None:
+        raise ValueError(
+            "Cannot convert to soil moisture without an N0 number."
+        )
+    name = ColumnInfo.Name
+    if dry_soil_bulk_density is None:
+        dry_soil_bulk_density = DEFAULT_BULK_DENSITY
+    lattice_water = lattice_water or 0
+    soil_organic_carbon = soil_organic_carbon or 0
+
+    # scalars as arrays of the dtype keep float32 from being promoted
+    n0, dry_soil_bulk_density, lattice_water, soil_organic_carbon = (
+        np.asarray(value, dtype=dtype)
+        for value in (
+            n0,
+            dry_soil_bulk_density,
+            lattice_water,
+            soil_organic_carbon,
+        )
+    )
+    neutrons = _values(
+        data_frame, str(name.CORRECTED_EPI_NEUTRON_COUNT_FINAL), dtype
+    )
+    raw = _values(data_frame, str(name.EPI_NEUTRON_COUNT_RAW), dtype)
+    parameters = (
+        n0,
+        dry_soil_bulk_density,
+        lattice_water,
+        soil_organic_carbon,
+    )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        uncertainty = 1 / np.sqrt(raw) * neutrons
+        upper_count = neutrons + uncertainty
+        lower_count = neutrons - uncertainty
+        soil_moisture = neutrons_to_soil_moisture(neutrons, *parameters)
+        depth = measurement_depth(soil_moisture, dry_soil_bulk_density, radius)
+        columns = {
+            str(name.CORRECTED_EPI_NEUTRON_COUNT_UNCERTAINTY): uncertainty,
+            str(name.CORRECTED_EPI_NEUTRON_COUNT_UPPER_COUNT): upper_count,
+            str(name.CORRECTED_EPI_NEUTRON_COUNT_LOWER_COUNT): lower_count,
+            str(name.SOIL_MOISTURE): soil_moisture,
+            # fewer neutrons mean more water
+            str(name.SOIL_MOISTURE_UNCERTAINTY_UPPER): (
+                neutrons_to_soil_moisture(lower_count, *parameters)
+            ),
+            str(name.SOIL_MOISTURE_UNCERTAINTY_LOWER): (
+                neutrons_to_soil_moisture(upper_count, *parameters)
+            ),
+            str(name.SOIL_MOISTURE_MEASURMENT_DEPTH): depth,
+        }
+    return columns
+
+
+def mask_columns(columns, ranges=PHYSICAL_RANGES, flagged=None):
+    """
+    Set the values outside their range or flagged to NaN, in place.
+
+    Parameters
+    ----------
+    columns : dict
+        Float arrays by column name
+    ranges : dict, optional
+        (minimum, maximum) by column name, see PHYSICAL_RANGES
+    flagged : dict, optional
+        Boolean arrays by column name, True for values to mask
+
+    Returns
+    -------
+    dict
+        Number of values set to NaN by column name
+    """
+    ranges = ranges or {}
+    flagged = flagged or {}
+    masked = {}
+    for column, values in columns.items():
+        if column not in ranges and column not in flagged:
+            continue
+        outside = np.zeros(len(values), dtype=bool)
+        if column in ranges:
+            low, high = ranges[column]
+            np.less(values, low, out=outside)
+            outside |= values > high
+        if column in flagged:
+            outside |= flagged[column]
+        values[outside] = np.nan
+        masked[column] = int(outside.sum())
+    return masked
+
+
+def produce_soil_moisture(
+    process,
+    partial_config=None,
+    ranges=None,
+    dtype="float64",
+    stage="run",
+):
+    """
+    Replacement for ProcessWithYaml._create_neutron_uncertainty_bounds()
+    and _produce_soil_moisture_estimates(), which can also apply the
+    soil moisture checks and the physical ranges in the same pass.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor with a data_hub and an N0
+    partial_config : optional
+        Checks, e.g. sensor_config.soil_moisture_qa. Checks of the new
+        columns are applied to the arrays, others to the data hub
+        afterwards, as apply_quality_assessment() does. By default none.
+    ranges : dict, optional
+        Physical ranges, see PHYSICAL_RANGES, by default none
+    dtype : str, optional
+        See soil_moisture_columns()
+    stage : str, optional
+        Stage of the quality report, see record_quality_report()
+
+    Returns
+    -------
+    pd.DataFrame or None
+        Report of the checks, None without partial_config
+    """
+    import pandas as pd
+    from magazine import Magazine
+    from neptoon_gui_quality import (
+        assess_quality,
+        compile_checks,
+        flag_column,
+        flags_frame,
+        label_flags,
+        record_quality_report,
+    )
+
+    sensor_info = process.sensor_config.sensor_info
+    parameters = dict(
+        n0=sensor_info.N0,
+        dry_soil_bulk_density=sensor_info.avg_dry_soil_bulk_density,
+        lattice_water=sensor_info.avg_lattice_water,
+        soil_organic_carbon=sensor_info.avg_soil_organic_carbon,
+    )
+    data_hub = process.data_hub
+    columns = soil_moisture_columns(
+        data_hub.crns_data_frame, dtype=dtype, **parameters
+    )
+
+    checks = {}
+    if partial_config is not None:
+        checks = compile_checks(partial_config, N0=sensor_info.N0)
+    report = []
+    flagged = {}
+    flags_data_frame = None
+    index = data_hub.crns_data_frame.index
+    for column in columns:
+        if column not in checks:
+            continue
+        if flags_data_frame is None:
+            flags_data_frame = flags_frame(data_hub)
+        bits = flag_column(
+            columns[column],
+            index,
+            checks.pop(column),
+            report=report,
+            column=column,
+        )
+        flagged[column] = label_flags(flags_data_frame, column, bits)
+    mask_columns(columns, ranges, flagged)
+
+    data_hub.crns_data_frame = data_hub.crns_data_frame.assign(**columns)
+    if flags_data_frame is not None:
+        data_hub.flags_data_frame = flags_data_frame
+    Magazine.report(
+        "Soil Moisture",
+        "Soil moisture was estimated using an n0 of {:}, a bulk density of "
+        "{:}, a lattice water content of {:}, and a soil organic carbon "
+        "content of {:}",
+        *parameters.values(),
+    )
+
+    if partial_config is None:
+        return None
+    # checks of columns the conversion does not write
+    report = pd.DataFrame(
+        report, columns=["column", "check", "flagged", "seconds"]
+    )
+    if checks:
+        report = pd.concat(
+            [report, assess_quality(data_hub, checks)], ignore_index=True
+        )
+    record_quality_report(process, stage, report)
+    return report
+
+
+def use_vectorized_soil_moisture(process, dtype="float64"):
+    """
+    Let ProcessWithYaml.run_full_process() use produce_soil_moisture(),
+    which adds the uncertainty bounds together with the soil moisture.
+    """
+    process._create_neutron_uncertainty_bounds = lambda: None
+    process._produce_soil_moisture_estimates = lambda: produce_soil_moisture(
+        process, dtype=dtype
+    )
+    return process
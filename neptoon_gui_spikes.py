@@ -0,0 +1,151 @@
+"""
+Fast approximate spike detection with a Hampel filter.
+
+A value is a spike if it deviates from the median of its window by more
+than threshold times the scaled median absolute deviation (MAD) of the
+window. The exact filter takes the MAD of every window around its own
+median; here the MAD is the rolling median of the deviations of the
+values from their own window medians, so that both are plain rolling
+medians, O(n log window) with pandas. saqc's flagUniLOF instead
+computes local outlier factors from the neighbourhoods of all values.
+
+HampelStream gives the same flags on data arriving in chunks, keeping
+only the values that later windows still need.
+
+Usage in the YAML files, next to or instead of spike_uni_lof::
+
+    neutron_quality_assessment:
+      raw_neutrons:
+        spike_hampel:
+          window: 25        # values, centred on the checked one
+          threshold: 5      # times the scaled MAD
+"""
+
+import numpy as np
+import pandas as pd
+
+# MAD of normally distributed values times this is their standard
+# deviation
+MAD_SCALE = 1.4826
+
+DEFAULT_WINDOW = 25
+DEFAULT_THRESHOLD = 5.0
+
+
+def _window(window):
+    """Odd window of at least 3 values, even ones are widened by one."""
+    return max(int(window), 3) // 2 * 2 + 1
+
+
+def _min_periods(window):
+    return max(1, window // 2)
+
+
+def hampel_scores(values, window=DEFAULT_WINDOW):
+    """
+    Deviations of values from their window medians, and the scaled MADs
+    they are compared with.
+
+    Parameters
+    ----------
+    values : array_like
+        Values in time order, NaN for missing or already flagged ones
+    window : int, optional
+        Values in the window around every value, odd
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Deviations and scaled MADs
+    """
+    window = _window(window)
+    values = pd.Series(np.asarray(values, dtype="float64"))
+    min_periods = _min_periods(window)
+    median = values.rolling(window, center=True, min_periods=min_periods)
+    deviation = (values - median.median()).abs()
+    mad = deviation.rolling(window, center=True, min_periods=min_periods)
+    return deviation.to_numpy(), MAD_SCALE * mad.median().to_numpy()
+
+
+def hampel_threshold(scores, threshold=DEFAULT_THRESHOLD):
+    """Spikes from hampel_scores(), True for spikes."""
+    deviation, scale = scores
+    with np.errstate(invalid="ignore"):
+        return deviation > threshold * scale
+
+
+def hampel_flags(values, window=DEFAULT_WINDOW, threshold=DEFAULT_THRESHOLD):
+    """
+    Spikes in a series of values.
+
+    Parameters
+    ----------
+    values : array_like
+        Values in time order, NaN for missing or already flagged ones
+    window : int, optional
+        Values in the window around every value, odd
+    threshold : float, optional
+        Deviations from the window median larger than this times the
+        scaled MAD are spikes
+
+    Returns
+    -------
+    np.ndarray
+        True for spikes
+    """
+    return hampel_threshold(hampel_scores(values, window), threshold)
+
+
+class HampelStream:
+    """
+    Hampel filter on values arriving in chunks.
+
+    The flag of a value depends on the values up to two half windows
+    after it, so flags are returned once these arrived; flush() returns
+    the remaining ones at the end of the data. Together the flags are
+    the same as those of hampel_flags() on all values.
+
+    Examples
+    --------
+    >>> stream = HampelStream(window=25, threshold=5)
+    >>> flags = [stream.push(chunk) for chunk in chunks]
+    >>> flags.append(stream.flush())
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, threshold=DEFAULT_THRESHOLD):
+        self.window = _window(window)
+        self.threshold = threshold
+        # a flag depends on the values of two half windows on each side
+        self.lag = self.window // 2 * 2
+        self.keep = 2 * self.lag
+        self.buffer = np.empty(0)
+        self.pending = 0
+
+    def _flags(self, values):
+        return hampel_flags(values, self.window, self.threshold)
+
+    def push(self, values):
+        """
+        Add values.
+
+        Returns
+        -------
+        np.ndarray
+            Flags of the values that are final now, the oldest first
+        """
+        values = np.asarray(values, dtype="float64")
+        data = np.concatenate([self.buffer, values])
+        # the last pending values of the buffer and the new ones
+        first = len(self.buffer) - self.pending
+        final = max(len(data) - self.lag, first)
+        flags = self._flags(data)[first:final]
+        self.pending = len(data) - final
+        self.buffer = data[-max(self.keep, self.pending) :]
+        return flags
+
+    def flush(self):
+        """Flags of the values still pending, at the end of the data."""
+        flags = self._flags(self.buffer)[len(self.buffer) - self.pending :]
+        self.buffer = np.empty(0)
+        self.pending = 0
+        return flags
@@ -0,0 +1,390 @@
+"""
+Content-addressed cache for the processing stages of the GUI.
+
+Every stage (parse, NMDB, quality, corrections, calibration, soil
+moisture) is keyed by a fingerprint of its input frames and of the
+config subtree it depends on. Its outputs are kept in a size-limited LRU
+cache shared across sessions, so that re-running a stage with unchanged
+inputs restores the result instead of recomputing it. A stage always
+starts from the output of the stage before it, which makes changing a
+downstream parameter recompute only that stage and the ones after it.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+STAGES = (
+    "parse",
+    "nmdb",
+    "quality",
+    "corrections",
+    "calibration",
+    "soil_moisture",
+)
+
+# sensor_info fields written by the calibration
+CALIBRATION_RESULTS = (
+    "N0",
+    "avg_dry_soil_bulk_density",
+    "avg_lattice_water",
+    "avg_soil_organic_carbon",
+)
+
+
+class StageCache:
+    """
+    Thread-safe LRU store of stage outputs with a size budget.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Budget for the frames, arrays and calibrators held, by default
+        512 MB. The least recently used entries are evicted first.
+
+    Examples
+    --------
+    >>> cache = StageCache(max_bytes=256 * 2**20)
+    >>> run_stage(process, "quality", config, make_quality_check, cache)
+    """
+
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Entry for key or None, marks it as recently used."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, entry):
+        """Store an entry and evict old ones beyond the budget."""
+        nbytes = entry_nbytes(entry)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (entry, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    @contextmanager
+    def loading(self, key):
+        """
+        Lock of a key, so that an entry computed by one session is
+        waited for by the others instead of computed again.
+        """
+        with self._lock:
+            lock, users = self._loading.get(key, (threading.Lock(), 0))
+            self._loading[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, users = self._loading[key]
+                if users == 1:
+                    del self._loading[key]
+                else:
+                    self._loading[key] = (lock, users - 1)
+
+
+def object_nbytes(value, seen=None, depth=6):
+    """
+    Memory of the frames, series and arrays reachable from value through
+    containers and object attributes up to depth levels, each counted
+    once. E.g. a CalibrationStation holds the sample frames, the time
+    series and the profiles of every calibration day.
+    """
+    seen = set() if seen is None else seen
+    if value is None or id(value) in seen or depth < 0:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (str, bytes, int, float, bool, type)) or callable(
+        value
+    ):
+        return 0
+    if isinstance(value, dict):
+        children = list(value.values())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        children = list(value)
+    else:
+        children = list(getattr(value, "__dict__", {}).values())
+        for name in getattr(type(value), "__slots__", ()):
+            children.append(getattr(value, name, None))
+    return sum(object_nbytes(child, seen, depth - 1) for child in children)
+
+
+def entry_nbytes(entry):
+    """
+    Memory of a stage output, including the calibrator. Objects shared
+    with other entries are counted in each of them.
+    """
+    return object_nbytes(entry)
+
+
+def frame_fingerprint(data_frame):
+    """SHA-256 of the values, index, columns and dtypes of a frame."""
+    digest = hashlib.sha256()
+    if data_frame is None:
+        return digest.hexdigest()
+    digest.update(repr(list(data_frame.columns)).encode())
+    digest.update(repr(list(data_frame.dtypes.astype(str))).encode())
+    digest.update(
+        pd.util.hash_pandas_object(data_frame, index=True).to_numpy().tobytes()
+    )
+    return digest.hexdigest()
+
+
+def config_fingerprint(*parts):
+    """
+    SHA-256 of config parts, which can be pydantic models, dicts or
+    plain values.
+    """
+    dumped = [
+        part.model_dump(mode="json") if hasattr(part, "model_dump") else part
+        for part in parts
+    ]
+    text = json.dumps(dumped, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def source_fingerprint(path):
+    """
+    Fingerprint of a data file, or of the names, sizes and modification
+    times of the files in a folder.
+    """
+    from neptoon_gui_ingest import file_hash
+
+    if path is None:
+        return None
+    path = Path(path)
+    if path.is_file():
+        return file_hash(path)
+    if path.is_dir():
+        return config_fingerprint(
+            [
+                (
+                    str(x.relative_to(path)),
+                    x.stat().st_size,
+                    x.stat().st_mtime_ns,
+                )
+                for x in sorted(path.rglob("*"))
+                if x.is_file()
+            ]
+        )
+    return None
+
+
+def stage_config(process, stage, **params):
+    """
+    Fingerprint of the config subtree a stage depends on.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor holding the configs
+    stage : str
+        One of STAGES
+    **params
+        Stage settings that are given in the GUI rather than the config
+
+    Returns
+    -------
+    str
+        Config fingerprint
+    """
+    sensor = process.sensor_config
+    parts = dict(
+        parse=lambda: (
+            sensor.raw_data_parse_options,
+            sensor.time_series_data,
+            sensor.sensor_info.install_date,
+            source_fingerprint(
+                sensor.raw_data_parse_options.data_location
+                if sensor.raw_data_parse_options.parse_raw_data
+                else sensor.time_series_data.path_to_data
+            ),
+        ),
+        nmdb=lambda: (
+            process.process_config.correction_steps.incoming_radiation,
+        ),
+        quality=lambda: (
+            sensor.sensor_info,
+            sensor.input_data_qa,
+            process.process_config.neutron_quality_assessment,
+        ),
+        corrections=lambda: (
+            sensor.sensor_info,
+            process.process_config.correction_steps,
+        ),
+        calibration=lambda: (
+            sensor.calibration,
+            source_fingerprint(sensor.calibration.location),
+        ),
+        soil_moisture=lambda: (
+            sensor.sensor_info,
+            sensor.soil_moisture_qa,
+            process.process_config.neutron_quality_assessment,
+        ),
+    )[stage]()
+    return config_fingerprint(stage, *parts, params)
+
+
+def _pack(data_frame):
+    """Copy with object columns (e.g. flags) stored as categoricals."""
+    if data_frame is None:
+        return None
+    return data_frame.astype(
+        {c: "category" for c, t in data_frame.dtypes.items() if t == object}
+    )
+
+
+def _unpack(data_frame, reference_dtypes):
+    if data_frame is None:
+        return None
+    return data_frame.astype(
+        {c: object for c, t in reference_dtypes.items() if t == object}
+    )
+
+
+def snapshot(process, stage):
+    """Copy of the data hub state after a stage."""
+    hub = process.data_hub
+    entry = dict(
+        crns_data_frame=_pack(hub.crns_data_frame),
+        crns_dtypes=hub.crns_data_frame.dtypes,
+        flags_data_frame=_pack(hub.flags_data_frame),
+        flags_dtypes=(
+            None
+            if hub.flags_data_frame is None
+            else hub.flags_data_frame.dtypes
+        ),
+        calibrator=hub.calibrator,
+    )
+    if stage == "calibration":
+        entry["sensor_info"] = {
+            key: getattr(process.sensor_config.sensor_info, key)
+            for key in CALIBRATION_RESULTS
+        }
+    return entry
+
+
+def restore(process, entry, new_hub=False):
+    """Set the data hub to a copy of a stage output."""
+    from neptoon.hub import CRNSDataHub
+
+    crns_data_frame = _unpack(entry["crns_data_frame"], entry["crns_dtypes"])
+    if new_hub or process.data_hub is None:
+        process.data_hub = CRNSDataHub(
+            crns_data_frame=crns_data_frame,
+            sensor_info=process.sensor_config.sensor_info,
+        )
+    else:
+        process.data_hub.crns_data_frame = crns_data_frame
+    process.data_hub.flags_data_frame = _unpack(
+        entry["flags_data_frame"], entry["flags_dtypes"]
+    )
+    process.data_hub.calibrator = entry["calibrator"]
+    for key, value in entry.get("sensor_info", {}).items():
+        setattr(process.sensor_config.sensor_info, key, value)
+
+
+def run_stage(process, stage, config, compute, cache):
+    """
+    Run a stage through the cache.
+
+    The data hub is first reset to the output of the latest preceding
+    stage of this process, then the stage is looked up by its input and
+    config fingerprints and either restored or computed and stored.
+    Outputs of the following stages are dropped from the process, as
+    they no longer match.
+
+    Parameters
+    ----------
+    process : ProcessWithYaml
+        Processor whose data_hub is used
+    stage : str
+        One of STAGES
+    config : str
+        Fingerprint from stage_config()
+    compute : callable
+        Runs the stage on process.data_hub, called without arguments
+    cache : StageCache
+        Shared cache
+
+    Returns
+    -------
+    bool
+        True if the output was restored from the cache
+    """
+    outputs = getattr(process, "stage_outputs", None)
+    if outputs is None:
+        outputs = process.stage_outputs = {}
+
+    position = STAGES.index(stage)
+    if position == 0:
+        inputs = ""
+    else:
+        for previous in reversed(STAGES[:position]):
+            if previous in outputs:
+                restore(process, outputs[previous])
+                break
+        inputs = frame_fingerprint(
+            process.data_hub.crns_data_frame
+        ) + frame_fingerprint(process.data_hub.flags_data_frame)
+
+    key = hashlib.sha256((stage + inputs + config).encode()).hexdigest()
+    with cache.loading(key):
+        entry = cache.get(key)
+        if entry is None:
+            compute()
+            entry = snapshot(process, stage)
+            cache.put(key, entry)
+            hit = False
+        else:
+            restore(process, entry, new_hub=position == 0)
+            hit = True
+
+    # the output is referenced here too, so that eviction from the
+    # shared cache does not break the chain of this process
+    outputs[stage] = entry
+    for later in STAGES[position + 1 :]:
+        outputs.pop(later, None)
+    return hit
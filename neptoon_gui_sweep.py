@@ -0,0 +1,175 @@
+"""
+Parameter sweep of the spike detection.
+
+The expensive part of both spike detectors is computing the scores of
+the values for a period, i.e. the local outlier factors of UniLOF (with
+periods_in_calculation neighbours) or the rolling medians and MADs of
+the Hampel filter (with a window). Flagging them for a threshold is
+cheap. A SpikeSweep therefore computes the scores once per period and
+keeps them, so that changing the threshold only re-thresholds, and a
+grid of (period, threshold) costs one scoring per period.
+
+The flags are the same as those of the spike_uni_lof and spike_hampel
+checks of neptoon_gui_quality: for UniLOF, the thresholding and slope
+correction of saqc's flagUniLOF are applied to the kept scores with
+saqc's own helper, which exists for this kind of reuse.
+"""
+
+import numpy as np
+import pandas as pd
+
+COLUMN = "epithermal_neutrons_cph"
+
+# periods and thresholds offered for a sweep
+SWEEP_GRIDS = dict(
+    spike_uni_lof=dict(
+        periods=(6, 12, 24, 48),
+        thresholds=tuple(np.round(np.arange(1.1, 2.01, 0.1), 2)),
+    ),
+    spike_hampel=dict(
+        periods=(7, 13, 25, 49),
+        thresholds=tuple(np.arange(2.0, 10.01, 1.0)),
+    ),
+)
+
+
+def sweep_input(process):
+    """
+    Raw neutrons as the quality checks see them: from the output of the
+    NMDB stage if the process has one, as the quality stage starts from
+    it, otherwise from the data hub.
+    """
+    entry = (getattr(process, "stage_outputs", None) or {}).get("nmdb")
+    if entry is not None:
+        return entry["crns_data_frame"][COLUMN]
+    return process.data_hub.crns_data_frame[COLUMN]
+
+
+class SpikeSweep:
+    """
+    Spike scores of a series, computed once per period.
+
+    Parameters
+    ----------
+    series : pd.Series
+        Values with a DatetimeIndex
+    method : str
+        "spike_uni_lof" or "spike_hampel"
+    algorithm : str, optional
+        Nearest neighbour algorithm of UniLOF, by default "ball_tree"
+
+    Examples
+    --------
+    >>> sweep = SpikeSweep(series, "spike_hampel")
+    >>> sweep.flags(25, 5.0).sum()
+    >>> sweep.counts([13, 25], [4.0, 5.0, 6.0])
+    """
+
+    def __init__(self, series, method, algorithm="ball_tree"):
+        self.series = series
+        self.method = method
+        self.algorithm = algorithm
+        self.fingerprint = self.fingerprint_of(series)
+        self._scores = {}
+        self._counts = {}
+        # counts of the last grid, see counts()
+        self.grid = None
+
+    @staticmethod
+    def fingerprint_of(series):
+        return int(pd.util.hash_pandas_object(series, index=True).sum())
+
+    def matches(self, series, method):
+        """Whether the kept scores are those of a series and method."""
+        return method == self.method and (
+            series is self.series
+            or self.fingerprint_of(series) == self.fingerprint
+        )
+
+    def scores(self, period):
+        """Scores for a period, computed on first use."""
+        period = int(period)
+        if period not in self._scores:
+            values = self.series.to_numpy(dtype="float64")
+            if self.method == "spike_hampel":
+                from neptoon_gui_spikes import hampel_scores
+
+                scores = hampel_scores(values, window=period)
+            else:
+                from saqc import SaQC
+
+                qc = SaQC(
+                    pd.DataFrame({"values": values}, index=self.series.index),
+                    scheme="simple",
+                )
+                qc = qc.assignUniLOF(
+                    field="values",
+                    target="scores",
+                    n=period,
+                    algorithm=self.algorithm,
+                    statistical_extent=1,
+                )
+                scores = qc.data["scores"].to_numpy()
+            self._scores[period] = scores
+        return self._scores[period]
+
+    def flags(self, period, threshold):
+        """Spikes for a period and threshold, True for spikes."""
+        scores = self.scores(period)
+        if self.method == "spike_hampel":
+            from neptoon_gui_spikes import hampel_threshold
+
+            return hampel_threshold(scores, threshold)
+
+        from saqc import SaQC
+        from saqc.constants import BAD
+
+        qc = SaQC(
+            pd.DataFrame(
+                {"values": self.series.to_numpy(), "scores": scores},
+                index=self.series.index,
+            ),
+            scheme="simple",
+        )
+        # flagUniLOF(thresh=threshold) after assignUniLOF, see saqc
+        qc = qc._uniLOF(
+            "values",
+            int(period),
+            "scores",
+            slope_correct=True,
+            min_offset=None,
+            density="auto",
+            flag=BAD,
+            para_check=2,
+            thresh=threshold,
+            corruption=None,
+            probability=None,
+            dfilter=BAD,
+        )
+        return (qc.flags.to_pandas()["values"] != "UNFLAGGED").to_numpy()
+
+    def count(self, period, threshold):
+        key = (int(period), float(threshold))
+        if key not in self._counts:
+            self._counts[key] = int(self.flags(period, threshold).sum())
+        return self._counts[key]
+
+    def counts(self, periods, thresholds):
+        """
+        Number of spikes for a grid of periods and thresholds, also kept
+        as grid.
+
+        Returns
+        -------
+        pd.DataFrame
+            Counts with the periods as index and thresholds as columns
+        """
+        self.grid = pd.DataFrame(
+            [
+                [self.count(period, threshold) for threshold in thresholds]
+                for period in periods
+            ],
+            index=pd.Index(periods, name="period"),
+            columns=pd.Index(thresholds, name="threshold"),
+        )
+        return self.grid
@@ -0,0 +1,414 @@
+"""
+Server-side windowed views of large tables.
+
+st.dataframe sends the whole frame to the browser as Arrow on every
+rerun, for multi-year data tens of MB per table. A TableView keeps the
+row positions of a time range, filter and sort order of a frame on the
+server and returns one page of them, together with statistics of the
+columns over the selected rows, so that only the visible rows are sent.
+Positions and statistics are kept until the selection or the frame
+changes, so that turning pages only slices. show_table() draws a
+TableView with its controls on a page.
+"""
+
+import weakref
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+OPERATORS = (
+    "=",
+    "≠",
+    ">",
+    "≥",
+    "<",
+    "≤",
+    "contains",
+    "is missing",
+    "is not missing",
+)
+# operators that take no value
+UNARY = ("is missing", "is not missing")
+
+PAGE_SIZES = (50, 100, 500, 1000)
+
+
+def _condition(series, operator, value):
+    """Boolean mask of a filter on the values of a column."""
+    if operator == "is missing":
+        return series.isna().to_numpy()
+    if operator == "is not missing":
+        return series.notna().to_numpy()
+    if operator == "contains":
+        return (
+            series.astype(str)
+            .str.contains(str(value), case=False, regex=False)
+            .to_numpy()
+        )
+    if operator not in OPERATORS:
+        raise ValueError("Unknown filter operator {:}".format(operator))
+
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(
+                "{:} is numeric, {:} is not a number.".format(
+                    series.name, value
+                )
+            )
+        values = series.to_numpy(dtype="float64", na_value=np.nan)
+    else:
+        value = str(value)
+        values = series.astype(str).to_numpy()
+    with np.errstate(invalid="ignore"):
+        if operator == "=":
+            return values == value
+        if operator == "≠":
+            return values != value
+        if operator == ">":
+            return values > value
+        if operator == "≥":
+            return values >= value
+        if operator == "<":
+            return values < value
+        return values <= value
+
+
+def select_rows(
+    data_frame, start=None, end=None, filters=(), sort=None, ascending=True
+):
+    """
+    Positions of the rows of a time range that pass filters, sorted.
+
+    Parameters
+    ----------
+    data_frame : pd.DataFrame
+        Table, usually with a DatetimeIndex
+    start, end : datetime, optional
+        Time range of the rows (inclusive), naive bounds are taken in the
+        time zone of the index
+    filters : sequence of tuple, optional
+        (column, operator, value), see OPERATORS
+    sort : str, optional
+        Column to sort by, missing values last. By default the rows
+        keep their order.
+    ascending : bool, optional
+        Sort order, also of the rows without sort column
+
+    Returns
+    -------
+    np.ndarray
+        Row positions
+    """
+    from neptoon_gui_plot import align_bound
+
+    index = data_frame.index
+    first, last = 0, len(data_frame)
+    if isinstance(index, pd.DatetimeIndex) and (start or end):
+        start = align_bound(start, index.tz)
+        end = align_bound(end, index.tz)
+        if index.is_monotonic_increasing:
+            if start is not None:
+                first = index.searchsorted(start, side="left")
+            if end is not None:
+                last = index.searchsorted(end, side="right")
+            positions = np.arange(first, last)
+        else:
+            inside = np.ones(len(index), dtype=bool)
+            if start is not None:
+                inside &= index >= start
+            if end is not None:
+                inside &= index <= end
+            positions = np.flatnonzero(inside)
+    else:
+        positions = np.arange(first, last)
+
+    # every filter only looks at the rows that passed the ones before
+    for column, operator, value in filters:
+        series = data_frame[column].iloc[positions]
+        positions = positions[_condition(series, operator, value)]
+
+    if sort is not None:
+        series = data_frame[sort].iloc[positions].reset_index(drop=True)
+        order = series.sort_values(
+            ascending=ascending, kind="stable", na_position="last"
+        ).index.to_numpy()
+        positions = positions[order]
+    elif not ascending:
+        positions = positions[::-1]
+    return positions
+
+
+def column_statistics(data_frame):
+    """
+    Count, missing values, minimum, mean and maximum of the numeric
+    columns, number of distinct values and the most frequent one of the
+    others.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per column
+    """
+    numeric = data_frame.select_dtypes("number")
+    statistics = pd.DataFrame(
+        dict(
+            dtype=data_frame.dtypes.astype(str),
+            count=data_frame.count(),
+            missing=data_frame.isna().sum(),
+        )
+    )
+    statistics["min"] = numeric.min()
+    statistics["mean"] = numeric.mean()
+    statistics["max"] = numeric.max()
+    others = [c for c in data_frame.columns if c not in numeric.columns]
+    statistics["distinct"] = pd.Series(
+        {c: data_frame[c].nunique() for c in others}, dtype="float64"
+    )
+    statistics["most frequent"] = pd.Series(
+        {
+            c: (
+                str(data_frame[c].mode(dropna=True).iloc[0])
+                if data_frame[c].notna().any()
+                else None
+            )
+            for c in others
+        },
+        dtype=object,
+    )
+    statistics.index.name = "column"
+    return statistics
+
+
+class TableView:
+    """
+    A time range, filters and sort order of a frame, served page by
+    page.
+
+    Parameters
+    ----------
+    data_frame : pd.DataFrame
+        Table, only weakly referenced, so that a view kept in the
+        session does not keep a frame alive that a later stage replaced
+    columns : list of str, optional
+        Columns to show, by default all
+
+    Examples
+    --------
+    >>> view = TableView(data_hub.crns_data_frame)
+    >>> view.select(start="2020-01-01", sort="air_pressure")
+    >>> view.page(0, size=100)
+    """
+
+    def __init__(self, data_frame, columns=None):
+        self._data_frame = weakref.ref(data_frame)
+        self.columns = list(data_frame.columns if columns is None else columns)
+        self._column_positions = data_frame.columns.get_indexer(self.columns)
+        self._selection = None
+        self._positions = np.arange(len(data_frame))
+        self._statistics = None
+
+    def __len__(self):
+        """Number of selected rows."""
+        return len(self._positions)
+
+    @property
+    def data_frame(self):
+        """The frame of the view, None once it is gone."""
+        return self._data_frame()
+
+    def matches(self, data_frame, columns=None):
+        """Whether the view is one of this frame and columns."""
+        columns = list(data_frame.columns if columns is None else columns)
+        return data_frame is self.data_frame and columns == self.columns
+
+    def select(
+        self, start=None, end=None, filters=(), sort=None, ascending=True
+    ):
+        """
+        Select the rows, see select_rows(). The positions are computed
+        again only if the selection differs from the last one.
+
+        Returns
+        -------
+        int
+            Number of selected rows
+        """
+        selection = (start, end, tuple(filters), sort, ascending)
+        if selection != self._selection:
+            self._positions = select_rows(self.data_frame, *selection)
+            self._selection = selection
+            self._statistics = None
+        return len(self._positions)
+
+    def pages(self, size):
+        return max(1, -(-len(self._positions) // size))
+
+    def page(self, number, size):
+        """Rows of page number (from 0) with size rows per page."""
+        positions = self._positions[number * size : (number + 1) * size]
+        return self.data_frame.iloc[positions, self._column_positions]
+
+    def statistics(self):
+        """Column statistics of the selected rows, kept until they change."""
+        if self._statistics is None:
+            self._statistics = column_statistics(
+                self.data_frame.iloc[self._positions, self._column_positions]
+            )
+        return self._statistics
+
+
+def show_table(container, data_frame, key, columns=None):
+    """
+    Table of a large frame of which only one page of rows is sent to the
+    browser, see neptoon_gui_table.py. The rows can be limited to a time
+    range, filtered and sorted on the server, and the statistics of the
+    columns over the selected rows are shown below.
+
+    Parameters
+    ----------
+    container : DeltaGenerator
+        Where the table is drawn, e.g. st or a tab
+    data_frame : pd.DataFrame
+        Table, usually with a DatetimeIndex
+    key : str
+        Unique key of the table
+    columns : list of str, optional
+        Columns to show, by default all
+    """
+    view = st.session_state.get(key + "_view")
+    if view is None or not view.matches(data_frame, columns):
+        view = TableView(data_frame, columns)
+        st.session_state[key + "_view"] = view
+    # stored selections that do not fit a changed frame are dropped
+    for name, options in (
+        ("_sort", view.columns),
+        ("_filter_column", view.columns),
+    ):
+        value = st.session_state.get(key + name)
+        if value is not None and value not in options:
+            del st.session_state[key + name]
+
+    c1, c2, c3 = container.columns([2, 2, 1])
+    start = end = None
+    index = data_frame.index
+    index_name = "Time" if isinstance(index, pd.DatetimeIndex) else "Row"
+    if isinstance(index, pd.DatetimeIndex) and len(index):
+        first, last = index.min().date(), index.max().date()
+        dates = st.session_state.get(key + "_dates")
+        if dates and not all(first <= date <= last for date in dates):
+            del st.session_state[key + "_dates"]
+        value = (
+            {}
+            if key + "_dates" in st.session_state
+            else dict(value=(first, last))
+        )
+        dates = c1.date_input(
+            "Time range",
+            min_value=first,
+            max_value=last,
+            key=key + "_dates",
+            **value,
+        )
+        if len(dates) == 2:
+            start = pd.Timestamp(dates[0])
+            end = pd.Timestamp(dates[1]) + pd.Timedelta(
+                days=1, microseconds=-1
+            )
+    sort = c2.selectbox(
+        "Sort by",
+        [None] + view.columns,
+        format_func=lambda column: column or index_name,
+        key=key + "_sort",
+    )
+    order = c3.selectbox(
+        "Order", ["ascending", "descending"], key=key + "_order"
+    )
+
+    c1, c2, c3 = container.columns([2, 1, 2])
+    column = c1.selectbox(
+        "Filter",
+        [None] + view.columns,
+        format_func=lambda column: "No filter" if column is None else column,
+        key=key + "_filter_column",
+    )
+    operator = c2.selectbox(
+        "Condition",
+        OPERATORS,
+        disabled=column is None,
+        key=key + "_filter_operator",
+    )
+    value = c3.text_input(
+        "Value",
+        disabled=column is None or operator in UNARY,
+        key=key + "_filter_value",
+    )
+    filters = []
+    if column is not None and (operator in UNARY or value != ""):
+        filters.append((column, operator, value))
+
+    ascending = order == "ascending"
+    try:
+        rows = view.select(start, end, filters, sort, ascending)
+    except ValueError as error:
+        container.error(error)
+        rows = view.select(start, end, (), sort, ascending)
+
+    c1, c2, c3 = container.columns([1, 1, 2])
+    size = c1.selectbox(
+        "Rows per page", PAGE_SIZES, index=1, key=key + "_page_size"
+    )
+    pages = view.pages(size)
+    if st.session_state.get(key + "_page", 1) > pages:
+        st.session_state[key + "_page"] = pages
+    page = c2.number_input(
+        "Page", min_value=1, max_value=pages, step=1, key=key + "_page"
+    )
+    c3.caption(
+        "Rows {:,} to {:,} of {:,}{:}".format(
+            (page - 1) * size + 1,
+            min(rows, page * size),
+            rows,
+            (
+                " (filtered from {:,})".format(len(data_frame))
+                if rows != len(data_frame)
+                else ""
+            ),
+        )
+        if rows
+        else "No rows selected."
+    )
+    container.dataframe(view.page(page - 1, size))
+    with container.expander(":material/functions: Column statistics"):
+        st.dataframe(
+            view.statistics(),
+            column_config=dict(
+                mean=st.column_config.NumberColumn("mean", format="%.4g"),
+            ),
+        )
+
+
+def show_quality_report(container, report):
+    """
+    Values flagged and time taken per quality check, see
+    neptoon_gui_quality.assess_quality(). Nothing is shown without a
+    report.
+    """
+    if report is None or report.empty:
+        return
+    with container.expander(
+        ":material/flag: {:,} values flagged by {:} checks in {:.2f} s".format(
+            report["flagged"].sum(), len(report), report["seconds"].sum()
+        )
+    ):
+        st.dataframe(
+            report,
+            hide_index=True,
+            column_config=dict(
+                seconds=st.column_config.NumberColumn(
+                    "Time (s)", format="%.3f"
+                )
+            ),
+        )
@@ -1,4 +1,8 @@
 import streamlit as st
+from neptoon_gui_datasets import enable_copy_on_write
+
+# sessions share the parsed datasets and copy only what they change
+enable_copy_on_write()
 
 # Icons: https://fonts.google.com/icons?icon.set=Material+Symbols&icon.style=Rounded
 
@@ -49,13 +53,28 @@ pages = [
         title="Run all",
         icon=":material/web_traffic:",
     ),
+    st.Page(
+        "gui-stations.py",
+        title="Stations",
+        icon=":material/hub:",
+    ),
     st.Page(
         "gui-export.py",
         title="Export",
         icon=":material/save:",
     ),
+    st.Page(
+        "gui-performance.py",
+        title="Performance",
+        icon=":material/speed:",
+    ),
 ]
 
+# Restore the session after a browser refresh or a server restart
+from neptoon_gui_checkpoint import checkpoint_session, restore_session
+
+restored = restore_session()
+
 # Initialize sharable session variables
 shared_session_variables = dict(
     config_sensor_selected="Custom configuration...",
@@ -86,6 +105,7 @@ shared_session_variables = dict(
     calibration_read_ready=False,
     calibration_finished=False,
     data_converted=False,
+    data_compact=False,
 )
 for var in shared_session_variables:
     if var not in st.session_state:
@@ -98,13 +118,46 @@ st.sidebar.image(
     "assets/neptoon-affils.svg", use_container_width=False, width=70
 )
 
-from neptoon.io.read import ConfigurationManager
-from neptoon.workflow import ProcessWithYaml
+from neptoon_gui_jobs import collect_jobs, show_jobs
+from neptoon_gui_session import compact_session_hub, session_memory_report
 
-# lets turn on the reporting system for our data
-from magazine import Magazine
+for job in collect_jobs():
+    if job.status == "done":
+        st.toast(":material/check: {:} finished.".format(job.name))
+    else:
+        st.toast(":material/error: {:} failed.".format(job.name))
+with st.sidebar:
+    show_jobs()
 
-Magazine.active = True
+st.sidebar.toggle(
+    "Compact data",
+    key="data_compact",
+    on_change=compact_session_hub,
+    help="Store the data with float32 numbers and categorical flags, which needs a fraction of the memory. Numbers keep about seven significant digits. Turning it off applies to data processed afterwards.",
+)
 
 pg = st.navigation(pages)
 pg.run()
+
+# neptoon, plotly and magazine are imported lazily where they are needed,
+# and loaded in the background once the first page is shown. This also
+# turns on the reporting system for our data (Magazine).
+from neptoon_gui_imports import preload
+
+preload()
+
+# the data is compacted by the toggle and after every stage, not here
+report = session_memory_report()
+if report is not None:
+    with st.sidebar.popover(
+        "Data in memory: {:.1f} MB".format(report["MB"].sum())
+    ):
+        st.dataframe(report, hide_index=True)
+
+checkpoint_session(shared_session_variables)
+if restored:
+    st.toast(
+        ":material/history: Session restored from {:}.".format(
+            restored.replace("T", " ")
+        )
+    )